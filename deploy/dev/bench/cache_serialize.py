@@ -0,0 +1,158 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Compare the old way of caching exam structures (JSON, with the dates
+    formatted and parsed as strings) with CachePack, for the exam structure
+    (get_exam_struct) and a course's list of exams (get_course_exam_all).
+    Prints the time to pack and unpack each, and the packed size.
+
+    Doesn't need the database, the structures are made up to look like
+    typical ones.
+
+    Usage:   cache_serialize.py [--rounds N] [--exams N]
+"""
+
+import os
+import sys
+import time
+import json
+import datetime
+from optparse import OptionParser
+
+# we should be SOMETHING/deploy/dev/bench/cache_serialize.py, find APPDIR
+# and add "SOMETHING/src" to our path
+APPDIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)))))
+sys.path.append(os.path.join(APPDIR, "src"))
+
+from oasis.lib import OaConfig, CachePack
+
+DATE_FMT = '%Y-%m-%d %H:%M:%S'
+
+
+def make_exam(exam_id):
+    """ Something like what Exams._exam_from_row returns. """
+    start = datetime.datetime(2014, 3, 10, 9, 0) + \
+        datetime.timedelta(days=exam_id)
+    return {'id': exam_id,
+            'title': "Week %d Assessment" % exam_id,
+            'owner': 12,
+            'type': 2,
+            'start': start,
+            'end': start + datetime.timedelta(days=7),
+            'instructions': "<p>Answer all the questions. You have one "
+                            "attempt at each, and your answers are saved "
+                            "as you go.</p>" * 4,
+            'comments': "",
+            'cid': 3,
+            'archived': 0,
+            'duration': 60,
+            'markstatus': 1,
+            'instant': 1,
+            'code': ""}
+
+
+def make_course_exams(num):
+    """ Something like what DB.get_course_exam_all returns. """
+    info = {}
+    for exam_id in range(1, num + 1):
+        exam = make_exam(exam_id)
+        info[exam_id] = {'id': exam_id, 'course': 3, 'name': exam['title'],
+                         'type': 2, 'start': exam['start'],
+                         'end': exam['end'],
+                         'description': exam['instructions'],
+                         'duration': 60,
+                         'startdate': exam['start'].strftime("%d %b"),
+                         'starttime': "09:00",
+                         'enddate': exam['end'].strftime("%d %b"),
+                         'endtime': "09:00"}
+    return info
+
+
+def json_pack_exam(exam):
+    """ The old Exams._serialize_examstruct """
+    safe = exam.copy()
+    safe['start'] = exam['start'].strftime(DATE_FMT)
+    safe['end'] = exam['end'].strftime(DATE_FMT)
+    return json.dumps(safe)
+
+
+def json_unpack_exam(obj):
+    """ The old Exams._deserialize_examstruct """
+    exam = json.loads(obj)
+    exam['start'] = datetime.datetime.strptime(exam['start'], DATE_FMT)
+    exam['end'] = datetime.datetime.strptime(exam['end'], DATE_FMT)
+    return exam
+
+
+def json_pack_info(info):
+    """ The old DB._serialize_courseexaminfo (without changing info) """
+    safe = {}
+    for k, exam in info.iteritems():
+        safe[k] = exam.copy()
+        safe[k]['start'] = exam['start'].strftime(DATE_FMT)
+        safe[k]['end'] = exam['end'].strftime(DATE_FMT)
+    return json.dumps(safe)
+
+
+def json_unpack_info(obj):
+    """ The old DB._deserialize_courseexaminfo """
+    safe = json.loads(obj)
+    info = {}
+    for k, exam in safe.iteritems():
+        info[k] = exam
+        info[k]['start'] = datetime.datetime.strptime(exam['start'], DATE_FMT)
+        info[k]['end'] = datetime.datetime.strptime(exam['end'], DATE_FMT)
+    return info
+
+
+def time_codec(value, packer, unpacker, rounds):
+    """ Return (microseconds to pack, microseconds to unpack, bytes) """
+    data = packer(value)
+    start = time.time()
+    for _ in range(rounds):
+        packer(value)
+    packed = time.time() - start
+    start = time.time()
+    for _ in range(rounds):
+        unpacker(data)
+    unpacked = time.time() - start
+    return (packed * 1000000.0 / rounds, unpacked * 1000000.0 / rounds,
+            len(data))
+
+
+def main():
+    """ Run the benchmark and print a table of results. """
+    parser = OptionParser(usage="%prog [--rounds N] [--exams N]")
+    parser.add_option("--rounds", dest="rounds", type="int", default=10000,
+                      help="times to pack and unpack each (default 10000)")
+    parser.add_option("--exams", dest="exams", type="int", default=30,
+                      help="exams in the course list (default 30)")
+    (opts, _) = parser.parse_args()
+
+    threshold = OaConfig.cache_compress_threshold
+    cases = [
+        ("exam struct", make_exam(1), json_pack_exam, json_unpack_exam),
+        ("course exams (%d)" % opts.exams, make_course_exams(opts.exams),
+         json_pack_info, json_unpack_info),
+    ]
+    print "%d rounds, compressing over %d bytes" % (opts.rounds, threshold)
+    print "%-20s %-10s %10s %12s %8s" % (
+        "value", "format", "pack (us)", "unpack (us)", "bytes")
+    for name, value, packer, unpacker in cases:
+        results = [
+            ("json", time_codec(value, packer, unpacker, opts.rounds)),
+            ("cachepack", time_codec(value, CachePack.pack,
+                                     CachePack.unpack, opts.rounds))]
+        OaConfig.cache_compress_threshold = 0
+        results.append(("uncompressed",
+                        time_codec(value, CachePack.pack,
+                                   CachePack.unpack, opts.rounds)))
+        OaConfig.cache_compress_threshold = threshold
+        for fmt, (packed, unpacked, size) in results:
+            print "%-20s %-10s %10.1f %12.1f %8d" % (
+                name, fmt, packed, unpacked, size)
+
+
+if __name__ == "__main__":
+    main()
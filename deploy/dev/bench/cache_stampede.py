@@ -0,0 +1,127 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Check that when a popular cache item expires, only one request
+    recomputes it, however many are asking for it at the time.
+
+    Many threads repeatedly fetch one short lived item through
+    MCPool.get_or_compute, with a slow compute function (like a big exam
+    being loaded from the database). Prints how many times it was computed
+    for each time it expired, which should be about 1 (a little more, as
+    it's sometimes refreshed early), and the most computes running at once,
+    which should be 1.
+
+    Usage:   cache_stampede.py [--threads N] [--seconds N] [--expiry N]
+                               [--compute N] [--delay N] [--memory]
+"""
+
+import os
+import sys
+import time
+import threading
+from optparse import OptionParser
+
+# we should be SOMETHING/deploy/dev/bench/cache_stampede.py, find APPDIR
+# and add "SOMETHING/src" to our path
+APPDIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)))))
+sys.path.append(os.path.join(APPDIR, "src"))
+
+from oasis.lib import OaConfig
+from oasis.lib.Pool import MCPool, MemoryCache
+
+
+class Counter(object):
+    """ Thread safe counter, remembers the highest it got to. """
+
+    def __init__(self):
+        self.count = 0
+        self.highest = 0
+        self.lock = threading.Lock()
+
+    def incr(self, amount=1):
+        """ Add to it, return the new count. """
+        with self.lock:
+            self.count += amount
+            self.highest = max(self.highest, self.count)
+            return self.count
+
+
+def hammer(cache, key, compute, expiry, delay, until, fetches, slowest):
+    """ Fetch the item, like a request would, until the time is up. """
+    while time.time() < until:
+        started = time.time()
+        cache.get_or_compute(key, compute, expiry)
+        elapsed = time.time() - started
+        fetches.incr()
+        if elapsed > slowest[0]:
+            slowest[0] = elapsed
+        time.sleep(delay)
+
+
+def main():
+    """ Run the load test and print the results. """
+    parser = OptionParser(usage="%prog [--threads N] [--seconds N] "
+                                "[--expiry N] [--compute N] [--delay N] "
+                                "[--memory]")
+    parser.add_option("--threads", dest="threads", type="int", default=50,
+                      help="number of concurrent requests (default 50)")
+    parser.add_option("--seconds", dest="seconds", type="int", default=30,
+                      help="how long to run for (default 30)")
+    parser.add_option("--expiry", dest="expiry", type="int", default=5,
+                      help="cache expiry of the item, seconds (default 5)")
+    parser.add_option("--compute", dest="compute", type="float",
+                      default=0.05,
+                      help="seconds to compute the item (default 0.05)")
+    parser.add_option("--delay", dest="delay", type="float", default=0.01,
+                      help="seconds each thread waits between fetches "
+                           "(default 0.01)")
+    parser.add_option("--memory", dest="memory", action="store_true",
+                      default=False,
+                      help="use an in-process cache instead of memcached")
+    opts = parser.parse_args()[0]
+
+    if opts.memory or not OaConfig.memcache_enable:
+        cache = MCPool([], backend=MemoryCache(16 * 1024 * 1024, 3600))
+        print "Using in-process cache"
+    else:
+        cache = MCPool(OaConfig.memcache_servers)
+        print "Using memcached on %s" % ", ".join(OaConfig.memcache_servers)
+
+    key = "stampede-test-%s-%s" % (os.getpid(), time.time())
+    computes = Counter()
+    running = Counter()
+    fetches = Counter()
+    slowest = [0.0]
+
+    def compute():
+        """ A slow database load """
+        computes.incr()
+        running.incr()
+        try:
+            time.sleep(opts.compute)
+        finally:
+            running.incr(-1)
+        return "x" * 1000
+
+    until = time.time() + opts.seconds
+    threads = [threading.Thread(target=hammer,
+                                args=(cache, key, compute, opts.expiry,
+                                      opts.delay, until, fetches, slowest))
+               for _ in range(opts.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expiries = max(1, opts.seconds // opts.expiry)
+    print "%d threads, %ds, item expires every %ds and takes %.2fs to compute" % (
+        opts.threads, opts.seconds, opts.expiry, opts.compute)
+    print "%d fetches, slowest %.3fs" % (fetches.count, slowest[0])
+    print "%d computes for %d expiries: %.2f per expiry" % (
+        computes.count, expiries, computes.count / float(expiries))
+    print "at most %d computes at once" % running.highest
+
+
+if __name__ == "__main__":
+    main()
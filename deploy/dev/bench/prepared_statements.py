@@ -0,0 +1,97 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Compare per-query latency of the queries on the practice question path
+    with and without server side prepared statements.
+
+    Usage:   prepared_statements.py [--questions N] [--rounds N]
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# we should be SOMETHING/deploy/dev/bench/prepared_statements.py, find APPDIR
+# and add "SOMETHING/src" to our path
+APPDIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)))))
+sys.path.append(os.path.join(APPDIR, "src"))
+
+from oasis.lib import OaConfig
+from oasis.lib.Pool import DbConn
+
+# What General.render_q_html and friends run for every practice question view.
+QUERIES = [
+    ("get_q_parent", "SELECT qtemplate FROM questions WHERE question=%s;"),
+    ("get_q_variation", "SELECT variation FROM questions WHERE question=%s;"),
+    ("get_q_version", "SELECT version FROM questions WHERE question=%s;"),
+    ("get_q_guesses", """SELECT part, guess
+                         FROM guesses
+                         WHERE question = %s
+                         ORDER BY created DESC;"""),
+]
+QT_QUERIES = [
+    ("get_qt_version", """SELECT version
+                          FROM qtemplates
+                          WHERE qtemplate=%s;"""),
+]
+
+
+def time_queries(dbc, questions, rounds, prepare):
+    """ Run each query over all the questions, rounds times.
+        Return {name: microseconds per query}
+    """
+    results = {}
+    for name, sql in QUERIES + QT_QUERIES:
+        if (name, sql) in QT_QUERIES:
+            params = [(qt_id,) for _, qt_id in questions]
+        else:
+            params = [(q_id,) for q_id, _ in questions]
+        dbc.run_sql(sql, params[0], prepare=prepare)  # warm up
+        start = time.time()
+        for _ in range(rounds):
+            for param in params:
+                dbc.run_sql(sql, param, prepare=prepare)
+        elapsed = time.time() - start
+        results[name] = elapsed * 1000000.0 / (rounds * len(params))
+    return results
+
+
+def main():
+    """ Run the benchmark and print a table of results. """
+    parser = OptionParser(usage="%prog [--questions N] [--rounds N]")
+    parser.add_option("--questions", dest="questions", type="int", default=100,
+                      help="number of recent questions to use (default 100)")
+    parser.add_option("--rounds", dest="rounds", type="int", default=20,
+                      help="times to repeat each query (default 20)")
+    (opts, _) = parser.parse_args()
+
+    dbc = DbConn(OaConfig.oasisdbconnectstring)
+    questions = dbc.run_sql("""SELECT question, qtemplate
+                               FROM questions
+                               ORDER BY question DESC
+                               LIMIT %s;""", (opts.questions,))
+    if not questions:
+        print "No questions in the database, practice some first."
+        sys.exit(1)
+
+    plain = time_queries(dbc, questions, opts.rounds, prepare=False)
+    prepared = time_queries(dbc, questions, opts.rounds, prepare=True)
+
+    print "%d questions, %d rounds" % (len(questions), opts.rounds)
+    print "%-18s %13s %13s %8s" % ("query", "plain (us)", "prepared (us)", "gain")
+    total_plain = total_prepared = 0.0
+    for name, _ in QUERIES + QT_QUERIES:
+        total_plain += plain[name]
+        total_prepared += prepared[name]
+        print "%-18s %13.1f %13.1f %7.1f%%" % (
+            name, plain[name], prepared[name],
+            100.0 * (plain[name] - prepared[name]) / plain[name])
+    print "%-18s %13.1f %13.1f %7.1f%%" % (
+        "per question view", total_plain, total_prepared,
+        100.0 * (total_plain - total_prepared) / total_plain)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Compare drawing question variation images the old way (loading the font
+    and decoding the template for every image, and saving as GIF) with
+    QImage, saving as GIF and as PNG.
+    Prints the time taken for all the variations, and their total size.
+
+    Doesn't need the database. Uses the template image given, or makes one
+    up, and made up values to draw on it.
+
+    Usage:   q_image.py [--variations N] [--values N] [--image FILE]
+"""
+
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+
+# we should be SOMETHING/deploy/dev/bench/q_image.py, find APPDIR
+# and add "SOMETHING/src" to our path
+APPDIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)))))
+sys.path.append(os.path.join(APPDIR, "src"))
+
+from PIL import Image, ImageDraw, ImageFont
+from oasis.lib import OaConfig, QImage
+
+
+def old_gen_q_image(qvars, image):
+    """ General.gen_q_image as it was. """
+    img = Image.open(StringIO(image)).convert("RGBA")
+    imgdraw = ImageDraw.Draw(img)
+    font = ImageFont.truetype("%s/fonts/Courier_New.ttf" % OaConfig.homedir, 14)
+    coords = [int(name[1:])
+              for name in qvars.keys()
+              if re.search("^X([0-9]+)$", name) > 0]
+    for coord in coords:
+        (xcoord, ycoord, value) = (qvars["X%d" % coord],
+                                   qvars["Y%d" % coord],
+                                   qvars["Z%d" % coord])
+        if (xcoord > -1) and (ycoord > -1):
+            value = unicode(value, "utf-8")
+            imgdraw.text((int(xcoord), int(ycoord)), value, font=font, fill="black")
+    data = StringIO("")
+    img.save(data, "GIF")
+    return data.getvalue()
+
+
+def make_template():
+    """ A diagram-like palette GIF. """
+    img = Image.new("RGB", (400, 300), "white")
+    draw = ImageDraw.Draw(img)
+    for pos in range(0, 400, 20):
+        draw.line((pos, 0, 400 - pos, 300), fill=(pos % 255, 100, 200))
+    draw.rectangle((50, 50, 150, 120), outline="red")
+    data = StringIO()
+    img.convert("P", palette=Image.ADAPTIVE, colors=64).save(data, "GIF")
+    return data.getvalue()
+
+
+def make_variations(num, values):
+    """ Made up variations with values to draw. """
+    variations = []
+    for var in range(num):
+        qvars = {'a': str(var)}
+        for val in range(1, values + 1):
+            qvars["X%d" % val] = str(20 + val * 60 % 340)
+            qvars["Y%d" % val] = str(20 + val * 45 % 260)
+            qvars["Z%d" % val] = "%d.%d kN" % (var, val)
+        variations.append(qvars)
+    return variations
+
+
+def run(name, func, variations):
+    """ Time func over all the variations and print a line of results. """
+    start = time.time()
+    images = func(variations)
+    took = time.time() - start
+    print "%-16s %8.2f s %8.2f ms each %10d KB" % (
+        name, took, took * 1000.0 / len(variations),
+        sum([len(img) for img in images]) / 1024)
+
+
+def main():
+    """ Run the benchmark and print the results. """
+    parser = OptionParser(usage="%prog [--variations N] [--values N] "
+                                "[--image FILE]")
+    parser.add_option("--variations", dest="variations", type="int",
+                      default=1000, help="variations to draw (default 1000)")
+    parser.add_option("--values", dest="values", type="int", default=5,
+                      help="values drawn on each (default 5)")
+    parser.add_option("--image", dest="image",
+                      help="template image (default, a made up one)")
+    (opts, _) = parser.parse_args()
+
+    if not os.path.exists("%s/fonts/Courier_New.ttf" % OaConfig.homedir):
+        OaConfig.homedir = os.path.join(APPDIR, "src")
+    if opts.image:
+        image = open(opts.image, "rb").read()
+    else:
+        image = make_template()
+    variations = make_variations(opts.variations, opts.values)
+
+    print "%d variations, %d values each" % (opts.variations, opts.values)
+    run("old (GIF)", lambda vs: [old_gen_q_image(qvars, image) for qvars in vs],
+        variations)
+    for fmt in ("GIF", "PNG"):
+        run("cached %s" % fmt,
+            lambda vs: [QImage.render(image, QImage.coords(qvars), fmt)
+                        for qvars in vs],
+            variations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Compare showing a question to a student the old way (a pass over the
+    HTML for every possible answer and option) with a compiled
+    CompiledQDisplay, for a question with many MULTI parts, all answered.
+
+    Doesn't need the database, the question is generated from a made up
+    template.
+
+    Usage:   render_q_html.py [--rounds N] [--parts N]
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# we should be SOMETHING/deploy/dev/bench/render_q_html.py, find APPDIR
+# and add "SOMETHING/src" to our path
+APPDIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)))))
+sys.path.append(os.path.join(APPDIR, "src"))
+
+from oasis.lib import General
+
+
+def make_question(parts):
+    """ The generated HTML of a question with the given number of parts,
+        and the student's guesses for each.
+    """
+    html = "<p>Intro, see <IMG SRC diagram.png>.</p>\n"
+    qvars = {}
+    guesses = {}
+    for part in range(1, parts + 1):
+        html += "<p>Part %d: what is <VAL q%d>?</p>" \
+                "<ANSWER%d MULTI o%d_1,o%d_2,o%d_3,o%d_4>\n" % \
+                ((part, part, part) + (part,) * 4)
+        qvars["q%d" % part] = part * 3
+        for opt in range(1, 5):
+            qvars["o%d_%d" % (part, opt)] = "option %d" % opt
+        guesses["G%d" % part] = "%d" % (part % 4 + 1)
+    return unicode(General.gen_q_html(qvars, html)), guesses
+
+
+def main():
+    """ Run the benchmark and print the results. """
+    parser = OptionParser(usage="%prog [--rounds N] [--parts N]")
+    parser.add_option("--rounds", dest="rounds", type="int", default=1000,
+                      help="times to render the question (default 1000)")
+    parser.add_option("--parts", dest="parts", type="int", default=20,
+                      help="MULTI parts in the question (default 20)")
+    (opts, _) = parser.parse_args()
+
+    text, guesses = make_question(opts.parts)
+    origin = (1, 1, 1)  # qt_id, version, variation
+    start = time.time()
+    compiled = General.CompiledQDisplay(text, *(origin + (False,)))
+    compile_time = time.time() - start
+    assert compiled.parts is not None, "question didn't compile"
+    old = General._q_display_passes(text, 5, *(origin + (False, dict(guesses))))
+    assert compiled.render(5, guesses) == old, "results differ"
+
+    start = time.time()
+    for _ in range(opts.rounds):
+        General._q_display_passes(text, 5, *(origin + (False, dict(guesses))))
+    passes = time.time() - start
+    start = time.time()
+    for _ in range(opts.rounds):
+        compiled.render(5, guesses)
+    rendered = time.time() - start
+
+    print "%d parts, %d bytes, %d rounds" % (opts.parts, len(text), opts.rounds)
+    print "compile once:  %8.3f ms" % (compile_time * 1000.0)
+    print "old renderer:  %8.3f ms each" % (passes * 1000.0 / opts.rounds)
+    print "compiled:      %8.3f ms each" % (rendered * 1000.0 / opts.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,7 @@ app = Flask(__name__,
             static_url_path=os.path.join(os.path.sep, OaConfig.staticpath, "static"))
 app.secret_key = OaConfig.secretkey
 app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024  # 8MB max file size upload
+app.use_x_sendfile = OaConfig.x_sendfile
 # CsrfProtect(app)  # enable once all forms checked
 
 # Flask initializes logging lazily and removes existing handlers when it does so,
@@ -64,17 +65,41 @@ L.addHandler(FH)
 L.setLevel(OaConfig.loglevel)
 L.info("File logger starting up")
 
+if OaConfig.db_slow_query_log:
+    SQH = RotatingFileHandler(filename=OaConfig.db_slow_query_log)
+    SQH.setLevel(logging.WARN)
+    SQH.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    SL = logging.getLogger("oasisqe.slowquery")
+    SL.addHandler(SQH)
+    SL.setLevel(logging.WARN)
+    SL.propagate = False
+
 from functools import wraps
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from oasis.lib import Users2, Users, DB
+from oasis.lib import Users2, Users, DB, QueryStats
 from oasis.lib.Audit import audit
 from oasis.lib.Permissions import satisfy_perms
 from oasis.lib.General import sanitize_username
 
 
+@app.before_request
+def before_request():
+    """ Reset per-request database state, eg. which server we read from."""
+    DB.start_request()
+
+
+@app.after_request
+def after_request(response):
+    """ Keep track of how many queries each page needs."""
+    queries, seconds = DB.request_stats()
+    QueryStats.record_request(request.endpoint, queries, seconds)
+    L.debug("%s ran %d queries in %.3fs" % (request.path, queries, seconds))
+    return response
+
+
 @app.context_processor
 def template_context():
     """ Useful values for templates to always have access to"""
@@ -24,33 +24,48 @@ def mark_exam(user_id, exam_id):
     numquestions = Exams.get_num_questions(exam_id)
     status = Exams.get_user_status(user_id, exam_id)
     L.info("Marking assessment %s for %s, status is %s" % (exam_id, user_id, status))
+    try:
+        examtotal, errors = _mark_exam_questions(user_id, exam_id,
+                                                 numquestions)
+    except OaMarkerError:
+        # a question couldn't be marked, so nothing has been saved
+        return False
+
+    if errors:
+        return False
+    L.info("user %s scored %s total on exam %s" %
+           (user_id, examtotal, exam_id))
+    return True
+
+
+def _mark_exam_questions(user_id, exam_id, numquestions):
+    """ Mark all the questions of the assessment. The marker scripts run
+        first, then the results are saved in one short transaction.
+        Returns (total score, number of errors). Raises OaMarkerError, and
+        nothing is saved, if a question can't be marked.
+    """
     examtotal = 0.0
     errors = 0
+    results = []
     for position in range(1, numquestions + 1):
         q_id = General.get_exam_q(exam_id, position, user_id)
         if not q_id:
-            L.critical("Unable to retrieve exam question page %s, exam %s, for user %s" % (position, exam_id, user_id
-                                                                                        ))
+            L.critical("Unable to retrieve exam question page %s, exam %s, for user %s" %
+                       (position, exam_id, user_id))
             errors += 1
             continue
         answers = DB.get_q_guesses(q_id)
-        # There's a small chance they got here without ever seeing a question,
-        # make sure it exists.
-        DB.add_exam_q(user_id, exam_id, q_id, position)
 
         # First, mark the question
         try:
             marks = General.mark_q(q_id, answers)
-            DB.set_q_status(q_id, 3)    # 3 = marked
-            DB.set_q_marktime(q_id)
         except OaMarkerError:
             L.warn("Marker Error in question %s, exam %s, student %s!" %
                    (q_id, exam_id, user_id))
-            return False
+            raise
         parts = [int(var[1:])
                  for var in marks.keys()
                  if re.search("^A([0-9]+)$", var) > 0]
-        parts.sort()
 
         # Then calculate the mark
         total = 0.0
@@ -60,19 +75,24 @@ def mark_exam(user_id, exam_id):
             except (KeyError, ValueError):
                 mark = 0
             total += mark
-            DB.update_q_score(q_id, total)
+        results.append((position, q_id, total, bool(parts)))
         examtotal += total
-    if not errors:
-        Exams.set_user_status(user_id, exam_id, 5)
-        Exams.set_submit_time(user_id, exam_id)
-        Exams.save_score(exam_id, user_id, examtotal)
-        Exams.touchuserexam(exam_id, user_id)
 
-    if errors:
-        return False
-    L.info("user %s scored %s total on exam %s" %
-           (user_id, examtotal, exam_id))
-    return True
+    with DB.transaction():
+        for position, q_id, total, scored in results:
+            # There's a small chance they got here without ever seeing a
+            # question, make sure it exists.
+            DB.add_exam_q(user_id, exam_id, q_id, position)
+            DB.set_q_status(q_id, 3)    # 3 = marked
+            DB.set_q_marktime(q_id)
+            if scored:
+                DB.update_q_score(q_id, total)
+        if not errors:
+            Exams.set_user_status(user_id, exam_id, 5)
+            Exams.set_submit_time(user_id, exam_id)
+            Exams.save_score(exam_id, user_id, examtotal)
+            Exams.touchuserexam(exam_id, user_id)
+    return examtotal, errors
 
 
 def student_exam_duration(student, exam_id):
@@ -173,8 +193,8 @@ def get_exam_list_sorted(user_id, prev_years=False):
     exams = []
     for cid in courses:
         try:
-            exams += [Exams.get_exam_struct(e, user_id)
-                      for e in Courses.get_exams(cid, prev_years=prev_years)]
+            exams += Exams.get_exam_structs(
+                Courses.get_exams(cid, prev_years=prev_years), user_id)
         except KeyError, err:
             L.error("Failed fetching exam list for user %s: %s" %
                     (user_id, err))
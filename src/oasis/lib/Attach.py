@@ -7,6 +7,8 @@
  Send a question attachment
 """
 
+import hashlib
+
 from oasis.lib import DB
 
 
@@ -24,22 +26,38 @@ def is_restricted(fname):
     return False
 
 
+def etag(kind, qtid, version, variation, name):
+    """ A strong ETag for an attachment. Attachment URLs include the version
+        and variation, so the content behind them never changes and the
+        URL itself identifies it.
+    """
+    key = u"%s/%d/%d/%d/%s" % (kind, qtid, version, variation, name)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
 def q_att_details(qtid, version, variation, name):
-    """ Find a question attachment and return its details. """
+    """ Find a question attachment and return its details:
+            (mimetype, filename, final)
+        final is False if it's the question template's image.gif or
+        qtemplate.html, standing in for the variation's until that's been
+        generated, so it will change.
+    """
     # for the two biggies we hit the question first,
     # otherwise check the question template first
     if name == "image.gif" or name == "qtemplate.html":
         fname = DB.get_q_att_fname(qtid, name, variation, version)
         if fname:
-            return DB.get_q_att_mimetype(qtid, name, variation, version), fname
+            return (DB.get_q_att_mimetype(qtid, name, variation, version),
+                    fname, True)
         fname = DB.get_qt_att_fname(qtid, name, version)
         if fname:
-            return DB.get_qt_att_mimetype(qtid, name, version), fname
+            return DB.get_qt_att_mimetype(qtid, name, version), fname, False
     else:
         fname = DB.get_qt_att_fname(qtid, name, version)
         if fname:
-            return DB.get_qt_att_mimetype(qtid, name, version), fname
+            return DB.get_qt_att_mimetype(qtid, name, version), fname, True
         fname = DB.get_q_att_fname(qtid, name, variation, version)
         if fname:
-            return DB.get_q_att_mimetype(qtid, name, variation, version), fname
-    return None, None
+            return (DB.get_q_att_mimetype(qtid, name, variation, version),
+                    fname, True)
+    return None, None, False
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" CachePack.py
+    Turn values into byte strings to keep in memcache (or the in-process
+    cache) and back again. Values are pickled in binary, so datetimes and
+    other Python types come back as they went in, without a trip through
+    strings, and compressed if they're bigger than cache_compress_threshold
+    bytes. Byte strings (eg. attachments) are kept as they are.
+
+    Each packed value starts with a byte saying how it was packed, so we
+    can change this later without mistaking old values for new ones.
+"""
+
+import cPickle
+import zlib
+from logging import getLogger
+
+import OaConfig
+
+L = getLogger("oasisqe")
+
+RAW = "s"
+PICKLED = "p"
+COMPRESSED = "z"  # followed by one of the others, compressed
+
+# zlib level. Cached values are mostly repetitive dicts and HTML, which the
+# fastest level does almost as well on.
+LEVEL = 1
+
+
+def pack(value):
+    """ Return the value as a byte string. """
+    if isinstance(value, str):
+        data = RAW + value
+    else:
+        data = PICKLED + cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    threshold = OaConfig.cache_compress_threshold
+    if threshold and len(data) > threshold:
+        compressed = COMPRESSED + zlib.compress(data, LEVEL)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+
+def unpack(data):
+    """ Return the value packed in data. If it isn't something we packed
+        (eg. left in memcache by an older version) return None, as if it
+        weren't there.
+    """
+    if not isinstance(data, str) or not data:
+        return None
+    try:
+        if data[0] == COMPRESSED:
+            data = zlib.decompress(data[1:])
+        if data[0] == RAW:
+            return data[1:]
+        if data[0] == PICKLED:
+            return cPickle.loads(data[1:])
+    except Exception as err:
+        L.warn("Unable to unpack cached value (%s)" % err)
+        return None
+    return None
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" CacheStats.py
+    Count hits, misses, sets and errors of the memcache and file caches, by
+    family of key (eg. "exam-*-struct"), so we can see which caches are
+    doing something useful, size them, and spot items that are stored but
+    never read back. Statistics are per process, since startup.
+"""
+
+import cPickle
+import re
+import threading
+
+# Stop tracking new families after this many, in case some key has a new
+# kind of value in it we don't recognise.
+MAX_FAMILIES = 500
+
+# Keys whose second part is a name rather than an id.
+NAMED_KINDS = ("generation", "attach")
+
+EVENTS = ("hits", "misses", "sets", "errors", "bytes")
+
+_lock = threading.Lock()
+_families = {}
+
+_RE_VALUE = re.compile(r"^(\d+|g[0-9a-f]{6,}|[0-9a-f]{32})$")
+
+
+def family(key):
+    """ The family of the cache key, the key with the ids, names and
+        generations in it replaced by *.
+          exam-12-struct-g5e3a1c2b0d47  ->  exam-*-struct-*
+          questionattach/3/image.gif/2/1/mimetype  ->  questionattach/*
+    """
+    if "/" in key:
+        # attachments, which have file names in them
+        parts = key.split("/")
+        return "%s/*" % parts[0]
+    parts = key.split("-")
+    if len(parts) >= 3 and parts[0] not in NAMED_KINDS:
+        # kind-id-name...
+        parts[1] = "*"
+    return "-".join([_RE_VALUE.match(part) and "*" or part
+                     for part in parts])
+
+
+def size(value):
+    """ Roughly how many bytes the value takes in the cache. """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, unicode):
+        return len(value.encode("utf-8"))
+    try:
+        return len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+    except (cPickle.PicklingError, TypeError):
+        return 0
+
+
+def record(cache, key, event, num=1):
+    """ Count an event ("hits", "misses", "sets", "errors" or "bytes") for
+        the key in the given cache ("memcache" or "file").
+    """
+    fam = (cache, family(key))
+    with _lock:
+        stat = _families.get(fam)
+        if stat is None:
+            if len(_families) >= MAX_FAMILIES:
+                fam = (cache, "(other)")
+                stat = _families.get(fam)
+            if stat is None:
+                stat = dict([(name, 0) for name in EVENTS])
+                _families[fam] = stat
+        stat[event] += num
+
+
+def record_set(cache, key, value):
+    """ Count storing the value under the key. """
+    record(cache, key, "sets")
+    record(cache, key, "bytes", size(value))
+
+
+def families():
+    """ Return the statistics for each family of keys, busiest first, as a
+        list of dicts:
+            cache, family, hits, misses, sets, errors, bytes, hit_rate
+        hit_rate is the percentage of lookups found, None if there were none.
+    """
+    with _lock:
+        stats = [(fam, dict(stat)) for fam, stat in _families.items()]
+    result = []
+    for (cache, fam), stat in stats:
+        stat['cache'] = cache
+        stat['family'] = fam
+        lookups = stat['hits'] + stat['misses']
+        if lookups:
+            stat['hit_rate'] = 100.0 * stat['hits'] / lookups
+        else:
+            stat['hit_rate'] = None
+        result.append(stat)
+    result.sort(key=lambda s: (s['hits'] + s['misses'] + s['sets']),
+                reverse=True)
+    return result
+
+
+def reset():
+    """ Throw away the statistics collected so far. """
+    with _lock:
+        _families.clear()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" CacheWarm.py
+    Load everything an exam needs into the caches before it starts, so
+    hundreds of students starting at once don't all hit the database for it.
+
+    Only the shared caches (file cache on this server, and memcache) benefit,
+    the in-process caches of the web server processes can't be reached.
+
+    Only attachments that exist are loaded. Variations that haven't been
+    generated yet may be any moment, so we don't record them as missing.
+"""
+
+import time
+from multiprocessing.pool import ThreadPool
+from logging import getLogger
+
+from oasis.lib import DB, Exams
+from oasis.lib.DB import run_sql
+
+L = getLogger("oasisqe")
+
+# Attachments looked up for every variation when questions are generated
+# and shown.
+VARIATION_ATTACHMENTS = ("image.gif", "qtemplate.html")
+
+
+def exams_starting(minutes):
+    """ Return the ids of unarchived exams that start within the next
+        minutes minutes.
+    """
+    assert isinstance(minutes, int)
+    ret = run_sql("""SELECT exam
+                     FROM exams
+                     WHERE "start" >= NOW()
+                       AND "start" <= NOW() + %s * INTERVAL '1 minute'
+                       AND archived = '0'
+                     ORDER BY "start";""", (minutes,))
+    return [int(row[0]) for row in ret or []]
+
+
+def _exam_positions(exam_id):
+    """ The question positions used in the exam. """
+    ret = run_sql("""SELECT DISTINCT position
+                     FROM examqtemplates
+                     WHERE exam=%s
+                     ORDER BY position;""", (exam_id,))
+    return [int(row[0]) for row in ret or []]
+
+
+def _warm_qt_attachment(qt_id, name, version):
+    """ Load a question template attachment. """
+    if DB.get_qt_att_fname(qt_id, name, version):
+        DB.get_qt_att_mimetype(qt_id, name, version)
+        return "attachments"
+    return "missing"
+
+
+def _warm_variation(qt_id, variation, version, names):
+    """ Load a variation, and the named generated attachments it has. """
+    DB.get_qt_variation(qt_id, variation, version)
+    for name in names:
+        DB.get_q_att_mimetype(qt_id, name, variation, version)
+        DB.get_q_att_fname(qt_id, name, variation, version)
+    return "variations"
+
+
+def _run(task):
+    """ Run one warming task in a worker thread. """
+    func = task[0]
+    try:
+        return func(*task[1:])
+    except BaseException as err:
+        L.warn("Cache warm %s%s failed: %s" % (func.__name__, task[1:], err))
+        return "errors"
+
+
+def warm_exam(exam_id, workers=4, max_variations=None):
+    """ Load the exam and everything in it into the caches, using the given
+        number of threads. If max_variations is given, only load that many
+        variations of each question template.
+        Returns a dict with counts of what was loaded.
+    """
+    assert isinstance(exam_id, int)
+    started = time.time()
+    report = {'exam': exam_id,
+              'positions': 0,
+              'qtemplates': 0,
+              'attachments': 0,
+              'missing': 0,
+              'variations': 0,
+              'errors': 0}
+
+    exam = Exams.get_exam_struct(exam_id)
+    report['title'] = exam['title']
+    DB.get_course_exam_all(exam['cid'])
+
+    qt_ids = set()
+    for position in _exam_positions(exam_id):
+        report['positions'] += 1
+        qt_ids.update(DB.get_exam_qts_in_pos(exam_id, position))
+    report['qtemplates'] = len(qt_ids)
+
+    tasks = []
+    for qt_id in sorted(qt_ids):
+        version = DB.get_qt_version(qt_id)
+        for name in sorted(DB.get_qt_atts(qt_id, version)):
+            tasks.append((_warm_qt_attachment, qt_id, name, version))
+        generated = dict([(name, DB.get_q_att_variations(qt_id, name, version))
+                          for name in VARIATION_ATTACHMENTS])
+        numvars = DB.get_qt_num_variations(qt_id, version)
+        if max_variations:
+            numvars = min(numvars, max_variations)
+        for variation in range(1, numvars + 1):
+            names = [name for name in VARIATION_ATTACHMENTS
+                     if variation in generated[name]]
+            tasks.append((_warm_variation, qt_id, variation, version, names))
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        for result in pool.imap_unordered(_run, tasks):
+            report[result] += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    report['seconds'] = time.time() - started
+    L.info("Cache warmed for exam %(exam)s: %(qtemplates)s qtemplates, "
+           "%(attachments)s attachments, %(variations)s variations, "
+           "%(errors)s errors in %(seconds).1fs" % report)
+    return report
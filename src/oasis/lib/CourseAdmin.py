@@ -42,14 +42,12 @@ def do_topic_update(course, request):
                 Topics.set_pos(i['id'], i['position'])
                 Topics.set_name(int(i['id']), i['name'])
                 Topics.set_vis(i['id'], i['visibility'])
-                Courses.incr_version()
             else:
                 if not i['name'] == "[Name of new topic]":
                     Topics.create(course['id'],
                                   i['name'],
                                   int(i['visibility']),
                                   i['position'])
-                    Courses.incr_version()
 
         return True
 
@@ -7,7 +7,7 @@
     Handle course related operations.
 """
 from oasis.lib import Topics, Groups
-from oasis.lib.DB import run_sql, MC
+from oasis.lib.DB import run_sql, MC, gen_key, bump_generation
 import datetime
 from logging import getLogger
 
@@ -18,9 +18,9 @@ L = getLogger("oasisqe")
 
 def get_version():
     """ Fetch the current version of the course table.
-        This will be incremented when anything in the courses table is changed.
-        The idea is that while the version hasn't changed, course information
-        can be cached in memory.
+        This will be incremented when courses are added.
+        Changes to a course bump its generation instead (see
+        DB.bump_generation)
     """
     key = "coursetable-version"
     obj = MC.get(key)
@@ -50,36 +50,33 @@ def set_name(course_id, name):
     """ Set the name of a course."""
     assert isinstance(course_id, int)
     assert isinstance(name, str) or isinstance(name, unicode)
-    incr_version()
     run_sql("UPDATE courses SET title=%s WHERE course=%s;", (name, course_id))
-    key = "course-%s-name" % course_id
-    MC.delete(key)
+    bump_generation("course", course_id)
 
 
 def set_title(course_id, title):
     """ Set the title of a course."""
     assert isinstance(course_id, int)
     assert isinstance(title, str) or isinstance(title, unicode)
-    incr_version()
     run_sql("UPDATE courses SET description=%s WHERE course=%s;",
             (title, course_id))
-    key = "course-%s-title" % course_id
-    MC.delete(key)
+    bump_generation("course", course_id)
 
 
 def get_active(course_id):
     """ Fetch the active flag"""
     assert isinstance(course_id, int)
-    key = "course-%s-active" % course_id
-    obj = MC.get(key)
-    if obj is not None:
-        return obj
-    ret = run_sql("SELECT active FROM courses WHERE course=%s;", (course_id,))
-    if ret:
-        MC.set(key, ret[0][0])
-        return ret[0][0]
-    L.error("Request for active flag of unknown course %s." % course_id)
-    return None
+    key = gen_key("course", course_id, "active")
+
+    def load():
+        """ Fetch it from the database """
+        ret = run_sql("SELECT active FROM courses WHERE course=%s;",
+                      (course_id,))
+        if ret:
+            return ret[0][0]
+        L.error("Request for active flag of unknown course %s." % course_id)
+        return None
+    return MC.get_or_compute(key, load, 600)
 
 
 def set_active(course_id, active):
@@ -91,9 +88,7 @@ def set_active(course_id, active):
     else:
         val = 0
     run_sql("UPDATE courses SET active=%s WHERE course=%s;", (val, course_id))
-    incr_version()
-    key = "course-%s-active" % course_id
-    MC.delete(key)
+    bump_generation("course", course_id)
     key = "courses-active"
     MC.delete(key)
 
@@ -105,7 +100,7 @@ def set_prac_vis(cid, visibility):
 
     run_sql("UPDATE courses SET practice_visibility=%s WHERE course=%s;",
             (visibility, cid))
-    incr_version()
+    bump_generation("course", cid)
 
 
 def set_assess_vis(cid, visibility):
@@ -115,7 +110,7 @@ def set_assess_vis(cid, visibility):
 
     run_sql("UPDATE courses SET assess_visibility=%s WHERE course=%s;",
             (visibility, cid))
-    incr_version()
+    bump_generation("course", cid)
 
 
 def get_users(course_id):
@@ -314,8 +309,6 @@ def get_topics_all(course, archived=2, numq=True):
                            'archived': row[4]}
             if info[count]['position'] is None or info[count]['position'] is "None":
                 info[count]['position'] = 0
-            if numq:
-                info[count]['numquestions'] = Topics.get_num_qs(int(row[0]))
             count += 1
     else:  # we probably don't have the archived flag in the Db yet
         ret = run_sql(
@@ -332,27 +325,25 @@ def get_topics_all(course, archived=2, numq=True):
                                'visibility': row[3]}
                 if info[count]['position'] is None or info[count]['position'] is "None":
                     info[count]['position'] = 0
-                if numq:
-                    info[count]['numquestions'] = Topics.get_num_qs(int(row[0]))
                 count += 1
+    if numq and info:
+        nums = Topics.get_num_qs_many([topic['id'] for topic in info.values()])
+        for topic in info.values():
+            topic['numquestions'] = nums[topic['id']]
     return info
 
 
 def get_topics(cid):
     """ Return a list of all topics in the course."""
-    key = "course-%s-topics" % cid
-    obj = MC.get(key)
-    if obj:
-        return obj
-    sql = "SELECT topic FROM topics WHERE course=%s ORDER BY position;"
-    params = (cid,)
-    ret = run_sql(sql, params)
-    if ret:
-        topics = [row[0] for row in ret]
-        MC.set(key, topics)
-        return topics
-    MC.set(key, [])
-    return []
+    key = gen_key("course", cid, "topics")
+
+    def load():
+        """ Fetch them from the database """
+        sql = "SELECT topic FROM topics WHERE course=%s ORDER BY position;"
+        params = (cid,)
+        ret = run_sql(sql, params)
+        return [row[0] for row in ret or []]
+    return MC.get_or_compute(key, load, 600)
 
 
 def get_exams(cid, prev_years=False):
@@ -8,16 +8,11 @@
     and to take some pressure off the database layer.
 """
 
-# Todo: this may misbehave when we're running parallel web servers.
-# Maybe make it expire automatically
-# every 10 mins or something. Or throw it all out and use flask-caching
-
-# Get the latest version of the course info
-# We can cache information until this changes, then we
-# need to flush and reread it from the Db layer
-# version will be bumped when any of the following changes:
-# course name, title, active, usersincourse, examsincourse, topicsincourse
-from oasis.lib import Courses
+# The course table version is bumped when courses are added, then we
+# reread them all from the Db layer.
+# Each course's generation is bumped when it changes (name, title, active,
+# topics, etc.), then we reread just that course.
+from oasis.lib import Courses, DB
 from logging import getLogger
 
 L = getLogger("oasisqe")
@@ -26,21 +21,42 @@ COURSES_VERSION = -1
 
 COURSES = {}
 
+# The generation of each course when we loaded it
+GENERATIONS = {}
+
 
 def load_courses():
     """Read the list of courses into memory """
     global COURSES
+    global GENERATIONS
     L.info("Courses fetched from database.")
-    COURSES = Courses.get_courses_dict()
+    courses = Courses.get_courses_dict()
+    GENERATIONS = DB.get_generations("course", courses.keys())
+    COURSES = courses
 
 
-def reload_if_needed():
-    """If the course table has changed, reload the info. """
+def reload_if_needed(course_ids=None):
+    """If the course table has changed, reload the info. Also reload any of
+       the given courses (default all of them) that have changed since.
+    """
     global COURSES_VERSION
     newversion = Courses.get_version()
     if newversion > COURSES_VERSION:
         COURSES_VERSION = newversion
         load_courses()
+        return
+    if course_ids is None:
+        course_ids = COURSES.keys()
+    gens = DB.get_generations("course", course_ids)
+    for course_id in course_ids:
+        if GENERATIONS.get(course_id) != gens[course_id]:
+            L.info("Course %s fetched from database." % course_id)
+            course = Courses.get_course(course_id)
+            if course:
+                COURSES[course_id] = course
+            else:
+                COURSES.pop(course_id, None)
+            GENERATIONS[course_id] = gens[course_id]
     return
 
 
@@ -85,7 +101,7 @@ def get_course_list(only_active=True, sortedby="name"):
 
 def get_topics(cid, archived=2):
     """ Return a dict of all topics in the course. """
-    reload_if_needed()
+    reload_if_needed([cid])
     if "topics" not in COURSES[cid]:
         COURSES[cid]['topics'] = Courses.get_topics_all(cid, archived, True)
     return COURSES[cid]['topics']
@@ -95,7 +111,7 @@ def get_topics_list(course_id, archived=2):
     """ Return a list of all topics in the course.
     """
 
-    reload_if_needed()
+    reload_if_needed([course_id])
     if "topics" not in COURSES[course_id]:
         COURSES[course_id]['topics'] = Courses.get_topics_all(course_id, archived, True)
     topics = COURSES[course_id]['topics']
@@ -107,7 +123,7 @@ def get_course(course_id):
     """ Return a dict of the course fields.
     """
 
-    reload_if_needed()
+    reload_if_needed([course_id])
     if course_id not in COURSES:
         load_courses()
     return COURSES[course_id]
@@ -12,40 +12,454 @@
 import psycopg2
 import cPickle
 import datetime
-import json
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
 
 IntegrityError = psycopg2.IntegrityError
 
 # Global dbpool
 import OaConfig
 import Pool
+import QueryStats
+from OaExceptions import OaPoolError
 from logging import getLogger
 
 L = getLogger("oasisqe.db")
 
 
-# 3 connections. Lets us keep going if one is slow but
-# doesn't overload the server if there're a lot of us
-dbpool = Pool.DbPool(OaConfig.oasisdbconnectstring, 3)
+# Grows from pool_min up to pool_max connections under load. Lets us keep
+# going if one is slow but doesn't overload the server if there're a lot of us
+dbpool = Pool.DbPool(OaConfig.oasisdbconnectstring,
+                     OaConfig.dbpool_min,
+                     maxsize=OaConfig.dbpool_max,
+                     timeout=OaConfig.dbpool_timeout,
+                     idle=OaConfig.dbpool_idle,
+                     stmt_cache_size=OaConfig.db_stmt_cache)
+
+# Pools for any read replicas. These start empty and connect when needed,
+# so a replica being down doesn't stop us starting.
+replicapools = [Pool.DbPool(connectstring,
+                            0,
+                            maxsize=OaConfig.dbpool_max,
+                            timeout=OaConfig.dbpool_timeout,
+                            idle=OaConfig.dbpool_idle,
+                            stmt_cache_size=OaConfig.db_stmt_cache)
+                for connectstring in OaConfig.replicaconnectstrings]
+
+# Keep small, frequently used values in memory, in front of the caches
+# below. Namespace: (key pattern, max items, seconds to keep).
+# Things that can change are only kept briefly, since other processes
+# won't hear about the change.
+if OaConfig.local_cache:
+    _local_namespaces = {
+        'mimetype': (r"attach/.*/mimetype$", 5000, 3600),
+        'qtversion': (r"^qtemplate-\d+-version$", 2000, 10),
+        'generation': (r"^generation-", 10000, 2),
+        'variation': (r"^qtemplate-\d+-vars", 5000, 3600),
+    }
+    if not OaConfig.memcache_enable:
+        # With memcached, another server may create the attachment, and
+        # can only tell us through memcached. See att_missing.
+        _local_namespaces['missing'] = (r"^attach-missing-", 5000, 60)
+    localCache = Pool.LocalCache(_local_namespaces)
+else:
+    localCache = None
 
 # Cache stuff on local drives to save our poor database
-fileCache = Pool.FileCache(OaConfig.cachedir)
+fileCache = Pool.FileCache(OaConfig.cachedir,
+                           maxbytes=OaConfig.cache_maxsize,
+                           maxage=OaConfig.cache_maxage,
+                           missing_ttl=OaConfig.cache_missing_ttl,
+                           local=localCache)
 
 from Pool import MCPool
 
-# Get a pool of memcache connections to use
-MC = MCPool('127.0.0.1:11211', 3)
+if OaConfig.memcache_enable:
+    mcBackend = None
+else:
+    # No memcached, so keep things in this process instead.
+    mcBackend = Pool.MemoryCache(OaConfig.memory_cache_size,
+                                 OaConfig.memory_cache_maxttl)
 
+# The memcached servers, shared with the other web servers.
+MC = MCPool(OaConfig.memcache_servers,
+            local=localCache,
+            dead_retry=OaConfig.memcache_dead_retry,
+            backend=mcBackend)
 
-def run_sql(sql, params=None, quiet=False):
-    """ Execute SQL commands using the dbpool"""
-    L.debug("SQL: %s ;(%s)", sql, params)
+
+# Per-thread state, such as the transaction the thread is currently in.
+_local = threading.local()
+
+
+class Transaction(object):
+    """ A database transaction, holding a single connection from the pool
+        until it is finished. Get one with DB.transaction()
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.after = []  # called once we've committed
+        self.wrote_variations = False  # see _variations_cacheable
+
+    def run_sql(self, sql, params=None, quiet=False, prepare=False):
+        """ Execute SQL commands inside the transaction."""
+        L.debug("SQL (tx): %s ;(%s)", sql, params)
+        started = time.time()
+        try:
+            return self.conn.run_sql(sql, params, quiet=quiet, prepare=prepare)
+        finally:
+            _record(sql, started, params)
+
+
+@contextmanager
+def transaction():
+    """ Run a group of statements over one connection, as one transaction.
+        It is committed when the block finishes, or rolled back if the
+        block raises an exception.
+
+        While the block runs, run_sql() on this thread (and so all the
+        helpers in here) also goes through the transaction, so existing
+        functions can be grouped without changing them. Nested calls
+        join the outer transaction.
+
+        example:
+
+        with DB.transaction() as tx:
+            tx.run_sql("UPDATE questions SET status=3 WHERE question=%s;",
+                       (q_id,))
+            DB.set_q_marktime(q_id)
+    """
+    current = getattr(_local, "tx", None)
+    if current:
+        yield current
+        return
     conn = dbpool.start()
-    res = conn.run_sql(sql, params, quiet=quiet)
-    dbpool.finish(conn)
+    tx = Transaction(conn)
+    _local.wrote = True
+    try:
+        conn.begin()
+        _local.tx = tx
+        yield tx
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _local.tx = None
+        dbpool.finish(conn)
+    for func in tx.after:
+        func()
+
+
+def after_commit(func):
+    """ Call func() once the current transaction has been committed, or
+        straight away if we're not in one. Use for clearing cache entries,
+        so other processes can't cache the old value again before they can
+        see the new one.
+    """
+    tx = getattr(_local, "tx", None)
+    if tx:
+        tx.after.append(func)
+    else:
+        func()
+
+
+# Things whose cached information can be thrown away all at once with
+# bump_generation()
+GENERATION_KINDS = ("course", "topic", "qtemplate", "exam", "user")
+
+
+def _generation_key(kind, ident):
+    """ The cache key holding the generation of the entity. """
+    assert kind in GENERATION_KINDS
+    return "generation-%s-%s" % (kind, ident)
+
+
+def _new_generation():
+    """ A generation that hasn't been used before. """
+    return "%x%04x" % (int(time.time() * 1000000), random.getrandbits(16))
+
+
+def _shared_get(key):
+    """ Fetch an item every process has to agree on, like a generation.
+        Without memcached, MC is only this process's memory, so they're
+        kept in the file cache instead, which the other processes on this
+        server can see.
+    """
+    if OaConfig.memcache_enable:
+        return MC.get(key)
+    (value, found) = fileCache.get(key)
+    if not found or value is False:
+        return None
+    return value
+
+
+def _shared_set(key, value, expiry=None):
+    """ Store an item fetched with _shared_get. value must be a string. """
+    if OaConfig.memcache_enable:
+        MC.set(key, value, expiry)
+    else:
+        fileCache.set(key, value)
+
+
+def _shared_delete(key):
+    """ Remove an item stored with _shared_set. """
+    if OaConfig.memcache_enable:
+        MC.delete(key)
+    else:
+        fileCache.set(key, False)
+
+
+def _store_generation(key, gen):
+    """ Remember the generation. """
+    _shared_set(key, gen)
+
+
+def get_generation(kind, ident):
+    """ Return the current generation of the course, topic, qtemplate,
+        exam or user. It's part of the key of everything cached about the
+        entity (see gen_key), so changing it throws them all away at once.
+    """
+    key = _generation_key(kind, ident)
+    gen = _shared_get(key)
+    if not gen:
+        # Never seen, or forgotten, so we can't trust anything cached
+        # under an older generation.
+        gen = _new_generation()
+        _store_generation(key, gen)
+    return gen
+
+
+def get_generations(kind, idents):
+    """ Like get_generation, for several entities of the same kind at once.
+        Returns a dict of {ident: generation}
+    """
+    keys = dict([(_generation_key(kind, ident), ident) for ident in idents])
+    gens = {}
+    if OaConfig.memcache_enable:
+        for key, gen in MC.get_multi(keys.keys()).iteritems():
+            if gen:
+                gens[keys[key]] = gen
+    for ident in idents:
+        if ident not in gens:
+            gens[ident] = get_generation(kind, ident)
+    return gens
+
+
+def gen_key(kind, ident, name, gen=None):
+    """ The cache key for the named item about the entity, in its current
+        generation, eg.  gen_key("course", 5, "active")
+    """
+    if gen is None:
+        gen = get_generation(kind, ident)
+    return "%s-%s-%s-g%s" % (kind, ident, name, gen)
+
+
+def bump_generation(kind, ident):
+    """ Throw away everything cached about the entity, in the file cache
+        and memcache. Done again when the current transaction commits, so
+        nothing read before then stays cached.
+    """
+    key = _generation_key(kind, ident)
+    _store_generation(key, _new_generation())
+    if getattr(_local, "tx", None):
+        after_commit(lambda: _store_generation(key, _new_generation()))
+
+
+def is_readonly_sql(sql):
+    """ Guess whether the SQL only reads from the database. """
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in ("SELECT", "SHOW"):
+        return False
+    upper = sql.upper()
+    for word in ("FOR UPDATE", "FOR SHARE", "NEXTVAL", "SETVAL", "INTO "):
+        if word in upper:
+            return False
+    return True
+
+
+def start_request():
+    """ Called at the start of each web request to reset the per-thread
+        database state.
+    """
+    _local.wrote = False
+    _local.queries = 0
+    _local.query_time = 0.0
+
+
+def request_stats():
+    """ How many queries this thread has run since start_request(), and
+        how many seconds they took.
+    """
+    return getattr(_local, "queries", 0), getattr(_local, "query_time", 0.0)
+
+
+def _record(sql, started, params=None):
+    """ Add a statement that started running at the given time to the query
+        statistics.
+    """
+    elapsed = time.time() - started
+    QueryStats.record(sql, elapsed, params)
+    _local.queries = getattr(_local, "queries", 0) + 1
+    _local.query_time = getattr(_local, "query_time", 0.0) + elapsed
+
+
+def _pool_for(sql, readonly):
+    """ Choose the pool to run the SQL on. Reads go to a replica if the caller
+        says it's ok (or we're configured to guess), unless we've already
+        written something during this request, in which case we stay on the
+        primary so we can read our own writes.
+    """
+    if not (readonly or is_readonly_sql(sql)):
+        _local.wrote = True
+        return dbpool
+    if not replicapools or getattr(_local, "wrote", False):
+        return dbpool
+    if readonly or OaConfig.db_replica_auto:
+        return random.choice(replicapools)
+    return dbpool
+
+
+def run_sql(sql, params=None, quiet=False, prepare=False, readonly=False):
+    """ Execute SQL commands using the dbpool, or the current transaction
+        if we're in one.
+        Set prepare for simple queries that are run very often, so the
+        connection keeps them as prepared statements.
+        Set readonly for queries that are fine with data that may be a
+        moment out of date, so they can be sent to a read replica. Not for
+        anything cached under a gen_key: a replica that's behind could store
+        the old data under the new generation.
+    """
+    tx = getattr(_local, "tx", None)
+    if tx:
+        return tx.run_sql(sql, params, quiet=quiet, prepare=prepare)
+    L.debug("SQL: %s ;(%s)", sql, params)
+    pool, conn = _start(sql, readonly)
+    started = time.time()
+    try:
+        res = conn.run_sql(sql, params, quiet=quiet, prepare=prepare)
+    finally:
+        _record(sql, started, params)
+        pool.finish(conn)
     return res
 
 
+def iter_sql(sql, params=None, batch=1000, readonly=False):
+    """ Generator yielding the rows of a SELECT one at a time, fetching them
+        from the server batch rows at a time. Use instead of run_sql for
+        queries that may return a lot of rows, so we don't need to hold
+        them all in memory.
+
+        example:
+
+        for uid, uname in iter_sql("SELECT id, uname FROM users;"):
+            ...
+
+        The connection is held until the loop finishes (or the generator
+        is thrown away).
+    """
+    tx = getattr(_local, "tx", None)
+    if tx:
+        for row in _timed_iter(tx.conn, sql, params, batch):
+            yield row
+        return
+    L.debug("SQL (iter): %s ;(%s)", sql, params)
+    pool, conn = _start(sql, readonly)
+    try:
+        for row in _timed_iter(conn, sql, params, batch):
+            yield row
+    finally:
+        pool.finish(conn)
+
+
+def _timed_iter(conn, sql, params, batch):
+    """ Iterate over conn.iter_sql, recording the time taken to get the first
+        batch (not the whole loop, which mostly depends on the caller).
+    """
+    started = time.time()
+    timing = True
+    for row in conn.iter_sql(sql, params, batch):
+        if timing:
+            _record(sql, started, params)
+            timing = False
+        yield row
+    if timing:
+        _record(sql, started, params)
+
+
+def _start(sql, readonly):
+    """ Get a connection for the SQL from the appropriate pool, falling back
+        to the primary if a replica is unavailable.
+        Returns (pool, conn), give conn back with pool.finish(conn)
+    """
+    pool = _pool_for(sql, readonly)
+    try:
+        conn = pool.start()
+    except OaPoolError as err:
+        if pool is dbpool:
+            raise
+        L.warn("DB replica unavailable, using primary. (%s)" % err)
+        pool = dbpool
+        conn = pool.start()
+    return pool, conn
+
+
+@contextmanager
+def _connection():
+    """ The connection to use: the current transaction's if we're in one,
+        otherwise one from the pool.
+    """
+    tx = getattr(_local, "tx", None)
+    if tx:
+        yield tx.conn
+        return
+    conn = dbpool.start()
+    try:
+        yield conn
+    finally:
+        dbpool.finish(conn)
+
+
+def run_many(sql, rows):
+    """ Execute the SQL once for each set of params in rows, batched into
+        as few round trips as possible.
+
+        example:
+
+        run_many("INSERT INTO usergroups (userid, groupid) VALUES (%s, %s);",
+                 [(uid, group_id) for uid in uids])
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    L.debug("SQL (many): %s ;(%d rows)", sql, len(rows))
+    with _connection() as conn:
+        started = time.time()
+        try:
+            conn.run_many(sql, rows)
+        finally:
+            _record(sql, started, "%d rows" % len(rows))
+
+
+def copy_rows(table, columns, rows):
+    """ Bulk insert rows (an iterable of tuples, in the same order as
+        columns) into the table, with COPY. Wrap bytea values with
+        psycopg2.Binary()
+        Returns the number of rows inserted.
+    """
+    L.debug("SQL (copy): %s (%s)", table, columns)
+    with _connection() as conn:
+        started = time.time()
+        try:
+            return conn.copy_rows(table, columns, rows)
+        finally:
+            _record('COPY "%s"' % table, started)
+
+
 def set_q_viewtime(question):
     """ Record that the question has been viewed.
         Not a good idea to call multiple times since it's
@@ -164,7 +578,8 @@ def set_q_status(q_id, status):
 def get_q_version(q_id):
     """ Return the template version this question was generated from """
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT version FROM questions WHERE question=%s;", (q_id,))
+    ret = run_sql("SELECT version FROM questions WHERE question=%s;", (q_id,),
+                  prepare=True)
     if ret:
         return int(ret[0][0])
     return None
@@ -173,16 +588,39 @@ def get_q_version(q_id):
 def get_q_variation(q_id):
     """ Return the template variation this question was generated from"""
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT variation FROM questions WHERE question=%s;", (q_id,))
+    ret = run_sql("SELECT variation FROM questions WHERE question=%s;", (q_id,),
+                  prepare=True)
     if ret:
         return int(ret[0][0])
     return None
 
 
+def get_q_origin(q_id):
+    """ Return (qtemplate, variation, version) the question was generated
+        from, or (None, None, None) if there's no such question. These
+        never change, so are cached.
+    """
+    assert isinstance(q_id, int)
+    key = "question-%d-origin" % q_id
+    obj = MC.get(key)
+    if obj is not None:
+        return obj
+    ret = run_sql("""SELECT qtemplate, variation, version
+                     FROM questions
+                     WHERE question=%s;""", (q_id,), prepare=True)
+    if not ret:
+        L.error("No parent found for question %s!" % q_id)
+        return None, None, None
+    origin = (int(ret[0][0]), int(ret[0][1]), int(ret[0][2]))
+    MC.set(key, origin, 3600)
+    return origin
+
+
 def get_q_parent(q_id):
     """ Return the template this question was generated from"""
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT qtemplate FROM questions WHERE question=%s;", (q_id,))
+    ret = run_sql("SELECT qtemplate FROM questions WHERE question=%s;", (q_id,),
+                  prepare=True)
     if ret:
         return int(ret[0][0])
     L.error("No parent found for question %s!" % q_id)
@@ -198,7 +636,8 @@ def save_guess(q_id, part, value):
     # noinspection PyComparisonWithNone
     if value is not None:  # "" is legit
         run_sql("""INSERT INTO guesses (question, created, part, guess)
-                   VALUES (%s, NOW(), %s, %s);""", (q_id, part, value))
+                   VALUES (%s, NOW(), %s, %s);""", (q_id, part, value),
+                prepare=True)
 
 
 def get_q_guesses(q_id):
@@ -207,7 +646,7 @@ def get_q_guesses(q_id):
     ret = run_sql("""SELECT part, guess
                      FROM guesses
                      WHERE question = %s
-                     ORDER BY created DESC;""", (q_id,))
+                     ORDER BY created DESC;""", (q_id,), prepare=True)
     if not ret:
         return {}
     guesses = {}
@@ -319,24 +758,37 @@ def incr_qt_version(qt_id):
     run_sql("""UPDATE qtemplates
                SET version=%s
                WHERE qtemplate=%s;""", (version, qt_id))
+    key = "qtemplate-%d-version" % qt_id
+    _shared_delete(key)
+    after_commit(lambda: _shared_delete(key))
     return version
 
 
 def get_qt_version(qt_id):
     """ Fetch the version of a question template."""
     assert isinstance(qt_id, int)
+    key = "qtemplate-%d-version" % qt_id
+    # Inside a transaction we may have changed it, so ask the database.
+    cache = not getattr(_local, "tx", None)
+    if cache:
+        obj = _shared_get(key)
+        if obj is not None:
+            return int(obj)
     ret = run_sql("""SELECT version
                      FROM qtemplates
-                     WHERE qtemplate=%s;""", (qt_id,))
+                     WHERE qtemplate=%s;""", (qt_id,), prepare=True)
     if ret:
-        return int(ret[0][0])
+        version = int(ret[0][0])
+        if cache:
+            _shared_set(key, str(version), 60)
+        return version
     raise KeyError("Question Template version %s not found" % qt_id)
 
 
 def get_qt_maxscore(qt_id):
     """ Fetch the maximum score of a question template."""
     assert isinstance(qt_id, int)
-    key = "qtemplate-%d-maxscore" % (qt_id,)
+    key = gen_key("qtemplate", qt_id, "maxscore")
     obj = MC.get(key)
     if obj is not None:  # 0 or [] or "" could be legit
         return obj
@@ -376,7 +828,7 @@ def get_qt_owner(qt_id):
 def get_qt_name(qt_id):
     """ Fetch the name of a question template."""
     assert isinstance(qt_id, int)
-    key = "qtemplate-%d-name" % qt_id
+    key = gen_key("qtemplate", qt_id, "name")
     obj = MC.get(key)
     if obj is not None:
         return obj
@@ -418,6 +870,59 @@ def get_qt_atts(qt_id, version=1000000000):
     return []
 
 
+def _missing_key(key):
+    """ The memcache key recording that the attachment doesn't exist.
+        Attachment names may contain anything, so use a hash.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return "attach-missing-%s" % hashlib.md5(key).hexdigest()
+
+
+def att_missing(key):
+    """ Have we recently looked for the attachment and found it doesn't
+        exist? Many questions don't have an image.gif, results script, etc.
+        so this saves asking the database every time.
+        With memcached the marker is only kept there, so that when any
+        server creates the attachment the others all hear about it.
+        Without, it's also kept in the file cache for the other processes
+        on this server.
+    """
+    if MC.get(_missing_key(key)):
+        return True
+    if OaConfig.memcache_enable:
+        return False
+    return fileCache.is_missing(key)
+
+
+def set_att_missing(key):
+    """ Remember that the attachment doesn't exist, for a while. """
+    MC.set(_missing_key(key), True, OaConfig.cache_missing_ttl)
+    if not OaConfig.memcache_enable:
+        fileCache.set_missing(key)
+
+
+def att_created(key):
+    """ The attachment has been created, forget that it was missing.
+        Done again after the transaction commits, in case someone looked
+        for it in the meantime.
+    """
+    def forget():
+        """ Remove the missing markers. """
+        MC.delete(_missing_key(key))
+        fileCache.clear_missing(key)
+    forget()
+    after_commit(forget)
+
+
+def _qt_att_key(qt_id, name, version):
+    """ The file cache key for the question template attachment. Changed
+        attachments are always saved under a new version, so the version
+        is enough to tell them apart.
+    """
+    return "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
+
+
 def get_q_att_mimetype(qt_id, name, variation, version=1000000000):
     """ Return a string containing the mime type of the attachment.
     """
@@ -428,10 +933,12 @@ def get_q_att_mimetype(qt_id, name, variation, version=1000000000):
     if version == 1000000000:
         version = get_qt_version(qt_id)
     try:
-        key = "questionattach/%d/%s/%d/%d/mimetype" % \
-              (qt_id, name, variation, version)
+        attkey = "questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version)
+        key = "%s/mimetype" % attkey
         (value, found) = fileCache.get(key)
         if not found:
+            if att_missing(attkey):
+                return False
             ret = run_sql("""SELECT qtemplate, mimetype
                                 FROM qattach
                                 WHERE name=%s
@@ -443,8 +950,9 @@ def get_q_att_mimetype(qt_id, name, variation, version=1000000000):
                 data = ret[0][1]
                 fileCache.set(key, data)
                 return data
-                # We use mimetype to see if an attachment is generated so
-                # not finding one is no big deal.
+            # We use mimetype to see if an attachment is generated so
+            # not finding one is no big deal.
+            set_att_missing(attkey)
             return False
         return value
     except BaseException as err:
@@ -461,9 +969,12 @@ def get_qt_att_mimetype(qt_id, name, version=1000000000):
     assert isinstance(name, str) or isinstance(name, unicode)
     if version == 1000000000:
         version = get_qt_version(qt_id)
-    key = "qtemplateattach/%d/%s/%d/mimetype" % (qt_id, name, version)
+    attkey = _qt_att_key(qt_id, name, version)
+    key = "%s/mimetype" % attkey
     (value, found) = fileCache.get(key)
     if not found:
+        if att_missing(attkey):
+            return False
         nameparts = name.split("?")
         if len(nameparts) > 1:
             name = nameparts[0]
@@ -481,6 +992,7 @@ def get_qt_att_mimetype(qt_id, name, version=1000000000):
             data = ret[0][0]
             fileCache.set(key, data)
             return data
+        set_att_missing(attkey)
         return False
     return value
 
@@ -500,6 +1012,8 @@ def get_q_att_fname(qt_id, name, variation, version=1000000000):
     key = "questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version)
     (filename, found) = fileCache.get_filename(key)
     if not found:
+        if att_missing(key):
+            return False
         ret = run_sql("""SELECT qtemplate, data
                             FROM qattach
                             WHERE qtemplate=%s
@@ -513,7 +1027,8 @@ def get_q_att_fname(qt_id, name, variation, version=1000000000):
             (filename, found) = fileCache.get_filename(key)
             if found:
                 return filename
-        fileCache.set(key, False)
+            return False
+        set_att_missing(key)
         return False
     return filename
 
@@ -532,6 +1047,8 @@ def get_q_att(qt_id, name, variation, version=1000000000):
     key = "questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version)
     (value, found) = fileCache.get(key)
     if not found:
+        if att_missing(key):
+            return get_qt_att(qt_id, name, version)
         ret = run_sql("""SELECT qtemplate, data
                             FROM qattach
                             WHERE qtemplate=%s
@@ -543,7 +1060,7 @@ def get_q_att(qt_id, name, variation, version=1000000000):
             data = str(ret[0][1])
             fileCache.set(key, data)
             return data
-        fileCache.set(key, False)
+        set_att_missing(key)
         return get_qt_att(qt_id, name, version)
     return value
 
@@ -557,9 +1074,11 @@ def get_qt_att_fname(qt_id, name, version=1000000000):
     assert isinstance(name, str) or isinstance(name, unicode)
     if version == 1000000000:
         version = get_qt_version(qt_id)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
+    key = _qt_att_key(qt_id, name, version)
     (filename, found) = fileCache.get_filename(key)
     if (not found) or version == 1000000000:
+        if att_missing(key):
+            return False
         ret = run_sql("""SELECT data
                          FROM qtattach
                          WHERE qtemplate = %s
@@ -577,7 +1096,8 @@ def get_qt_att_fname(qt_id, name, version=1000000000):
             (filename, found) = fileCache.get_filename(key)
             if found:
                 return filename
-        fileCache.set(key, False)
+            return False
+        set_att_missing(key)
         return False
     return filename
 
@@ -591,9 +1111,11 @@ def get_qt_att(qt_id, name, version=1000000000):
     assert isinstance(name, str) or isinstance(name, unicode)
     if version == 1000000000:
         version = get_qt_version(qt_id)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
+    key = _qt_att_key(qt_id, name, version)
     (value, found) = fileCache.get(key)
     if (not found) or version == 1000000000:
+        if att_missing(key):
+            return False
         ret = run_sql("""SELECT data
                          FROM qtattach
                          WHERE qtemplate = %s
@@ -609,7 +1131,7 @@ def get_qt_att(qt_id, name, version=1000000000):
             data = str(ret[0][0])
             fileCache.set(key, data)
             return data
-        fileCache.set(key, False)
+        set_att_missing(key)
         return False
     return value
 
@@ -619,14 +1141,16 @@ def get_exam_qts_in_pos(exam_id, position):
     """
     assert isinstance(exam_id, int)
     assert isinstance(position, int)
-    ret = run_sql("""SELECT qtemplate
-                     FROM examqtemplates
-                     WHERE exam=%s
-                       AND position=%s;""", (exam_id, position))
-    if ret:
-        qtemplates = [int(row[0]) for row in ret]
-        return qtemplates
-    return []
+    key = gen_key("exam", exam_id, "position-%d-qtemplates" % position)
+
+    def load():
+        """ Fetch them from the database """
+        ret = run_sql("""SELECT qtemplate
+                         FROM examqtemplates
+                         WHERE exam=%s
+                           AND position=%s;""", (exam_id, position))
+        return [int(row[0]) for row in ret or []]
+    return MC.get_or_compute(key, load, 300)
 
 
 def get_qt_exam_pos(exam_id, qt_id):
@@ -646,7 +1170,7 @@ def get_qtemplate_topic_pos(qt_id, topic_id):
     """ Fetch the position of a question template in a topic. """
     assert isinstance(topic_id, int)
     assert isinstance(qt_id, int)
-    key = "topic-%d-qtemplate-%d-position" % (topic_id, qt_id)
+    key = gen_key("topic", topic_id, "qtemplate-%d-position" % qt_id)
     obj = MC.get(key)
     if obj is not None:
         return int(obj)
@@ -708,36 +1232,106 @@ def get_qt_variations(qt_id, version=1000000000):
     return ret
 
 
+def _variations_cacheable():
+    """ Can cached variations be used? Not if the current transaction has
+        added some, the cache doesn't know about them yet.
+    """
+    tx = getattr(_local, "tx", None)
+    return not (tx and tx.wrote_variations)
+
+
+def _variations_written():
+    """ Note that the current transaction has added variations. """
+    tx = getattr(_local, "tx", None)
+    if tx:
+        tx.wrote_variations = True
+
+
+def _qt_variations_version(qt_id, version):
+    """ The version of the question template's variations that its given
+        version uses, the newest one that isn't newer. None if there are
+        none. Variations only ever change along with the version, so this
+        doesn't change either.
+    """
+    key = "qtemplate-%d-varsversion-%d" % (qt_id, version)
+    cache = _variations_cacheable()
+    if cache:
+        obj = MC.get(key)
+        if obj is not None:
+            return obj
+    ret = run_sql("""SELECT MAX(version)
+                     FROM qtvariations
+                     WHERE qtemplate=%s
+                       AND version <= %s;""", (qt_id, version), prepare=True)
+    if not ret or ret[0][0] is None:
+        return None
+    resolved = int(ret[0][0])
+    if cache:
+        MC.set(key, resolved, 3600)
+    return resolved
+
+
 def get_qt_variation(qt_id, variation, version=1000000000):
-    """ Return a specific variation of a question template."""
+    """ Return a specific variation of a question template, a dict of its
+        variables. The decoded variables are cached (and kept in memory by
+        localCache), keyed by the version of the variations actually used.
+        Each caller gets its own copy, since markers change it.
+    """
     assert isinstance(qt_id, int)
     assert isinstance(version, int)
     assert isinstance(variation, int)
     if version == 1000000000:
         version = get_qt_version(qt_id)
-    res = run_sql("""SELECT data
+    resolved = _qt_variations_version(qt_id, version)
+    if resolved is None:
+        L.warn("Request for unknown qt variation. (%s, %s, %s)" %
+               (qt_id, variation, version))
+        return None
+    key = "qtemplate-%d-vars-%d-%d" % (qt_id, variation, resolved)
+    cache = _variations_cacheable()
+    qvars = None
+    if cache:
+        qvars = MC.get(key)
+    if qvars is None:
+        res = run_sql("""SELECT data
+                         FROM qtvariations
+                         WHERE qtemplate=%s
+                           AND variation=%s
+                           AND version=%s;""",
+                      (qt_id, variation, resolved), prepare=True)
+        if not res:
+            L.warn("Request for unknown qt variation. (%s, %s, %s)" %
+                   (qt_id, variation, version))
+            return None
+        try:
+            qvars = cPickle.loads(str(res[0][0]))
+        except TypeError:
+            L.warn("Type error trying to cpickle.loads(%s) for (%s, %s, %s)" %
+                   (type(res[0][0]), qt_id, variation, version))
+            return None
+        if cache:
+            MC.set(key, qvars, 3600)
+    # the variables are strings and numbers, so a shallow copy will do
+    return dict(qvars)
+
+
+def get_qt_variations_data(qt_id, version):
+    """ Return a list of (variation, data) for every variation of the
+        question template version, in order. The data is still pickled,
+        see get_qt_variation.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    ret = run_sql("""SELECT variation, data
                      FROM qtvariations
                      WHERE qtemplate=%s
-                       AND variation=%s
                        AND version =
                          (SELECT MAX(version)
                           FROM qtvariations
                           WHERE qtemplate=%s
-                            AND version <= %s);""",
-                  (qt_id, variation, qt_id, version))
-    if not res:
-        L.warn("Request for unknown qt variation. (%s, %s, %s)" %
-            (qt_id, variation, version))
-        return None
-    result = None
-    data = None
-    try:
-        result = str(res[0][0])
-        data = cPickle.loads(result)
-    except TypeError:
-        L.warn("Type error trying to cpickle.loads(%s) for (%s, %s, %s)" %
-            (type(result), qt_id, variation, version))
-    return data
+                            AND version <= %s)
+                     ORDER BY variation;""", (qt_id, qt_id, version))
+    return [(int(row[0]), str(row[1])) for row in ret or []]
 
 
 def get_qt_num_variations(qt_id, version=1000000000):
@@ -746,6 +1340,12 @@ def get_qt_num_variations(qt_id, version=1000000000):
     assert isinstance(version, int)
     if version == 1000000000:
         version = get_qt_version(qt_id)
+    key = "qtemplate-%d-numvariations-%d" % (qt_id, version)
+    cache = not getattr(_local, "tx", None)
+    if cache:
+        obj = MC.get(key)
+        if obj is not None:
+            return obj
     ret = run_sql("""SELECT MAX(variation) FROM qtvariations
                         WHERE qtemplate=%s AND version = (
                          SELECT MAX(version) FROM qtvariations
@@ -757,11 +1357,16 @@ def get_qt_num_variations(qt_id, version=1000000000):
         L.warn("No Variation found for qtid=%d, version=%d: %s" %
             (qt_id, version, err))
         return 0
+    if cache:
+        MC.set(key, num, 600)
     return num
 
 
 def create_q_att(qt_id, variation, name, mimetype, data, version):
-    """ Create a new Question Attachment using given data."""
+    """ Create a new Question Attachment using given data. If the variation
+        already has one of that name (eg. another student's request made it
+        first) it's left alone.
+    """
     assert isinstance(qt_id, int)
     assert isinstance(variation, int)
     assert isinstance(name, str) or isinstance(name, unicode)
@@ -772,9 +1377,80 @@ def create_q_att(qt_id, variation, name, mimetype, data, version):
         L.warn("Refusing to create empty attachment for question %s" % qt_id)
         return
     safe_data = psycopg2.Binary(data)
-    run_sql("""INSERT INTO qattach (qtemplate, variation, mimetype, name, data, version)
-               VALUES (%s, %s, %s, %s, %s, %s);""",
-               (qt_id, variation, mimetype, name, safe_data, version))
+    with transaction():
+        # Held until we commit, so anyone generating the same variation
+        # waits here and then sees ours.
+        run_sql("SELECT pg_advisory_xact_lock(%s, %s);", (qt_id, variation))
+        run_sql("""INSERT INTO qattach (qtemplate, variation, mimetype, name, data, version)
+                   SELECT %s, %s, %s, %s, %s, %s
+                   WHERE NOT EXISTS (SELECT 1
+                                     FROM qattach
+                                     WHERE qtemplate=%s
+                                       AND variation=%s
+                                       AND version=%s
+                                       AND name=%s);""",
+                (qt_id, variation, mimetype, name, safe_data, version,
+                 qt_id, variation, version, name))
+    att_created("questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version))
+
+
+def create_q_atts(qt_id, version, atts):
+    """ Add many question attachments to the question template version in
+        one go. atts is a list of (variation, name, mimetype, data)
+        Attachments the variation already has are skipped, as are variations
+        someone else is generating right now (see create_q_att).
+        Returns the number added.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    if not atts:
+        return 0
+    variations = sorted(set([att[0] for att in atts]))
+    with transaction():
+        ret = run_sql("""SELECT var
+                         FROM unnest(%s) AS var
+                         WHERE pg_try_advisory_xact_lock(%s, var);""",
+                      (variations, qt_id))
+        locked = set([int(row[0]) for row in ret or []])
+        ret = run_sql("""SELECT variation, name
+                         FROM qattach
+                         WHERE qtemplate=%s
+                           AND version=%s
+                           AND variation = ANY(%s);""",
+                      (qt_id, version, sorted(locked)))
+        have = set([(int(row[0]), row[1]) for row in ret or []])
+        atts = [att for att in atts
+                if att[0] in locked and (att[0], att[1]) not in have]
+        rows = [(qt_id, variation, mimetype, name, psycopg2.Binary(data),
+                 version)
+                for variation, name, mimetype, data in atts]
+        num = 0
+        if rows:
+            num = copy_rows("qattach",
+                            ("qtemplate", "variation", "mimetype", "name",
+                             "data", "version"),
+                            rows)
+    keys = ["questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version)
+            for variation, name, _, _ in atts]
+    MC.delete_multi([_missing_key(key) for key in keys])
+    for key in keys:
+        fileCache.clear_missing(key)
+    return num
+
+
+def get_q_att_variations(qt_id, name, version):
+    """ Return the set of variations of the question template version that
+        have the named question attachment generated already.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(name, str) or isinstance(name, unicode)
+    assert isinstance(version, int)
+    ret = run_sql("""SELECT DISTINCT variation
+                     FROM qattach
+                     WHERE qtemplate=%s
+                       AND name=%s
+                       AND version=%s;""", (qt_id, name, version))
+    return set([int(row[0]) for row in ret or []])
 
 
 def create_qt_att(qt_id, name, mime_type, data, version):
@@ -784,8 +1460,6 @@ def create_qt_att(qt_id, name, mime_type, data, version):
     assert isinstance(mime_type, str) or isinstance(mime_type, unicode)
     assert isinstance(data, str) or isinstance(data, unicode)
     assert isinstance(version, int)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
-    MC.delete(key)
     if not data:
         data = ""
     if isinstance(data, unicode):
@@ -794,14 +1468,18 @@ def create_qt_att(qt_id, name, mime_type, data, version):
     run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, data, version)
                VALUES (%s, %s, %s, %s, %s);""",
             (qt_id, mime_type, name, safe_data, version))
+    att_created(_qt_att_key(qt_id, name, version))
+    bump_generation("qtemplate", qt_id)
     return None
 
 
 def create_q(qt_id, name, student, status, variation, version, exam):
-    """ Add a question (instance) to the database."""
+    """ Add a question (instance) to the database. student is None for
+        one that isn't given to anyone yet, see claim_pooled_q.
+    """
     assert isinstance(qt_id, int)
     assert isinstance(name, str) or isinstance(name, unicode)
-    assert isinstance(student, int)
+    assert isinstance(student, int) or student is None
     assert isinstance(status, int)
     assert isinstance(variation, int)
     assert isinstance(version, int)
@@ -810,21 +1488,104 @@ def create_q(qt_id, name, student, status, variation, version, exam):
                                  VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING question;""",
                   (qt_id, name, student, status, variation, version, exam))
     if not res:
-        L.error("CreateQuestion(%d, %s, %d, %s, %d, %d, %d) may have failed." % (
+        L.error("CreateQuestion(%d, %s, %s, %s, %d, %d, %d) may have failed." % (
                 qt_id, name, student, status, variation, version, exam))
         return None
     return res[0][0]
 
 
+def count_pooled_qs(qt_id, version):
+    """ How many question instances of the qtemplate version are waiting in
+        the pool (status 0, not given to anyone yet).
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    ret = run_sql("""SELECT COUNT(*)
+                     FROM questions
+                     WHERE qtemplate=%s
+                       AND version=%s
+                       AND status=0
+                       AND student IS NULL;""", (qt_id, version))
+    if ret:
+        return int(ret[0][0])
+    return 0
+
+
+SERVER_VERSION = None
+
+
+def get_server_version():
+    """ The version of the (primary) database server, as a number like
+        90500 for 9.5.0
+    """
+    global SERVER_VERSION
+    if SERVER_VERSION is None:
+        ret = run_sql("SHOW server_version_num;")
+        SERVER_VERSION = int(ret[0][0])
+    return SERVER_VERSION
+
+
+def claim_pooled_q(qt_id, version, student):
+    """ Give one of the pooled instances of the qtemplate version to the
+        student, as a practice question. Returns its id, or False if there
+        are none left.
+
+        Done as one UPDATE, and the status is checked again as part of it,
+        so if two requests pick the same instance at once only one gets it.
+        On PostgreSQL 9.5 and later the instance is picked with SKIP LOCKED,
+        so they each get a different one rather than queueing up behind the
+        same row. Before that, the loser tries again.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    assert isinstance(student, int)
+    skip_locked = ""
+    if get_server_version() >= 90500:
+        skip_locked = "FOR UPDATE SKIP LOCKED"
+    for _ in range(3):
+        ret = run_sql("""UPDATE questions
+                         SET student=%%s, status=1
+                         WHERE question=(SELECT question
+                                         FROM questions
+                                         WHERE qtemplate=%%s
+                                           AND version=%%s
+                                           AND status=0
+                                           AND student IS NULL
+                                         ORDER BY question
+                                         LIMIT 1
+                                         %s)
+                           AND status=0
+                           AND student IS NULL
+                         RETURNING question;""" % skip_locked,
+                      (student, qt_id, version))
+        if ret:
+            return int(ret[0][0])
+        if skip_locked or not count_pooled_qs(qt_id, version):
+            break
+    return False
+
+
+def delete_stale_pooled_qs(qt_id, version):
+    """ Remove pooled instances of the qtemplate that aren't of the given
+        (current) version, they'll never be used.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    run_sql("""DELETE FROM questions
+               WHERE qtemplate=%s
+                 AND version<>%s
+                 AND status=0
+                 AND student IS NULL;""", (qt_id, version))
+
+
 def update_qt_title(qt_id, title):
     """ Update the title of a question template. """
     assert isinstance(qt_id, int)
     assert isinstance(title, str) or isinstance(title, unicode)
-    key = "qtemplate-%d-name" % qt_id
-    MC.delete(key)
     sql = "UPDATE qtemplates SET title = %s WHERE qtemplate = %s;"
     params = (title, qt_id)
     run_sql(sql, params)
+    bump_generation("qtemplate", qt_id)
 
 
 def update_qt_owner(qt_id, owner):
@@ -833,22 +1594,20 @@ def update_qt_owner(qt_id, owner):
     """
     assert isinstance(qt_id, int)
     assert isinstance(owner, int)
-    key = "qtemplate-%d-owner" % qt_id
-    MC.delete(key)
     sql = "UPDATE qtemplates SET owner = %s WHERE qtemplate = %s;"
     params = (owner, qt_id)
     run_sql(sql, params)
+    bump_generation("qtemplate", qt_id)
 
 
 def update_qt_maxscore(qt_id, scoremax):
     """ Update the maximum score of a question template. """
     assert isinstance(qt_id, int)
     assert isinstance(scoremax, float) or scoremax is None
-    key = "qtemplate-%d-maxscore" % qt_id
-    MC.delete(key)
     sql = """UPDATE qtemplates SET scoremax=%s WHERE qtemplate=%s;"""
     params = (scoremax, qt_id)
     run_sql(sql, params)
+    bump_generation("qtemplate", qt_id)
 
 
 def update_qt_marker(qt_id, marker):
@@ -869,6 +1628,7 @@ def update_exam_qt_in_pos(exam_id, position, qts):
     assert isinstance(exam_id, int)
     assert isinstance(position, int)
     assert isinstance(qts, list)
+    bump_generation("exam", exam_id)
     # First remove the current set
     run_sql("DELETE FROM examqtemplates "
             "WHERE exam=%s "
@@ -889,14 +1649,7 @@ def update_qt_pos(qt_id, topic_id, position):
     assert isinstance(position, int)
     assert isinstance(topic_id, int)
     previous = get_qtemplate_topic_pos(qt_id, topic_id)
-    key = "topic-%d-qtemplates-position-%d" % (topic_id, qt_id)
-    MC.delete(key)
-    key = "topic-%d-qtemplate-%d-position" % (topic_id, qt_id)
-    MC.delete(key)
-    key = "topic-%d-numquestions" % topic_id
-    MC.delete(key)
-    key = "topic-%d-qtemplates" % topic_id
-    MC.delete(key)
+    bump_generation("topic", topic_id)
     sql = """UPDATE questiontopics
              SET position=%s
              WHERE topic=%s
@@ -912,25 +1665,14 @@ def move_qt_to_topic(qt_id, topic_id):
     """ Move a question template to a different sub category."""
     assert isinstance(qt_id, int)
     assert isinstance(topic_id, int)
-    key = "topic-%d-numquestions" % topic_id
-    MC.delete(key)
-    key = "topic-%d-qtemplates-position-%d" % (topic_id, qt_id)
-    MC.delete(key)
-    key = "topic-%d-qtemplates" % topic_id
-    MC.delete(key)
+    bump_generation("topic", topic_id)
 
     sql = "SELECT topic FROM questiontopics WHERE qtemplate=%s"
     params = (qt_id,)
     ret = run_sql(sql, params)
     if ret:
         for row in ret:
-            fromtopic = int(row[0])
-            key = "topic-%d-numquestions" % fromtopic
-            MC.delete(key)
-            key = "topic-%d-qtemplates" % fromtopic
-            MC.delete(key)
-            key = "topic-%d-qtemplate-%d-position" % (fromtopic, qt_id)
-            MC.delete(key)
+            bump_generation("topic", int(row[0]))
     run_sql("""UPDATE questiontopics
          SET topic=%s WHERE qtemplate=%s;""", (topic_id, qt_id))
 
@@ -942,12 +1684,7 @@ def add_qt_to_topic(qt_id, topic_id, position=0):
     assert isinstance(position, int)
     run_sql("INSERT INTO questiontopics (qtemplate, topic, position) "
             "VALUES (%s, %s, %s)", (qt_id, topic_id, position))
-    key = "topic-%d-numquestions" % topic_id
-    MC.delete(key)
-    key = "topic-%d-qtemplates-position-%d" % (topic_id, position)
-    MC.delete(key)
-    key = "topic-%d-qtemplates" % topic_id
-    MC.delete(key)
+    bump_generation("topic", topic_id)
 
 
 def copy_qt_all(qt_id):
@@ -955,26 +1692,23 @@ def copy_qt_all(qt_id):
         including all attachments.
     """
     assert isinstance(qt_id, int)
-    newid = copy_qt(qt_id)
-    if newid <= 0:
-        return 0
-    attachments = get_qt_atts(qt_id)
-    newversion = get_qt_version(newid)
-    for name in attachments:
-        create_qt_att(newid,
-                      name,
-                      get_qt_att_mimetype(qt_id, name),
-                      get_qt_att(qt_id, name),
-                      newversion)
-    try:
-        variations = get_qt_variations(qt_id)
-        for variation in variations.keys():
-            add_qt_variation(newid,
-                             variation,
-                             variations[variation],
-                             newversion)
-    except AttributeError as err:
-        L.warn("Copying a qtemplate %s with no variations. '%s'" % (qt_id, err))
+    with transaction():
+        newid = copy_qt(qt_id)
+        if newid <= 0:
+            return 0
+        attachments = get_qt_atts(qt_id)
+        newversion = get_qt_version(newid)
+        for name in attachments:
+            create_qt_att(newid,
+                          name,
+                          get_qt_att_mimetype(qt_id, name),
+                          get_qt_att(qt_id, name),
+                          newversion)
+        try:
+            variations = get_qt_variations(qt_id)
+            add_qt_variations(newid, variations, newversion)
+        except AttributeError as err:
+            L.warn("Copying a qtemplate %s with no variations. '%s'" % (qt_id, err))
     return newid
 
 
@@ -1010,11 +1744,27 @@ def add_qt_variation(qt_id, variation, data, version):
     assert isinstance(version, int)
     pick = cPickle.dumps(data)
     safe_data = psycopg2.Binary(pick)
+    _variations_written()
     run_sql("INSERT INTO qtvariations (qtemplate, variation, data, version) "
             "VALUES (%s, %s, %s, %s)",
             (qt_id, variation, safe_data, version))
 
 
+def add_qt_variations(qt_id, variations, version):
+    """ Add many variations to the question template in one go.
+        variations is a dictionary of {variation number: data}
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    rows = ((qt_id, int(variation), psycopg2.Binary(cPickle.dumps(data)), version)
+            for variation, data in variations.iteritems())
+    _variations_written()
+    num = copy_rows("qtvariations",
+                    ("qtemplate", "variation", "data", "version"),
+                    rows)
+    L.info("Added %d variations to qtemplate %s version %s" % (num, qt_id, version))
+
+
 def create_qt(owner, title, desc, marker, score_max, status):
     """ Create a new Question Template. """
     assert isinstance(owner, int)
@@ -1033,31 +1783,6 @@ def create_qt(owner, title, desc, marker, score_max, status):
     L.error("create_qt error (%d, %s, %s, %d, %s, %s)" % (owner, title, desc, marker, score_max, status))
 
 
-def _serialize_courseexaminfo(info):
-    """ Serialize the structure for, eg. cache.
-        The dates, especially, need work before JSON
-    """
-    fmt = '%Y-%m-%d %H:%M:%S'
-    safe = {}
-    for k, exam in info.iteritems():
-        safe[k] = exam
-        safe[k]['start'] = exam['start'].strftime(fmt)
-        safe[k]['end'] = exam['end'].strftime(fmt)
-    return json.dumps(safe)
-
-
-def _deserialize_courseexaminfo(obj):
-    """ Deserialize a serialized exam info structure."""
-    fmt = '%Y-%m-%d %H:%M:%S'
-    safe = json.loads(obj)
-    info = {}
-    for k, exam in safe.iteritems():
-        info[k] = exam
-        info[k]['start'] = datetime.datetime.strptime(exam['start'], fmt)
-        info[k]['end'] = datetime.datetime.strptime(exam['end'], fmt)
-    return info
-
-
 def get_course_exam_all(course_id, prev_years=False):
     """ Return a summary of information about all current exams in the course
         {id, course, name, description, start, duration, end, type}
@@ -1065,14 +1790,7 @@ def get_course_exam_all(course_id, prev_years=False):
     assert isinstance(course_id, int)
     assert isinstance(prev_years, bool)
     if prev_years:
-        key = "course-exam-all-%s-prevyears" % course_id
-    else:
-        key = "course-exam-all-%s" % course_id
-    obj = MC.get(key)
-    if obj:
-        return _deserialize_courseexaminfo(obj)
-
-    if prev_years:
+        key = gen_key("course", course_id, "examall-prevyears")
         sql = """SELECT exam, course, title, "type", "start", "end",
                     description, duration, to_char("start", 'DD Mon'),
                     to_char("start", 'hh:mm'), to_char("end", 'DD Mon'),
@@ -1081,6 +1799,7 @@ def get_course_exam_all(course_id, prev_years=False):
                  WHERE course='%s' AND archived='0'
                  ORDER BY "start";"""
     else:
+        key = gen_key("course", course_id, "examall")
         sql = """SELECT exam, course, title, "type", "start", "end",
                     description, duration, to_char("start", 'DD Mon'),
                     to_char("start", 'hh:mm'), to_char("end", 'DD Mon'),
@@ -1090,20 +1809,23 @@ def get_course_exam_all(course_id, prev_years=False):
                  AND archived='0'
                  AND extract('year' from "end") = extract('year' from now())
                  ORDER BY "start";"""
-    params = (course_id,)
-    ret = run_sql(sql, params)
-    info = {}
-    if ret:
-        for row in ret:
-            info[int(row[0])] = {'id': row[0], 'course': row[1], 'name': row[2],
-                                 'type': row[3], 'start': row[4], 'end': row[5],
-                                 'description': row[6], 'duration': row[7],
-                                 'startdate': row[8], 'starttime': row[9],
-                                 'enddate': row[10], 'endtime': row[11]}
-    # 60 second cache. take the edge off an exam start peak load
-    MC.set(key, _serialize_courseexaminfo(info), 60)
 
-    return info
+    def load():
+        """ Fetch the exams from the database """
+        params = (course_id,)
+        ret = run_sql(sql, params)
+        info = {}
+        if ret:
+            for row in ret:
+                info[int(row[0])] = {'id': row[0], 'course': row[1], 'name': row[2],
+                                     'type': row[3], 'start': row[4], 'end': row[5],
+                                     'description': row[6], 'duration': row[7],
+                                     'startdate': row[8], 'starttime': row[9],
+                                     'enddate': row[10], 'endtime': row[11]}
+        return info
+
+    # 60 second cache. take the edge off an exam start peak load
+    return MC.get_or_compute(key, load, 60)
 
 
 def add_exam_q(user, exam, question, position):
@@ -1262,7 +1984,7 @@ def get_q_stats_class(course, qt_id):
              );
           """
     params = (qt_id, course)
-    ret = run_sql(sql, params)
+    ret = run_sql(sql, params, readonly=True)
     if ret:
         i = ret[0]
         if i[1]:
@@ -1390,7 +2112,7 @@ def get_db_size():
              LIMIT 10;
     """
 
-    ret = run_sql(sql)
+    ret = run_sql(sql, readonly=True)
     sizes = []
     for row in ret:
         sizes.append([row[0], row[1]])
@@ -36,15 +36,16 @@ def mark_q(user_id, qtid, request):
 
     out = u""
     answers = {}
-    for i in request.form.keys():
-        part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
-        if part:
-            newqid = int(part.groups()[0])
-            part = int(part.groups()[1])
-
-            value = request.form[i]
-            answers["G%d" % part] = value
-            DB.save_guess(newqid, part, value)
+    with DB.transaction():  # save all the guesses together
+        for i in request.form.keys():
+            part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
+            if part:
+                newqid = int(part.groups()[0])
+                part = int(part.groups()[1])
+
+                value = request.form[i]
+                answers["G%d" % part] = value
+                DB.save_guess(newqid, part, value)
 
     if qid:
         try:
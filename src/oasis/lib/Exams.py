@@ -8,10 +8,9 @@
 """
 
 import time
-import json
 import datetime
 
-from .DB import run_sql, MC
+from .DB import run_sql, MC, gen_key, get_generations, bump_generation
 from .OaTypes import todatetime
 import Courses2
 from .Permissions import check_perm
@@ -36,12 +35,23 @@ def save_score(exam_id, student, examtotal):
     touchuserexam(exam_id, student)
 
 
+def _changed(exam_id):
+    """ Throw away what's cached about the exam, and about its course,
+        which includes a summary of its exams.
+    """
+    bump_generation("exam", exam_id)
+    ret = run_sql("""SELECT course FROM exams WHERE exam=%s;""", (exam_id,))
+    if ret:
+        bump_generation("course", int(ret[0][0]))
+
+
 def set_duration(exam_id, duration):
     """ Set the duration of an assessment."""
     assert isinstance(exam_id, int)
     assert isinstance(duration, int) or isinstance(duration, float)
     run_sql("""UPDATE exams SET duration=%s WHERE exam=%s;""",
             (duration, exam_id))
+    _changed(exam_id)
 
 
 def set_instant(exam_id, instant):
@@ -50,6 +60,7 @@ def set_instant(exam_id, instant):
     assert isinstance(instant, int)
     run_sql("""UPDATE exams SET instant=%s WHERE exam=%s;""",
             (instant, exam_id))
+    _changed(exam_id)
 
 
 def get_student_start_time(exam, student):
@@ -91,6 +102,7 @@ def set_type(exam, examtype):
     assert isinstance(exam, int)
     assert isinstance(examtype, int)
     run_sql("""UPDATE exams SET "type"=%s WHERE exam=%s;""", (examtype, exam,))
+    _changed(exam)
 
 
 def set_title(exam, title):
@@ -98,6 +110,7 @@ def set_title(exam, title):
     assert isinstance(exam, int)
     assert isinstance(title, str) or isinstance(title, unicode)
     run_sql("""UPDATE exams SET title=%s WHERE exam=%s;""", (title, exam))
+    _changed(exam)
 
 
 def set_code(exam, code):
@@ -105,6 +118,7 @@ def set_code(exam, code):
     assert isinstance(exam, int)
     assert isinstance(code, str) or isinstance(code, unicode)
     run_sql("""UPDATE exams SET code=%s WHERE exam=%s;""", (code, exam))
+    _changed(exam)
 
 
 def get_submit_time(exam_id, student):
@@ -212,6 +226,7 @@ def create(course, owner, title, examtype, duration, start, end,
               course, duration, code, instant)
     L.info("Create Exam on course %s: [%s][%s]" % (course, sql, params))
     res = run_sql(sql, params)
+    bump_generation("course", course)
     if res:
         return int(res[0][0])
     L.error("Create exam FAILED on course %s: [%s][%s]" % (course, sql, params))
@@ -224,6 +239,7 @@ def set_description(exam_id, description):
     assert isinstance(description, str) or isinstance(description, unicode)
     run_sql("""UPDATE exams SET description=%s WHERE exam=%s;""",
             (description, exam_id))
+    _changed(exam_id)
 
 
 def get_end_time(exam, user):
@@ -246,18 +262,16 @@ def set_end_time(exam, examend):
     """ Set the end time of an assessment. """
     assert isinstance(exam, int)
     assert isinstance(examend, datetime.datetime) or isinstance(examend, str) or isinstance(examend, unicode)
-    key = "exams-%d-endepoch" % exam
-    MC.delete(key)
     run_sql("""UPDATE exams SET "end"=%s WHERE exam=%s;""", (examend, exam))
+    _changed(exam)
 
 
 def set_start_time(exam, examstart):
     """ Set the start time of an assessment."""
     assert isinstance(exam, int)
     assert isinstance(examstart, datetime.datetime) or isinstance(examstart, str) or isinstance(examstart, unicode)
-    key = "exams-%d-startepoch" % exam
-    MC.delete(key)
     run_sql("""UPDATE exams SET "start"=%s WHERE exam=%s;""", (examstart, exam))
+    _changed(exam)
 
 
 def get_num_questions(exam_id):
@@ -416,33 +430,59 @@ def set_mark_status(exam, status):
     assert isinstance(exam, int)
     assert isinstance(status, int)
     run_sql("""UPDATE exams SET markstatus=%s WHERE exam=%s;""", (status, exam))
+    _changed(exam)
+
+
+_EXAM_COLUMNS = """ "title", "owner", "type", "start", "end",
+                    "description", "comments", "course", "archived",
+                    "duration", "markstatus", "instant", "code" """
 
 
-def _serialize_examstruct(exam):
-    """ Serialize the exam structure for, eg. cache.
-        The dates, especially, need work before JSON
+def _exam_from_row(exam_id, row):
+    """ The basic (cacheable) exam structure from a database row of
+        _EXAM_COLUMNS
     """
-    assert isinstance(exam, dict)
-    date_fmt = '%Y-%m-%d %H:%M:%S'
-    assert isinstance(exam['start'], datetime.datetime)
-    assert isinstance(exam['end'], datetime.datetime)
-    safe = exam.copy()
-    safe['start'] = exam['start'].strftime(date_fmt)
-    safe['end'] = exam['end'].strftime(date_fmt)
-
-    return json.dumps(safe)
-
-
-def _deserialize_examstruct(obj):
-    """ Deserialize a serialized exam structure. """
-    assert isinstance(obj, str) or isinstance(obj, unicode)
-    date_fmt = '%Y-%m-%d %H:%M:%S'
-    exam = json.loads(obj)
-    exam['start'] = datetime.datetime.strptime(exam['start'], date_fmt)
-    exam['end'] = datetime.datetime.strptime(exam['end'], date_fmt)
-
-    assert isinstance(exam['start'], datetime.datetime)
-    assert isinstance(exam['end'], datetime.datetime)
+    return {'id': exam_id,
+            'title': row[0],
+            'owner': row[1],
+            'type': row[2],
+            'start': row[3],
+            'end': row[4],
+            'instructions': row[5],
+            'comments': row[6],
+            'cid': row[7],
+            'archived': row[8],
+            'duration': row[9],
+            'markstatus': row[10],
+            'instant': row[11],
+            'code': row[12]
+            }
+
+
+def _add_exam_details(exam, user_id, include_qtemplates, include_stats):
+    """ Fill in the rest of the exam structure, the parts that depend on
+        the time, user, etc.
+    """
+    course = Courses2.get_course(exam['cid'])
+    exam['future'] = General.is_future(exam['start'])
+    exam['past'] = General.is_past(exam['end'])
+    exam['soon'] = General.is_soon(exam['start'])
+    exam['recent'] = General.is_recent(exam['end'])
+    exam['active'] = General.is_now(exam['start'], exam['end'])
+    exam['start_epoch'] = int(exam['start'].strftime("%s"))  # used to sort
+    exam['period'] = General.human_dates(exam['start'], exam['end'])
+    exam['course'] = course
+    exam['start_human'] = exam['start'].strftime("%a %d %b")
+
+    if include_qtemplates:
+        exam['qtemplates'] = get_qts(exam['id'])
+        exam['num_questions'] = len(exam['qtemplates'])
+    if include_stats:
+        exam['coursedone'] = get_num_done(exam['id'], exam['cid'])
+        exam['notcoursedone'] = get_num_done(exam['id']), exam['coursedone']
+    if user_id:
+        exam['is_done'] = is_done_by(user_id, exam['id'])
+        exam['can_preview'] = check_perm(user_id, exam['cid'], "exampreview")
     return exam
 
 
@@ -457,60 +497,57 @@ def get_exam_struct(exam_id, user_id=None, include_qtemplates=False,
         or user_id is None
     assert isinstance(include_qtemplates, bool)
     assert isinstance(include_stats, bool)
-    key = "exam-%s-struct" % exam_id
-    obj = MC.get(key)
-    if obj:
-        exam = _deserialize_examstruct(obj)
-    else:
-        sql = """SELECT "title", "owner", "type", "start", "end",
-                        "description", "comments", "course", "archived",
-                        "duration", "markstatus", "instant", "code"
-                 FROM "exams" WHERE "exam" = %s LIMIT 1;"""
+    key = gen_key("exam", exam_id, "struct")
+
+    def load():
+        """ Fetch the exam from the database """
+        sql = """SELECT %s FROM "exams" WHERE "exam" = %%s LIMIT 1;""" % \
+            _EXAM_COLUMNS
         params = (exam_id, )
+        # not from a replica, it may not have seen the change that
+        # bumped the generation yet
         ret = run_sql(sql, params)
         if not ret:
             raise KeyError("Exam %s not found." % exam_id)
-        row = ret[0]
-        exam = {'id': exam_id,
-                'title': row[0],
-                'owner': row[1],
-                'type': row[2],
-                'start': row[3],
-                'end': row[4],
-                'instructions': row[5],
-                'comments': row[6],
-                'cid': row[7],
-                'archived': row[8],
-                'duration': row[9],
-                'markstatus': row[10],
-                'instant': row[11],
-                'code': row[12]
-                }
-
-        MC.set(key, _serialize_examstruct(exam),
-               60)  # 60 second cache. to take the edge off exam start peak load
-    course = Courses2.get_course(exam['cid'])
-    exam['future'] = General.is_future(exam['start'])
-    exam['past'] = General.is_past(exam['end'])
-    exam['soon'] = General.is_soon(exam['start'])
-    exam['recent'] = General.is_recent(exam['end'])
-    exam['active'] = General.is_now(exam['start'], exam['end'])
-    exam['start_epoch'] = int(exam['start'].strftime("%s"))  # used to sort
-    exam['period'] = General.human_dates(exam['start'], exam['end'])
-    exam['course'] = course
-    exam['start_human'] = exam['start'].strftime("%a %d %b")
+        return _exam_from_row(exam_id, ret[0])
 
-    if include_qtemplates:
-        exam['qtemplates'] = get_qts(exam_id)
-        exam['num_questions'] = len(exam['qtemplates'])
-    if include_stats:
-        exam['coursedone'] = get_num_done(exam_id, exam['cid'])
-        exam['notcoursedone'] = get_num_done(exam_id), exam['coursedone']
-    if user_id:
-        exam['is_done'] = is_done_by(user_id, exam_id)
-        exam['can_preview'] = check_perm(user_id, exam['cid'], "exampreview")
+    # 60 second cache. to take the edge off exam start peak load
+    exam = MC.get_or_compute(key, load, 60)
+    return _add_exam_details(exam, user_id, include_qtemplates, include_stats)
 
-    return exam
+
+def get_exam_structs(exam_ids, user_id=None, include_qtemplates=False,
+                     include_stats=False):
+    """ Like get_exam_struct, but for a list of exams at once. Returns a list
+        of exam structures in the same order. Exams that can't be found are
+        left out.
+    """
+    assert isinstance(user_id, int) \
+        or user_id is None
+    assert isinstance(include_qtemplates, bool)
+    assert isinstance(include_stats, bool)
+    gens = get_generations("exam", exam_ids)
+    keys = dict([(gen_key("exam", exam_id, "struct", gens[exam_id]), exam_id)
+                 for exam_id in exam_ids])
+    exams = {}
+    for key, obj in MC.get_computed_multi(keys.keys()).iteritems():
+        exams[keys[key]] = obj
+    missing = [exam_id for exam_id in exam_ids if exam_id not in exams]
+    if missing:
+        sql = """SELECT "exam", %s FROM "exams" WHERE "exam" IN %%s;""" % \
+            _EXAM_COLUMNS
+        params = (tuple(missing), )
+        found = {}
+        for row in run_sql(sql, params) or []:
+            row_id = int(row[0])
+            exams[row_id] = _exam_from_row(row_id, row[1:])
+            found[gen_key("exam", row_id, "struct", gens[row_id])] = \
+                exams[row_id]
+        MC.set_computed_multi(found, 60)
+    return [_add_exam_details(exams[exam_id], user_id,
+                              include_qtemplates, include_stats)
+            for exam_id in exam_ids
+            if exam_id in exams]
 
 
 def get_marks(group, exam_id):
@@ -527,9 +564,8 @@ def get_marks(group, exam_id):
           AND q.exam = %s;
     """
     params = (group.id, exam_id)
-    ret = DB.run_sql(sql, params)
     results = {}
-    for row in ret:
+    for row in DB.iter_sql(sql, params, readonly=True):
         user_id = row[0]
         if user_id not in results:
             results[user_id] = {}
@@ -6,7 +6,8 @@
     (except to OASIS database or memcache servers) should come through here.
 """
 
-from oasis.lib import OaConfig, Groups, Feeds, DB, Users2, UFeeds, Users, Topics, QEditor
+from oasis.lib import OaConfig, Groups, Feeds, DB, Users2, UFeeds, Users, Topics, QEditor, \
+    Materialize
 import os
 import subprocess
 import tempfile
@@ -109,6 +110,7 @@ def group_update_from_feed(group_id, refresh_users=False):
     removed = []
     added = []
     unknown = []
+    add_uids = []
     old_members = group.member_unames()
     new_members = output.split()[1:]
     for uname in new_members:
@@ -119,8 +121,9 @@ def group_update_from_feed(group_id, refresh_users=False):
             unknown.append(uname)
             continue
         if uname not in old_members:
-            group.add_member(uid)
+            add_uids.append(uid)
             added.append(uname)
+    group.add_members(add_uids)
 
     for uname in old_members:
         if uname not in new_members:
@@ -354,8 +357,8 @@ def import_qts_from_zip(data, topicid):
                 if att_name == "datfile.txt" or att_name == "datfile.dat" or att_name == "datfile" or att_name == "_datfile" or att_name == "__datfile":
                     qvars = QEditor.parse_datfile(data)
                     print "generating variations..."
-                    for row in range(0, len(qvars)):
-                        DB.add_qt_variation(newid, row + 1, qvars[row], 1)
+                    DB.add_qt_variations(newid, dict(enumerate(qvars, 1)), 1)
+            Materialize.start(newid, DB.get_qt_version(newid))
 
     Topics.flush_num_qs(topicid)
     return 0
@@ -9,25 +9,33 @@
     Functions needed by several of the Oasis views
 """
 
-from PIL import Image, ImageDraw, ImageFont
 import re
 import random
-from StringIO import StringIO
 import math
 import sys
 import traceback
 import datetime
 import time
+import threading
 import jinja2
+from collections import OrderedDict
 
 from oasis.lib.OaExceptions import OaMarkerError
 from . import Courses, Exams
-from oasis.lib import OaConfig, DB, Topics, script_funcs, OqeSmartmarkFuncs, Audit
+from oasis.lib import OaConfig, DB, Topics, script_funcs, OqeSmartmarkFuncs, Audit, \
+    QImage
 from logging import getLogger
 
 
 L = getLogger("oasisqe")
 
+# How many compiled qtemplate.html and question variation HTML to keep in
+# memory, see get_compiled_q_html and get_compiled_q_display
+COMPILED_SIZE = 1000
+
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
+
 
 def htmlesc(text):
     """ HTML escape the text. """
@@ -178,66 +186,75 @@ def gen_q(qtid, student=0, exam=0, position=0):
     return q_id
 
 
-def gen_q_from_var(qt_id, student, exam, position, version, variation):
+def gen_q_from_var(qt_id, student, exam, position, version, variation,
+                   status=1):
     """ Generate a question given a specific variation. """
     qvars = None
-    q_id = DB.create_q(qt_id,
-                       DB.get_qt_name(qt_id),
-                       student,
-                       1,
-                       variation,
-                       version,
-                       exam)
-    try:
-        q_id = int(q_id)
-        assert (q_id > 0)
-    except (ValueError, TypeError, AssertionError):
-        L.error("OaDB.createQuestion(%s,...) FAILED" % qt_id)
-    imageexists = DB.get_q_att_mimetype(qt_id, "image.gif", variation, version)
-    if not imageexists:
-        if not qvars:
-            qvars = DB.get_qt_variation(qt_id, variation, version)
-        qvars['Oasis_qid'] = q_id
-        image = DB.get_qt_att(qt_id, "image.gif", version)
-        if image:
-            newimage = gen_q_image(qvars, image)
-            DB.create_q_att(qt_id,
-                            variation,
-                            "image.gif",
-                            "image/gif",
-                            newimage,
-                            version)
-    htmlexists = DB.get_q_att_mimetype(qt_id,
-                                       "qtemplate.html",
-                                       variation,
-                                       version)
-    if not htmlexists:
-        if not qvars:
-            qvars = DB.get_qt_variation(qt_id, variation, version)
-        html = DB.get_qt_att(qt_id, "qtemplate.html", version)
-        if html:
+    with DB.transaction():
+        q_id = DB.create_q(qt_id,
+                           DB.get_qt_name(qt_id),
+                           student,
+                           status,
+                           variation,
+                           version,
+                           exam)
+        try:
+            q_id = int(q_id)
+            assert (q_id > 0)
+        except (ValueError, TypeError, AssertionError):
+            L.error("OaDB.createQuestion(%s,...) FAILED" % qt_id)
+        imageexists = DB.get_q_att_mimetype(qt_id, "image.gif", variation, version)
+        if not imageexists:
+            if not qvars:
+                qvars = DB.get_qt_variation(qt_id, variation, version)
             qvars['Oasis_qid'] = q_id
-            newhtml = gen_q_html(qvars, html)
-            L.info("generating new qattach qtemplate.html for %s" % q_id)
-            DB.create_q_att(qt_id,
-                            variation,
-                            "qtemplate.html",
-                            "application/oasis-html",
-                            newhtml,
-                            version)
-    try:
-        q_id = int(q_id)
-        assert (q_id > 0)
-    except (ValueError, TypeError, AssertionError):
-        L.error("generateQuestionFromVar(%s,%s), can't find qid %s? " %
-                   (qt_id, student, q_id))
-    if exam >= 1:
-        DB.add_exam_q(student, exam, q_id, position)
-    return q_id
+            image = DB.get_qt_att(qt_id, "image.gif", version)
+            if image:
+                newimage = gen_q_image(qvars, image)
+                DB.create_q_att(qt_id,
+                                variation,
+                                "image.gif",
+                                QImage.mimetype(),
+                                newimage,
+                                version)
+        htmlexists = DB.get_q_att_mimetype(qt_id,
+                                           "qtemplate.html",
+                                           variation,
+                                           version)
+        if not htmlexists:
+            if not qvars:
+                qvars = DB.get_qt_variation(qt_id, variation, version)
+            compiled = get_compiled_q_html(qt_id, version)
+            if compiled:
+                qvars['Oasis_qid'] = q_id
+                newhtml = compiled.render(qvars)
+                L.info("generating new qattach qtemplate.html for %s" % q_id)
+                DB.create_q_att(qt_id,
+                                variation,
+                                "qtemplate.html",
+                                "application/oasis-html",
+                                newhtml,
+                                version)
+        try:
+            q_id = int(q_id)
+            assert (q_id > 0)
+        except (ValueError, TypeError, AssertionError):
+            L.error("generateQuestionFromVar(%s,%s), can't find qid %s? " %
+                       (qt_id, student, q_id))
+        if exam >= 1:
+            DB.add_exam_q(student, exam, q_id, position)
+        return q_id
 
 
 def gen_q_html(qvars, html):
     """ Create an instance of the HTML """
+    return compile_q_html(html).render(qvars)
+
+
+def _gen_q_html_fixed(html):
+    """ The parts of making an instance of the HTML that don't depend on
+        the variation: images and text answer boxes.
+    """
     html = html.replace("<IMG SRC>", '<IMG SRC="$IMAGES$image.gif" />')
     # replace <ANSWERn size> with the correct HTML
     rx_answern = re.compile(r'<ANSWER([0-9]+) ([0-9]+)>')
@@ -257,6 +274,15 @@ def gen_q_html(qvars, html):
                   (lambda x:
                    """<TEXTAREA class='auto_save' NAME='ANS_%s' ROWS=6 COLS=100>VAL_%s</TEXTAREA>""" %
                    (x.group(1), x.group(1))), html)
+    return html
+
+
+def _gen_q_html_passes(qvars, html):
+    """ Create an instance of the HTML the long way, a pass over it for each
+        kind of tag (and each variable). CompiledQHtml gives the same
+        result in one pass, except in odd cases where this is used instead.
+    """
+    html = _gen_q_html_fixed(html)
     # Do multiple choice
     # TODO: need to replace with regex at some point
     #  '<ANSWER(.+?)\s+(.+?)\s+(.*?)>'
@@ -291,43 +317,39 @@ def gen_q_html(qvars, html):
 
 def gen_q_image(qvars, image):
     """ Draw values onto the image provided. """
-    img = Image.open(StringIO(image)).convert("RGBA")
-    imgdraw = ImageDraw.Draw(img)
-    font = ImageFont.truetype("%s/fonts/Courier_New.ttf" % OaConfig.homedir, 14)
-    coords = [int(name[1:])
-              for name in qvars.keys()
-              if re.search("^X([0-9]+)$", name) > 0]
-    for coord in coords:
-        (xcoord, ycoord, value) = (qvars["X%d" % coord],
-                                   qvars["Y%d" % coord],
-                                   qvars["Z%d" % coord])
-        if (xcoord > -1) and (ycoord > -1):
-            value = unicode(value, "utf-8")    # convert to unicode
-            try:
-                imgdraw.text((int(xcoord), int(ycoord)), value, font=font, fill="black")
-            except UnicodeEncodeError as err:
-                L.warn(u"Unicode error generating image: %s [%s]." % (err, value))
-    data = StringIO("")
-    img.save(data, "GIF")
-    return data.getvalue()
-
+    return QImage.render(image, QImage.coords(qvars))
 
-def handle_multi_f(html, answer, qvars):
-    """ Convert MULTIF answer tags into appropriate HTML. (radio buttons)
-        Keeps the original order (doesn't shuffle the options)
 
-        Expects something like <ANSWERn MULTIF a,b,c,d,e>
+def _find_answer_tag(html, answer, kind):
+    """ Find the first <ANSWERn KIND params> tag in the html.
+        Returns (the whole tag, params) or (None, None)
     """
+    tag = "<ANSWER%d %s " % (answer, kind)
     try:
-        start = html.index("<ANSWER%d MULTIF " % answer)
+        start = html.index(tag)
     except ValueError:
         return None, None
     try:
         end = html.index(">", start) + 1
     except ValueError:
         return None, None
-    params = html[start + len("<ANSWER%d MULTIF " % answer):end - 1]
-    match = html[start:end]
+    return html[start:end], html[start + len(tag):end - 1]
+
+
+def handle_multi_f(html, answer, qvars):
+    """ Convert MULTIF answer tags into appropriate HTML. (radio buttons)
+        Keeps the original order (doesn't shuffle the options)
+
+        Expects something like <ANSWERn MULTIF a,b,c,d,e>
+    """
+    (match, params) = _find_answer_tag(html, answer, "MULTIF")
+    if not match:
+        return None, None
+    return match, multi_f_html(answer, params, qvars)
+
+
+def multi_f_html(answer, params, qvars):
+    """ The HTML for <ANSWERn MULTIF params> """
     paramlist = params.split(',')
     pout = ["", ]
     if paramlist:
@@ -345,7 +367,7 @@ def handle_multi_f(html, answer, qvars):
     ret = "<table border=0><tr><td>Please choose one:</td>"
     ret += ''.join(pout)
     ret += "</tr></table><br />\n"
-    return match, ret
+    return ret
 
 
 def handle_multi_v(html, answer, qvars):
@@ -354,16 +376,14 @@ def handle_multi_v(html, answer, qvars):
 
         Expects something like  <ANSWERn MULTIV a,b,c,d>
     """
-    try:
-        start = html.index("<ANSWER%d MULTIV " % answer)
-    except ValueError:
+    (match, params) = _find_answer_tag(html, answer, "MULTIV")
+    if not match:
         return None, None
-    try:
-        end = html.index(">", start) + 1
-    except ValueError:
-        return None, None
-    params = html[start + len("<ANSWER%d MULTIV " % answer):end - 1]
-    match = html[start:end]
+    return match, multi_v_html(answer, params, qvars)
+
+
+def multi_v_html(answer, params, qvars):
+    """ The HTML for <ANSWERn MULTIV params> """
     paramlist = params.split(',')
     pout = ["", ]
     if paramlist:
@@ -383,22 +403,20 @@ def handle_multi_v(html, answer, qvars):
     ret = "<table border=0><tr><th>Please choose one:</th></tr>"
     ret += ''.join(pout)
     ret += "</table><br />\n"
-    return match, ret
+    return ret
 
 
 def handle_multi(html, answer, qvars, shuffle=True):
     """ Convert MULTI answer tags into appropriate HTML. (radio buttons)
     """
-    try:
-        start = html.index("<ANSWER%d MULTI " % answer)
-    except ValueError:
-        return None, None
-    try:
-        end = html.index(">", start) + 1
-    except ValueError:
+    (match, params) = _find_answer_tag(html, answer, "MULTI")
+    if not match:
         return None, None
-    params = html[start + len("<ANSWER%d MULTI " % answer):end - 1]
-    match = html[start:end]
+    return match, multi_html(answer, params, qvars, shuffle)
+
+
+def multi_html(answer, params, qvars, shuffle=True):
+    """ The HTML for <ANSWERn MULTI params> """
     paramlist = params.split(',')
     pout = ["", ]
     if paramlist:
@@ -419,7 +437,7 @@ def handle_multi(html, answer, qvars, shuffle=True):
     ret = "<table border=0><tr><th>Please choose one:</th>"
     ret += ''.join(pout)
     ret += "</tr></table><br />\n"
-    return match, ret
+    return ret
 
 
 def handle_listbox(html, answer, qvars, shuffle=True):
@@ -428,16 +446,14 @@ def handle_listbox(html, answer, qvars, shuffle=True):
         We expect    <ANSWERn SELECT a,b,c,d,e>
         with 2+ parameters (a,b,c,d,...)
     """
-    try:
-        start = html.index("<ANSWER%d SELECT " % answer)
-    except ValueError:
+    (match, params) = _find_answer_tag(html, answer, "SELECT")
+    if not match:
         return None, None
-    try:
-        end = html.index(">", start) + 1
-    except ValueError:
-        return None, None
-    params = html[start + len("<ANSWER%d SELECT " % answer):end - 1]
-    match = html[start:end]
+    return match, listbox_html(answer, params, qvars, shuffle)
+
+
+def listbox_html(answer, params, qvars, shuffle=True):
+    """ The HTML for <ANSWERn SELECT params> """
     paramlist = params.split(',')
     pout = ["", ]
     if paramlist:
@@ -457,7 +473,167 @@ def handle_listbox(html, answer, qvars, shuffle=True):
     ret += """<OPTION VALUE='None'>--Choose--</OPTION>"""
     ret += ''.join(pout)
     ret += "</SELECT>\n"
-    return match, ret
+    return ret
+
+
+# The multiple choice tags, in the order _gen_q_html_passes does them.
+MULTI_TAGS = (("MULTIF", multi_f_html),
+              ("MULTI", multi_html),
+              ("MULTIV", multi_v_html),
+              ("SELECT", listbox_html))
+
+# Tags left in the HTML mean something was too odd to compile.
+_TAG_MARKS = ("<ANSWER", "<VAL ", "<IMG SRC ", "<ATT SRC ")
+
+_RE_VAR_TAG = re.compile(r"<(VAL|IMG SRC|ATT SRC) ([^<>]*)>")
+_RE_MULTI_REF = re.compile("\x00([0-9]+)\x00")
+
+(_LITERAL, _MULTI, _VAL, _IMG, _ATT) = range(5)
+
+
+class CompiledQHtml(object):
+    """ A qtemplate.html parsed once into literal text and the tags to fill
+        in for each variation, so making an instance is one pass over it
+        rather than one (or several) for each kind of tag and variable.
+
+        The result is the same as _gen_q_html_passes. In the odd cases
+        where that depends on the order it does things (eg. a variable
+        containing tags, unfinished tags, unicode variables), it's used
+        instead.
+    """
+
+    def __init__(self, html):
+
+        self.html = html
+        self.parts = None  # None if we can't compile it
+        self.multis = []
+        self.shuffled = False
+        if "\x00" in html:
+            return
+        html = _gen_q_html_fixed(html)
+        # Do the multiple choice tags the same way _gen_q_html_passes does,
+        # only the first of each, but every copy of that, marking where
+        # they go with \x00index\x00
+        for kind, func in MULTI_TAGS:
+            for answer in range(1, 49):
+                (match, params) = _find_answer_tag(html, answer, kind)
+                if not match:
+                    continue
+                if "\x00" in params:
+                    # contains one we've already done, so it would end
+                    # somewhere inside that one's HTML
+                    return
+                html = html.replace(match, "\x00%d\x00" % len(self.multis))
+                self.multis.append((func, answer, params))
+                if func in (multi_html, listbox_html):
+                    self.shuffled = True
+        parts = []
+        pieces = _RE_MULTI_REF.split(html)
+        for idx, piece in enumerate(pieces):
+            if idx % 2:
+                parts.append((_MULTI, int(piece), None))
+                continue
+            pos = 0
+            for match in _RE_VAR_TAG.finditer(piece):
+                if match.start() > pos:
+                    parts.append((_LITERAL, piece[pos:match.start()], None))
+                kind = {"VAL": _VAL,
+                        "IMG SRC": _IMG,
+                        "ATT SRC": _ATT}[match.group(1)]
+                parts.append((kind, match.group(2), match.group(0)))
+                pos = match.end()
+            if pos < len(piece):
+                parts.append((_LITERAL, piece[pos:], None))
+        for kind, text, _ in parts:
+            if kind == _LITERAL:
+                for mark in _TAG_MARKS:
+                    if mark in text:
+                        return
+        self.parts = parts
+
+    def _simple(self, qvars):
+        """ Are the variables ordinary enough to render in one pass? """
+        if self.parts is None:
+            return False
+        for name, value in qvars.iteritems():
+            if not isinstance(name, str) or "<" in name or ">" in name:
+                return False
+            if isinstance(value, (unicode, tuple)):
+                return False
+        return True
+
+    def render(self, qvars):
+        """ Create an instance of the HTML for the given variables. """
+        if not self._simple(qvars):
+            return _gen_q_html_passes(qvars, self.html)
+        state = None
+        if self.shuffled:
+            state = random.getstate()
+        multis = [func(answer, params, qvars)
+                  for func, answer, params in self.multis]
+        out = []
+        for kind, text, tag in self.parts:
+            if kind == _LITERAL:
+                out.append(text)
+            elif kind == _MULTI:
+                out.append(multis[text])
+            elif text not in qvars:
+                out.append(tag)
+            elif kind == _VAL:
+                out.append('%s' % (qvars[text]))
+            elif kind == _IMG:
+                out.append('<IMG SRC="$STATIC$%s" />' % (qvars[text]))
+            else:
+                out.append('<A HREF="$STATIC$%s" TARGET="_new">%s(View in New Window)</a>' % (qvars[text], qvars[text]))
+        html = "".join(out)
+        for mark in _TAG_MARKS:
+            if mark in html:
+                # Something left over, or a variable with tags in it, that
+                # the long way might treat differently.
+                if state:
+                    random.setstate(state)
+                return _gen_q_html_passes(qvars, self.html)
+        return html
+
+
+def compile_q_html(html):
+    """ Parse the qtemplate.html, ready to make instances of it. """
+    return CompiledQHtml(html)
+
+
+def _get_compiled(key, make):
+    """ Return the compiled HTML for key from memory, or make() it and keep
+        it. make() returns (compiled, final), it's only kept if final and
+        not None. Least recently used are forgotten first.
+    """
+    with _compiled_lock:
+        if key in _compiled:
+            compiled = _compiled.pop(key)
+            _compiled[key] = compiled
+            return compiled
+    (compiled, final) = make()
+    if compiled is None or not final:
+        return compiled
+    with _compiled_lock:
+        _compiled[key] = compiled
+        while len(_compiled) > COMPILED_SIZE:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def get_compiled_q_html(qt_id, version):
+    """ The compiled qtemplate.html of the question template, or None if it
+        doesn't have one. Kept in memory, per qtemplate version.
+    """
+    key = ("qtemplate", qt_id, version, DB.get_generation("qtemplate", qt_id))
+
+    def make():
+        """ Compile it """
+        html = DB.get_qt_att(qt_id, "qtemplate.html", version)
+        if not html:
+            return None, False
+        return compile_q_html(html), True
+    return _get_compiled(key, make)
 
 
 def render_q_html(q_id, readonly=False):
@@ -468,30 +644,50 @@ def render_q_html(q_id, readonly=False):
         assert q_id > 0
     except (ValueError, TypeError, AssertionError):
         L.warn("renderQuestionHTML(%s,%s) called with bad qid?" % (q_id, readonly))
-    qt_id = DB.get_q_parent(q_id)
+    (qt_id, variation, version) = DB.get_q_origin(q_id)
     try:
         qt_id = int(qt_id)
         assert qt_id > 0
     except (ValueError, TypeError, AssertionError):
         L.warn("renderQuestionHTML(%s,%s), getparent failed? " % (q_id, readonly))
-    variation = DB.get_q_variation(q_id)
-    version = DB.get_q_version(q_id)
-    data = DB.get_q_att(qt_id, "qtemplate.html", variation, version)
-    if not data:
+        return "QuestionError"
+    compiled = get_compiled_q_display(qt_id, version, variation, readonly)
+    if not compiled:
         L.warn("Unable to retrieve qtemplate for q_id: %s" % q_id)
         return "QuestionError"
+    return compiled.render(q_id, DB.get_q_guesses(q_id))
+
+
+def _q_display_text(qt_id, version, variation):
+    """ The generated HTML of the question variation as unicode, or None,
+        and whether it's final. It isn't if the variation's hasn't been
+        generated yet and the question template's is used instead.
+    """
+    if DB.get_q_att_fname(qt_id, "qtemplate.html", variation, version):
+        data = DB.get_q_att(qt_id, "qtemplate.html", variation, version)
+        final = True
+    else:
+        data = DB.get_qt_att(qt_id, "qtemplate.html", version)
+        final = False
+    if not data:
+        return None, False
     try:
         out = unicode(data, "utf-8")
     except UnicodeDecodeError:
         try:
-            out = unicode(DB.get_q_att(qt_id, "qtemplate.html", variation, version),
-                          "latin-1")
+            out = unicode(data, "latin-1")
         except UnicodeDecodeError as err:
-            L.error("unicode error decoding qtemplate for q_id %s: %s" % (q_id, err))
+            L.error("unicode error decoding qtemplate for qt %s variation %s: %s" % (qt_id, variation, err))
             raise
     out = out.replace("This question is not verified yet, please report any error!", "")
+    return out, final
+
 
-    out = out.replace("ANS_", "Q_%d_ANS_" % (q_id,))
+def _q_display_fixed(out, q_id, qt_id, version, variation, readonly):
+    """ The parts of getting question HTML ready for display that don't
+        depend on the student's guesses.
+    """
+    out = out.replace("ANS_", "Q_%s_ANS_" % (q_id,))
     out = out.replace("$IMAGES$",
                       "%s/att/qatt/%s/%s/%s/" %
                       (OaConfig.parentURL, qt_id, version, variation))
@@ -504,7 +700,16 @@ def render_q_html(q_id, readonly=False):
     if readonly:
         out = out.replace("<INPUT ", "<INPUT READONLY ")
         out = out.replace("<SELECT ", "<SELECT DISABLED=DISABLED STYLE='color: black;'")
-    guesses = DB.get_q_guesses(q_id)
+    return out
+
+
+def _q_display_passes(out, q_id, qt_id, version, variation, readonly,
+                      guesses):
+    """ Get the question HTML ready for display the long way, a pass over it
+        for every possible answer and option. CompiledQDisplay does the
+        same in one pass, except in odd cases where this is used instead.
+    """
+    out = _q_display_fixed(out, q_id, qt_id, version, variation, readonly)
     for guess in guesses.keys():
         # noinspection PyComparisonWithNone
         if guesses[guess] == None:  # If it's 0 we want to leave it alone
@@ -534,6 +739,147 @@ def render_q_html(q_id, readonly=False):
     return out
 
 
+# Anything in the question HTML that might be an answer value or option
+_RE_GUESS_MARK = re.compile(u"VAL_|Oa_SEL_|Oa_CHK_|\x01")
+_RE_VAL_MARK = re.compile(u"VAL_([1-9][0-9]?)")
+_RE_OPTION_MARK = re.compile(u"Oa_(SEL|CHK)_([1-9][0-9]?)_([1-9][0-9]?)")
+_RE_WORD_CHAR = re.compile(u"[A-Za-z0-9_]")
+
+(_QID, _ANSWER, _OPTION) = range(5, 8)
+
+
+class CompiledQDisplay(object):
+    """ The HTML of a question variation, ready for display except for the
+        question id and the student's guesses. Parsed once into literal
+        text and the places they go, so showing a question is one pass
+        over it rather than hundreds of replaces.
+
+        The result is the same as _q_display_passes. Where that could depend
+        on the order it does things (eg. VAL_ in the middle of a word, a
+        guess that looks like one), it's used instead.
+    """
+
+    def __init__(self, text, qt_id, version, variation, readonly):
+
+        self.text = text
+        self.origin = (qt_id, version, variation, readonly)
+        self.parts = None  # None if we can't compile it
+        if u"\x01" in text:
+            return
+        out = _q_display_fixed(text, u"\x01", qt_id, version, variation,
+                               readonly)
+        parts = []
+        pos = 0
+        for mark in _RE_GUESS_MARK.finditer(out):
+            start = mark.start()
+            if start < pos:
+                continue
+            if mark.group(0) == u"\x01":
+                match = None
+            elif mark.group(0) == u"VAL_":
+                match = _RE_VAL_MARK.match(out, start)
+                if not match or int(match.group(1)) > 25:
+                    return
+            else:
+                match = _RE_OPTION_MARK.match(out, start)
+                if not match or int(match.group(2)) > 25 \
+                        or int(match.group(3)) > 50:
+                    return
+            if match:
+                end = match.end()
+                # must be a word of its own, or the long way may see it
+                # differently
+                if start > 0 and _RE_WORD_CHAR.match(out, start - 1):
+                    return
+                if _RE_WORD_CHAR.match(out, end):
+                    return
+            else:
+                end = start + 1
+            if start > pos:
+                parts.append((_LITERAL, out[pos:start], None))
+            if not match:
+                parts.append((_QID, None, None))
+            elif match.group(0).startswith(u"VAL_"):
+                parts.append((_ANSWER, int(match.group(1)), None))
+            else:
+                parts.append((_OPTION,
+                              (int(match.group(2)), int(match.group(3)),
+                               match.group(1) == u"SEL"),
+                              match.group(0)))
+            pos = end
+        if pos < len(out):
+            parts.append((_LITERAL, out[pos:], None))
+        self.parts = parts
+
+    def render(self, q_id, guesses):
+        """ The question HTML, for the question with the given guesses. """
+        if self.parts is None:
+            return self._passes(q_id, guesses)
+        answers = {}
+        chosen = {}
+        for ques in range(1, 26):
+            if ("G%d" % ques) not in guesses:
+                continue
+            guess = guesses["G%d" % ques]
+            # noinspection PyComparisonWithNone
+            if guess == None or guess == "None":
+                guess = ""
+            answer = htmlesc(guess)
+            if u"VAL_" in answer or u"Oa_SEL_" in answer \
+                    or u"Oa_CHK_" in answer:
+                return self._passes(q_id, guesses)
+            answers[ques] = answer
+            chosen[ques] = None
+            for part in range(50, 0, -1):
+                if guess == "%s.0" % part or guess == "%s" % part:
+                    chosen[ques] = part
+                    break
+        qid = u"%s" % (q_id,)
+        out = []
+        for kind, value, text in self.parts:
+            if kind == _LITERAL:
+                out.append(value)
+            elif kind == _QID:
+                out.append(qid)
+            elif kind == _ANSWER:
+                out.append(answers.get(value, u""))
+            else:
+                (ques, part, select) = value
+                if ques not in chosen:
+                    out.append(text)
+                elif chosen[ques] != part:
+                    pass
+                elif select:
+                    out.append(u"SELECTED")
+                else:
+                    out.append(u"CHECKED")
+        return u"".join(out)
+
+    def _passes(self, q_id, guesses):
+        """ Do it the long way. """
+        (qt_id, version, variation, readonly) = self.origin
+        return _q_display_passes(self.text, q_id, qt_id, version, variation,
+                                 readonly, guesses)
+
+
+def get_compiled_q_display(qt_id, version, variation, readonly=False):
+    """ The compiled HTML of the question variation, or None if it doesn't
+        have any. Kept in memory, per variation, once the variation's own
+        HTML has been generated.
+    """
+    key = ("display", qt_id, version, variation, readonly,
+           DB.get_generation("qtemplate", qt_id))
+
+    def make():
+        """ Compile it """
+        (text, final) = _q_display_text(qt_id, version, variation)
+        if text is None:
+            return None, False
+        return (CompiledQDisplay(text, qt_id, version, variation, readonly),
+                final)
+    return _get_compiled(key, make)
+
+
 # parseExpo interprets an input like "1.602 x 10^19" and returns
 # a tuple ("1.602e19",1.602e19), i.e., a reformatted string and an
 # attempt to convert it to float.
@@ -783,8 +1129,7 @@ def render_mark_results_script(qtid, qid, marks, script):
     """Run the provided script to show the marking for the
        question.
     """
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
+    (_, variation, version) = DB.get_q_origin(qid)
     qvars = DB.get_qt_variation(qtid, variation, version)
     questionhtml = render_q_html(qid, readonly=True)
     reshtml = ""
@@ -882,9 +1227,7 @@ def mark_q(qid, answers):
         input:    {"A1":"0.345", "A2":"fred", "A3":"-26" }
         return:   {"M1": Mark One, "C1": Comment One, "M2": Mark Two..... }
     """
-    qtid = DB.get_q_parent(qid)
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
+    (qtid, variation, version) = DB.get_q_origin(qid)
     qvars = DB.get_qt_variation(qtid, variation, version)
     if not qvars:
         qvars = {}
@@ -13,7 +13,7 @@
 # like SQL Alchemy. Too big a jump to do it all in one go.
 
 from oasis.lib import Periods
-from oasis.lib.DB import run_sql, IntegrityError
+from oasis.lib.DB import run_sql, run_many, IntegrityError
 
 from logging import getLogger
 
@@ -115,6 +115,19 @@ class Group(object):
                VALUES (%s, %s) """,
             (uid, self.id))
 
+    def add_members(self, uids):
+        """ Adds the given users to the group, skipping any already in it."""
+        existing = set(self.members())
+        new = []
+        for uid in uids:
+            if uid not in existing:
+                existing.add(uid)
+                new.append(uid)
+        run_many(
+            """INSERT INTO usergroups (userid, groupid)
+               VALUES (%s, %s) """,
+            [(uid, self.id) for uid in new])
+
     def remove_member(self, uid):
         """ Remove given user from the group."""
         run_sql(
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" Materialize.py
+    Generate the attachments of every variation of a question template
+    (qtemplate.html with the values filled in, image.gif with them drawn on)
+    when it's saved or imported, instead of when each variation is first
+    given to a student. Then the first students in an exam don't wait for
+    them.
+
+    The web server does it in a background thread. Forking a threaded web
+    server isn't safe (the children get copies of locks other threads may
+    be holding), so a pool of processes is only used when run from
+    bin/materialize_qtemplate. The results are written to the database in
+    bulk. How far it has got is kept in the cache, for the question editor
+    page.
+"""
+
+import Queue
+import cPickle
+import random
+import threading
+from multiprocessing import Pool
+from logging import getLogger
+
+from oasis.lib import OaConfig, DB, General, QImage
+
+L = getLogger("oasisqe")
+
+# Write generated attachments to the database this many at a time.
+BATCH = 200
+
+# How long to keep the progress of a run.
+PROGRESS_TIME = 3600
+
+_queue = Queue.Queue()
+_worker = None
+_lock = threading.Lock()
+
+# What worker processes render, set when the pool starts.
+_worker_state = {}
+
+
+def start(qt_id, version):
+    """ Generate the variation attachments of the question template version
+        in a background thread, if turned on in the configuration. Returns
+        straight away. Runs are done one at a time, in order.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    global _worker
+    if not OaConfig.materialize_on_save:
+        return
+    _set_progress(qt_id, {'version': version, 'done': 0, 'total': 0,
+                          'errors': 0, 'started': False, 'finished': False})
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="materialize")
+            _worker.daemon = True
+            _worker.start()
+    _queue.put((qt_id, version))
+
+
+def progress(qt_id):
+    """ How far generating the question template's variation attachments
+        has got, as a dict:
+            version, done, total, errors, started, finished
+        or None if it hasn't been done lately.
+    """
+    return DB.MC.get(_progress_key(qt_id))
+
+
+def _progress_key(qt_id):
+    """ The cache key holding the progress. """
+    return "qtemplate-%d-materialize" % qt_id
+
+
+def _set_progress(qt_id, status):
+    """ Record the progress. """
+    DB.MC.set(_progress_key(qt_id), status, PROGRESS_TIME)
+
+
+def _run():
+    """ The background thread, doing runs as they're requested. """
+    while True:
+        (qt_id, version) = _queue.get()
+        try:
+            materialize(qt_id, version)
+        except Exception as err:
+            L.error("Unable to generate variations of qtemplate %s "
+                    "version %s: %s" % (qt_id, version, err))
+            _set_progress(qt_id, {'version': version, 'done': 0, 'total': 0,
+                                  'errors': 1, 'started': True,
+                                  'finished': True})
+
+
+def materialize(qt_id, version, processes=1):
+    """ Generate and store the attachments of every variation of the
+        question template version that doesn't have them yet. If processes
+        is more than 1 they're rendered by a pool of that many processes,
+        don't do that from the web server. Returns how many were stored.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    html = DB.get_qt_att(qt_id, "qtemplate.html", version)
+    if html and "Oasis_qid" in html:
+        # needs the id of a question instance, leave it until there is one
+        html = None
+    image = DB.get_qt_att(qt_id, "image.gif", version)
+    names = []
+    if html:
+        names.append("qtemplate.html")
+    if image:
+        names.append("image.gif")
+    jobs = []
+    if names:
+        existing = dict([(name, DB.get_q_att_variations(qt_id, name, version))
+                         for name in names])
+        for variation, data in DB.get_qt_variations_data(qt_id, version):
+            todo = [name for name in names if variation not in existing[name]]
+            if todo:
+                jobs.append((variation, data, todo))
+    status = {'version': version, 'done': 0, 'total': len(jobs), 'errors': 0,
+              'started': True, 'finished': False}
+    _set_progress(qt_id, status)
+    made = 0
+    if jobs and processes > 1:
+        pool = Pool(processes, _init_worker, (html, image))
+        try:
+            made = _store(qt_id, version,
+                          pool.imap_unordered(_render, jobs, chunksize=8),
+                          status)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    elif jobs:
+        compiled = General.compile_q_html(html) if html else None
+        made = _store(qt_id, version,
+                      (_render_variation(compiled, image, job)
+                       for job in jobs),
+                      status)
+    status['finished'] = True
+    _set_progress(qt_id, status)
+    L.info("Generated %d attachments for %d variations of qtemplate %s "
+           "version %s" % (made, status['done'], qt_id, version))
+    return made
+
+
+def _store(qt_id, version, results, status):
+    """ Write the rendered attachments to the database a batch at a time,
+        updating the progress as we go. Gives up if the question template
+        gets a newer version in the meantime.
+        Returns how many were stored.
+    """
+    batch = []
+    made = 0
+    for variation, atts, error in results:
+        status['done'] += 1
+        if error:
+            status['errors'] += 1
+            L.warn("Unable to generate variation %s of qtemplate %s: %s" %
+                   (variation, qt_id, error))
+        batch.extend([(variation, name, mimetype, data)
+                      for name, mimetype, data in atts])
+        if len(batch) >= BATCH:
+            made += DB.create_q_atts(qt_id, version, batch)
+            batch = []
+            _set_progress(qt_id, status)
+            if DB.get_qt_version(qt_id) != version:
+                L.info("qtemplate %s changed, stopped generating version %s" %
+                       (qt_id, version))
+                return made
+    if batch:
+        made += DB.create_q_atts(qt_id, version, batch)
+    return made
+
+
+def _init_worker(html, image):
+    """ Set up a worker process. """
+    # otherwise every worker shuffles MULTI answers the same way
+    random.seed()
+    _worker_state['compiled'] = General.compile_q_html(html) if html else None
+    _worker_state['image'] = image
+
+
+def _render(job):
+    """ Render a variation, in a worker process. """
+    return _render_variation(_worker_state['compiled'], _worker_state['image'],
+                             job)
+
+
+def _render_variation(compiled, image, job):
+    """ Render the named attachments of the variation.
+        Returns (variation, [(name, mimetype, data), ...], error)
+    """
+    (variation, data, names) = job
+    atts = []
+    try:
+        qvars = cPickle.loads(data)
+        if "qtemplate.html" in names:
+            html = compiled.render(qvars)
+            if isinstance(html, unicode):
+                html = html.encode("utf-8")
+            atts.append(("qtemplate.html", "application/oasis-html", html))
+        if "image.gif" in names:
+            atts.append(("image.gif", QImage.mimetype(),
+                         QImage.render(image, QImage.coords(qvars))))
+    except Exception as err:
+        return variation, atts, "%s: %s" % (type(err).__name__, err)
+    return variation, atts, None
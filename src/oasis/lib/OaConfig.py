@@ -40,22 +40,51 @@ if len(admin_list):
 else:
     email_admins = ()
 cachedir = cp.get("cache", "cachedir")
+cache_maxsize = cp.getint("cache", "file_maxsize") * 1024 * 1024
+cache_maxage = cp.getint("cache", "file_maxage") * 24 * 60 * 60
+cache_missing_ttl = cp.getint("cache", "missing_ttl")
+prewarm_minutes = cp.getint("cache", "prewarm_minutes")
 
 dbhost = cp.get("db", "host")
 dbuname = cp.get("db", "uname")
 dbname = cp.get("db", "dbname")
 dbpass = cp.get("db", "pass")
 dbport = cp.get("db", "port")
+dbpool_min = cp.getint("db", "pool_min")
+dbpool_max = cp.getint("db", "pool_max")
+dbpool_timeout = cp.getfloat("db", "pool_timeout")
+dbpool_idle = cp.getint("db", "pool_idle")
+db_stmt_cache = cp.getint("db", "stmt_cache")
+db_slow_query = cp.getfloat("db", "slow_query")
+db_slow_query_log = cp.get("db", "slow_query_log")
 
 oasisdbconnectstring = "host=%s port=%s dbname=%s user=%s password='%s'" % \
                        (dbhost, dbport, dbname, dbuname, dbpass)
 
+# Optional read-only replicas, same database name and login as the primary.
+replicaconnectstrings = []
+for _replica in cp.get("db", "replicas").replace(",", " ").split():
+    if ":" in _replica:
+        (_rhost, _rport) = _replica.split(":", 1)
+    else:
+        (_rhost, _rport) = (_replica, dbport)
+    replicaconnectstrings.append(
+        "host=%s port=%s dbname=%s user=%s password='%s'" %
+        (_rhost, _rport, dbname, dbuname, dbpass))
+db_replica_auto = cp.getboolean("db", "replica_auto")
+
 email = cp.get("web", "email")
 contact_url = cp.get("web", "contact_url", False)
 if len(contact_url) < 3:
     contact_url = False
 memcache_enable = cp.getboolean("cache", "memcache_enable")
+memcache_servers = cp.get("cache", "memcache_servers").replace(",", " ").split()
+memcache_dead_retry = cp.getint("cache", "memcache_dead_retry")
+memory_cache_size = cp.getint("cache", "memory_cache_size") * 1024 * 1024
+memory_cache_maxttl = cp.getint("cache", "memory_cache_maxttl")
+cache_compress_threshold = cp.getint("cache", "cache_compress_threshold")
 uniqueKey = cp.get("cache", "cachekey")
+local_cache = cp.getboolean("cache", "local_cache")
 
 logfile = cp.get("app", "logfile")
 _ll = cp.getint("app", "loglevel")
@@ -66,7 +95,12 @@ else:
 
 profile_log = cp.get("app", "profile_log")
 feed_path = cp.get("app", "feed_path")
+qpool_size = cp.getint("app", "qpool_size")
+qpool_low = cp.getint("app", "qpool_low")
+materialize_on_save = cp.getboolean("app", "materialize_on_save")
+q_image_format = cp.get("app", "q_image_format")
 open_registration = cp.getboolean("web", "open_registration")
 enable_local_login = cp.getboolean("web", "enable_local_login")
 enable_webauth_login = cp.getboolean("web", "enable_webauth_login")
 webauth_ignore_domain = cp.getboolean("web", "webauth_ignore_domain")
+x_sendfile = cp.getboolean("web", "x_sendfile")
@@ -11,3 +11,11 @@ class OaMarkerError(Exception):
     """
 
     pass
+
+
+class OaPoolError(Exception):
+    """We were unable to get a connection from a pool in a reasonable time,
+       or the server it connects to is unavailable.
+    """
+
+    pass
@@ -5,7 +5,7 @@
 
 """ Contains db access functions for users, groups, permissions and courses """
 
-from oasis.lib.DB import run_sql, MC
+from oasis.lib.DB import run_sql, MC, gen_key, bump_generation
 
 PERMS = {'sysadmin': 1, 'useradmin': 2,
          'courseadmin': 3, 'coursecoord': 4,
@@ -23,18 +23,19 @@ def check_perm(user_id, group_id, perm):
     if not isinstance(perm, int):  # we have a string name so look it up
         if perm in PERMS:
             permission = PERMS[perm]
-    key = "permission-%s-super" % user_id
-    obj = MC.get(key)
-    if obj:
-        return True
-        # If they're superuser, let em do anything
-    ret = run_sql("""SELECT "id"
-                     FROM permissions
-                     WHERE userid=%s
-                       AND permission=1;""",
-                  (user_id,))
-    if ret:
-        MC.set(key, True)
+    key = gen_key("user", user_id, "super")
+
+    def load():
+        """ Is the user a superuser? """
+        ret = run_sql("""SELECT "id"
+                         FROM permissions
+                         WHERE userid=%s
+                           AND permission=1;""",
+                      (user_id,))
+        return bool(ret)
+    # If they're superuser, let em do anything
+    # (add_perm/delete_perm bump the user, so we can cache "no" too)
+    if MC.get_or_compute(key, load, 600):
         return True
         # If we're asking for course -1 it means any course will do.
     if group_id == -1:
@@ -78,21 +79,19 @@ def satisfy_perms(uid, group_id, permlist):
 
 def delete_perm(uid, group_id, perm):
     """Remove a permission. """
-    key = "permission-%s-super" % (uid,)
-    MC.delete(key)
     run_sql("""DELETE FROM permissions
                WHERE userid=%s
                  AND course=%s
                  AND permission=%s""",
             (uid, group_id, perm))
+    bump_generation("user", uid)
 
 
 def add_perm(uid, course_id, perm):
     """ Assign a permission."""
-    key = "permission-%s-super" % (uid,)
-    MC.delete(key)
     run_sql("""INSERT INTO permissions (course, userid, permission)
                VALUES (%s, %s, %s) """, (course_id, uid, perm))
+    bump_generation("user", uid)
 
 
 def get_course_perms(course_id):
@@ -13,13 +13,33 @@
 # to make sure a replacement works as well.
 
 
-import Queue
+import bisect
+import datetime
+import hashlib
+import math
 import os
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
 import OaConfig
+import CacheStats
+from CachePack import pack, unpack
+from OaExceptions import OaPoolError
 from logging import getLogger
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, \
+    ISOLATION_LEVEL_READ_COMMITTED
 import memcache
+from collections import OrderedDict
+
+try:
+    from psycopg2.extras import execute_batch
+except ImportError:  # psycopg2 older than 2.7
+    execute_batch = None
 
 try:
     uniqueKey = OaConfig.uniqueKey
@@ -28,30 +48,199 @@ except AttributeError:
 
 L = getLogger("oasisqe")
 
+_RX_PARAM = re.compile(r"%%|%s")
+
+# memcached won't take keys longer than this, or with spaces or control
+# characters in them.
+MC_MAX_KEY_LENGTH = 250
+_RX_MC_BAD_KEY = re.compile(r"[\x00-\x20\x7f]")
+
+
+def to_positional(sql):
+    """ Convert a psycopg2 style query ("... WHERE a=%s AND b=%s")
+        into a postgres positional one ("... WHERE a=$1 AND b=$2")
+        suitable for PREPARE.
+        Returns (sql, number of parameters)
+    """
+    count = [0]
+
+    def repl(match):
+        """ Number each %s in turn """
+        if match.group(0) == "%%":
+            return "%"
+        count[0] += 1
+        return "$%d" % count[0]
+
+    sql = _RX_PARAM.sub(repl, sql.strip().rstrip(";"))
+    return sql, count[0]
+
+
+def copy_value(value, encoding="utf-8"):
+    """ Format a python value as a field for postgres COPY (text format).
+        Use psycopg2.Binary(data) for bytea columns.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, psycopg2.extensions.Binary):
+        return "\\\\x" + str(value.adapted).encode("hex")
+    if isinstance(value, unicode):
+        value = value.encode(encoding)
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\") \
+                .replace("\t", "\\t") \
+                .replace("\n", "\\n") \
+                .replace("\r", "\\r")
+
 
 class DbConn(object):
-    """Manage a single database connection."""
+    """Manage a single database connection.
 
-    def __init__(self, connectstring):
+       Also keeps a cache of server side prepared statements, keyed by SQL
+       text, for queries run with prepare=True. The least recently used
+       ones are deallocated once there are more than stmt_cache_size.
+    """
+
+    def __init__(self, connectstring, stmt_cache_size=50):
 
         self.connectstring = connectstring
-        self.conn = psycopg2.connect(connectstring)
+        self.conn = None
+        self.broken = False
+        self.in_transaction = False
+        self.last_used = time.time()
+        self.stmt_cache_size = stmt_cache_size
+        self.prepared = OrderedDict()  # sql -> statement name, oldest first
+        self.stmt_seq = 0
+        self.connect()
+
+    def connect(self):
+        """ Log in to the database. May raise psycopg2.Error """
+        self.conn = psycopg2.connect(self.connectstring)
         self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        self.broken = False
+        self.in_transaction = False
+        self.prepared.clear()  # they belonged to the old session
         L.info("DB Encoding is %s" % self.conn.encoding)
-        if not self.conn:
-            L.warn("DB relogin failed!")
 
-    def run_sql(self, sql, params=None, quiet=False):
-        """ Execute SQL commands over the connection. """
+    def close(self):
+        """ Close the underlying connection, ignoring any errors since
+            we're usually doing this because it's already broken.
+        """
+        try:
+            self.conn.close()
+        except (psycopg2.Error, AttributeError):
+            pass
+
+    def reset(self):
+        """ Throw away the current connection and log in again.
+            May raise psycopg2.Error if the database is unavailable.
+        """
+        L.warn("DB connection reset.")
+        self.close()
+        self.connect()
+
+    def is_alive(self, ping_after=0):
+        """ Check the connection is still usable. If it has been idle for
+            more than ping_after seconds we ask the server, otherwise we just
+            look at the local state, which is cheap.
+        """
+        if self.broken or not self.conn or self.conn.closed:
+            return False
+        if time.time() - self.last_used < ping_after:
+            return True
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.fetchall()
+            cur.close()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def begin(self):
+        """ Start a transaction. Statements are no longer committed
+            individually, but all together by commit().
+        """
+        self.conn.set_isolation_level(ISOLATION_LEVEL_READ_COMMITTED)
+        self.in_transaction = True
+
+    def commit(self):
+        """ Commit the current transaction and go back to autocommit. """
+        self.conn.commit()
+        self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        self.in_transaction = False
+
+    def rollback(self):
+        """ Abandon the current transaction and go back to autocommit. """
+        try:
+            self.conn.rollback()
+            self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        except psycopg2.Error as err:
+            L.error("DB Error during rollback (%s)" % err)
+            self.broken = True
+        self.in_transaction = False
+        if self.prepared and not self.broken:
+            # A statement prepared during the transaction may or may not
+            # have survived it, so start again.
+            self.forget_prepared()
+
+    def forget_prepared(self):
+        """ Drop all our prepared statements, on the server too. """
+        self.prepared.clear()
+        try:
+            cur = self.conn.cursor()
+            cur.execute("DEALLOCATE ALL;")
+            cur.close()
+        except psycopg2.Error as err:
+            L.warn("DB Error deallocating statements (%s)" % err)
+
+    def _prepared_name(self, cur, sql):
+        """ Find (or create) the prepared statement for the given SQL
+            and mark it as most recently used.
+        """
+        name = self.prepared.pop(sql, None)
+        if name is None:
+            self.stmt_seq += 1
+            name = "oa_stmt_%d" % self.stmt_seq
+            possql, _ = to_positional(sql)
+            cur.execute("PREPARE %s AS %s;" % (name, possql))
+            while len(self.prepared) >= self.stmt_cache_size:
+                _, oldname = self.prepared.popitem(last=False)
+                cur.execute("DEALLOCATE %s;" % oldname)
+        self.prepared[sql] = name
+        return name
+
+    def run_sql(self, sql, params=None, quiet=False, prepare=False):
+        """ Execute SQL commands over the connection.
+            If prepare is set, the statement is prepared on the server the
+            first time and only EXECUTEd after that, saving postgres from
+            parsing and planning it every time. Only use it for simple
+            queries that are run often.
+        """
 #        log(ERROR, "DB SQL '%s' (%s)" % (sql, repr(params)))
         try:
             cur = self.conn.cursor()
-            if not params:
+            if prepare and params and self.stmt_cache_size > 0:
+                name = self._prepared_name(cur, sql)
+                placeholders = ", ".join(["%s"] * len(params))
+                rec = cur.execute("EXECUTE %s (%s);" % (name, placeholders),
+                                  params)
+            elif not params:
                 rec = cur.execute(sql)
             else:
                 rec = cur.execute(sql, params)
 
         except BaseException as err:
+            if isinstance(err, (psycopg2.OperationalError,
+                                psycopg2.InterfaceError)):
+                # Lost the server. Flag it so the pool will reset us.
+                self.broken = True
+            if prepare:
+                # Not sure what state the statement is in, prepare it
+                # again next time.
+                self.prepared.pop(sql, None)
             if not quiet:
                 L.error("DB Error (%s) '%s' (%s)" % (err, sql, repr(params)))
                 raise
@@ -67,46 +256,256 @@ class DbConn(object):
             return rec
 
 
+    def run_many(self, sql, rows):
+        """ Execute the SQL once for each set of params in rows, sending
+            them to the server in batches rather than one at a time.
+        """
+        try:
+            cur = self.conn.cursor()
+            if execute_batch:
+                execute_batch(cur, sql, rows, page_size=1000)
+            else:
+                cur.executemany(sql, rows)
+            cur.close()
+        except BaseException as err:
+            if isinstance(err, (psycopg2.OperationalError,
+                                psycopg2.InterfaceError)):
+                self.broken = True
+            L.error("DB Error (%s) '%s' (run_many)" % (err, sql))
+            raise
+
+    def copy_rows(self, table, columns, rows):
+        """ Bulk insert rows into the table using COPY, which is much
+            faster than individual INSERTs for more than a handful of rows.
+            Returns the number of rows copied.
+        """
+        encoding = psycopg2.extensions.encodings.get(self.conn.encoding,
+                                                     "utf-8")
+        buf = StringIO()
+        count = 0
+        for row in rows:
+            buf.write("\t".join([copy_value(val, encoding) for val in row]))
+            buf.write("\n")
+            count += 1
+        buf.seek(0)
+        sql = 'COPY "%s" (%s) FROM STDIN;' % (
+            table, ", ".join(['"%s"' % col for col in columns]))
+        try:
+            cur = self.conn.cursor()
+            cur.copy_expert(sql, buf)
+            cur.close()
+        except BaseException as err:
+            if isinstance(err, (psycopg2.OperationalError,
+                                psycopg2.InterfaceError)):
+                self.broken = True
+            L.error("DB Error (%s) '%s' (%d rows)" % (err, sql, count))
+            raise
+        return count
+
+    def iter_sql(self, sql, params=None, batch=1000):
+        """ Generator yielding the rows of a query, fetched batch rows at a
+            time through a server side (named) cursor, so the whole result
+            never has to fit in memory at once.
+            Named cursors only live inside a transaction, so we start one if
+            we're not already in one. Don't run other statements on this
+            connection until the iteration is finished.
+        """
+        own_tx = not self.in_transaction
+        if own_tx:
+            self.begin()
+        self.stmt_seq += 1
+        try:
+            cur = self.conn.cursor("oa_cur_%d" % self.stmt_seq)
+            cur.itersize = batch
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            cur.close()
+        except BaseException as err:
+            if isinstance(err, (psycopg2.OperationalError,
+                                psycopg2.InterfaceError)):
+                self.broken = True
+            if not isinstance(err, GeneratorExit):
+                L.error("DB Error (%s) '%s' (%s)" % (err, sql, repr(params)))
+            if own_tx:
+                self.rollback()
+            raise
+        if own_tx:
+            self.commit()
+
+
 class DbPool(object):
     """ Manage a pool of DbConn.
         users should grab a database connection with start(), run sql
         commands with run_sql() and then release it back to the pool with
-        finish(). 
-        Will initialise the pool with the given number of parallel connections.
+        finish().
+
+        The pool starts with "size" connections and will open more, up to
+        "maxsize", when they're all busy. Connections that have been idle
+        for more than "idle" seconds are closed again, down to "size".
+        Connections are checked when handed out, and dead ones replaced.
+        If we can't get a connection within "timeout" seconds, OaPoolError
+        is raised.
 
         example:
 
-        dbpool = DbPool("dbname=oasis user=oasisuser",10)
+        dbpool = DbPool("dbname=oasis user=oasisuser", 3, maxsize=10)
         dbc = dbpool.start()
-        dbc.run_sql("SELECT * FROM users WHERE user=%s;", userid)
-        dbpool.finish(dbc)
+        try:
+            dbc.run_sql("SELECT * FROM users WHERE user=%s;", userid)
+        finally:
+            dbpool.finish(dbc)
     """
 
-    def __init__(self, connectstring, size):
-        self.size = size
-        self.connqueue = Queue.Queue(size)
+    def __init__(self, connectstring, size, maxsize=None, timeout=30,
+                 idle=300, ping_after=10, stmt_cache_size=50):
+        self.connectstring = connectstring
+        self.stmt_cache_size = stmt_cache_size
+        self.minsize = size
+        self.maxsize = max(size, maxsize or size)
+        self.timeout = timeout
+        self.idle = idle
+        self.ping_after = ping_after
+        self.cond = threading.Condition(threading.Lock())
+        self.free = []  # idle connections, most recently used at the end
+        self.size = 0   # connections we own, including those handed out
+        self.waits = {'count': 0,     # connections handed out
+                      'waited': 0,    # how many of those had to wait
+                      'total': 0.0,   # seconds spent waiting
+                      'max': 0.0,
+                      'timeouts': 0}
         for _ in range(0, size):
-            self.connqueue.put(DbConn(connectstring))
+            self.free.append(DbConn(connectstring, stmt_cache_size))
+            self.size += 1
 
     def start(self):
         """Fetch a db connection from the pool (will block until one becomes
-           available), and begin a transaction on it.
+           available, or raise OaPoolError if that takes too long).
         """
-        if self.connqueue.qsize() < 3:
-            L.info("DB Pool getting low! %d" % self.connqueue.qsize())
-        dbc = self.connqueue.get(True)
+        started = time.time()
+        deadline = started + self.timeout
+        dbc = None
+        waited = False
+        with self.cond:
+            while True:
+                if self.free:
+                    dbc = self.free.pop()
+                    break
+                if self.size < self.maxsize:
+                    self.size += 1  # reserve a slot, connect outside the lock
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waits['timeouts'] += 1
+                    L.error("DB Pool exhausted, gave up after %s seconds "
+                            "(%d connections)" % (self.timeout, self.size))
+                    raise OaPoolError("Timed out waiting for a database "
+                                      "connection (%d in use)" % self.size)
+                L.info("DB Pool empty, waiting. %d in use" % self.size)
+                waited = True
+                self.cond.wait(remaining)
+            self._note_wait(waited, time.time() - started)
+
+        if dbc is None:
+            try:
+                dbc = DbConn(self.connectstring, self.stmt_cache_size)
+            except psycopg2.Error as err:
+                self._discard(None)
+                L.error("DB Pool unable to open new connection: %s" % err)
+                raise OaPoolError("Unable to connect to database: %s" % err)
+            L.info("DB Pool grew to %d connections" % self.size)
+        elif not dbc.is_alive(self.ping_after):
+            L.warn("DB Pool found a dead connection, replacing it.")
+            try:
+                dbc.reset()
+            except psycopg2.Error as err:
+                self._discard(dbc)
+                L.error("DB Pool unable to reconnect: %s" % err)
+                raise OaPoolError("Unable to connect to database: %s" % err)
         return dbc
 
     def finish(self, dbc):
-        """Put the db connection back in the pool."""
-        # TODO: check for errors and reset connection if any
-        self.connqueue.put(dbc)
+        """Put the db connection back in the pool. If it broke while it
+           was out, try to reset it first.
+        """
+        if dbc.in_transaction:
+            L.warn("DB connection returned to pool mid-transaction, "
+                   "rolling back.")
+            dbc.rollback()
+        if dbc.broken:
+            try:
+                dbc.reset()
+            except psycopg2.Error as err:
+                L.error("DB Pool unable to reset connection: %s" % err)
+                self._discard(dbc)
+                return
+        dbc.last_used = time.time()
+        with self.cond:
+            self.free.append(dbc)
+            idle = self._reap()
+            self.cond.notify()
+        for old in idle:
+            old.close()
+
+    def _reap(self):
+        """ Remove connections that have been idle too long, keeping at
+            least minsize. Must be called with the lock held.
+            Returns the removed connections so they can be closed after
+            the lock is released.
+        """
+        idle = []
+        cutoff = time.time() - self.idle
+        while (self.size > self.minsize and self.free
+               and self.free[0].last_used < cutoff):
+            idle.append(self.free.pop(0))
+            self.size -= 1
+        if idle:
+            L.info("DB Pool shrank to %d connections" % self.size)
+        return idle
+
+    def _discard(self, dbc):
+        """ Forget about a connection (or a reserved slot if dbc is None)
+            so that someone else can open a new one in its place.
+        """
+        if dbc:
+            dbc.close()
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def _note_wait(self, waited, seconds):
+        """ Update the wait statistics. Call with self.cond held. """
+        self.waits['count'] += 1
+        if waited:
+            self.waits['waited'] += 1
+            self.waits['total'] += seconds
+            if seconds > self.waits['max']:
+                self.waits['max'] = seconds
+
+    def wait_stats(self):
+        """ How long callers of start() have had to wait for a connection.
+            Returns a dict with
+                count: connections handed out, waited: how many had to wait,
+                total, mean, max: seconds spent waiting by those that did,
+                timeouts: how many gave up.
+        """
+        with self.cond:
+            stats = dict(self.waits)
+        if stats['waited']:
+            stats['mean'] = stats['total'] / stats['waited']
+        else:
+            stats['mean'] = 0.0
+        return stats
 
     def __len__(self):
         """
         :return: integer : the number of free entries in the pool.
         """
-        return self.connqueue.qsize()
+        return len(self.free)
 
     def total(self):
         """
@@ -116,9 +515,22 @@ class DbPool(object):
 
 
 class FileCache(object):
-    """Cache data in local files """
+    """Cache data in local files.
+
+       Each item is stored in cachedir/<key>/DATA. Files are written to a
+       temporary name and renamed into place, so readers never see a half
+       written one. The modification time of DATA is used as the "last
+       used" time (bumped when read, at most once every touch_after
+       seconds), and trim() removes the least recently used items to keep
+       the cache under maxbytes, and anything not used for maxage seconds.
+       If given a LocalCache, small items it's interested in are kept in
+       memory too.
+       set_missing() records that an item doesn't exist at all (in
+       cachedir/<key>/MISSING), which is believed for missing_ttl seconds.
+    """
 
-    def __init__(self, cachedir):
+    def __init__(self, cachedir, maxbytes=0, maxage=0, touch_after=3600,
+                 local=None, missing_ttl=300):
 
         if not os.access(cachedir, os.W_OK):
             try:
@@ -128,9 +540,19 @@ class FileCache(object):
             if not os.access(cachedir, os.W_OK):
                 L.warn("Can't write to cache dir '%s' please check permissions.")
         self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.touch_after = touch_after
+        self.local = local
+        self.missing_ttl = missing_ttl
 
     def set(self, key, value):
         """ store item."""
+        if self.local:
+            if value is False:
+                self.local.delete(key)
+            else:
+                self.local.set(key, value)
         if value is False:
             # We want to delete the item from the cache
             try:
@@ -139,36 +561,101 @@ class FileCache(object):
                 # this usually happens when the file is already gone
                 pass
             return
-        if not os.access(os.path.join(self.cachedir, key), os.W_OK):
+        keydir = os.path.join(self.cachedir, key)
+        if not os.access(keydir, os.W_OK):
             try:
-                os.makedirs(os.path.join(self.cachedir, key))
-            except IOError:
-                L.error("Can't create cache in %s/%s" % (self.cachedir, key))
+                os.makedirs(keydir)
+            except OSError as err:
+                # may have been created by someone else in the meantime
+                if not os.path.isdir(keydir):
+                    L.error("Can't create cache in %s/%s (%s)" % (
+                        self.cachedir, key, err))
+                    CacheStats.record("file", key, "errors")
+                    return False
+        tmpname = None
         try:
-            fptr = open(os.path.join(self.cachedir, key, "DATA"), "wb")
+            (fd, tmpname) = tempfile.mkstemp(prefix=".DATA.", dir=keydir)
+            fptr = os.fdopen(fd, "wb")
             fptr.write(value)
             fptr.close()
-        except IOError as err:
+            os.chmod(tmpname, 0o644)
+            os.rename(tmpname, os.path.join(keydir, "DATA"))
+        except (IOError, OSError) as err:
             L.error("File Cache Error. (%s)" % err)
+            CacheStats.record("file", key, "errors")
+            if tmpname:
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
             return False
+        CacheStats.record_set("file", key, value)
+        self.clear_missing(key)
         return True
 
+    def set_missing(self, key):
+        """ Record that the item doesn't exist. """
+        self.set(key, False)
+        keydir = os.path.join(self.cachedir, key)
+        try:
+            if not os.path.isdir(keydir):
+                os.makedirs(keydir)
+            open(os.path.join(keydir, "MISSING"), "w").close()
+        except (IOError, OSError) as err:
+            L.warn("File Cache Error. (%s)" % err)
+
+    def is_missing(self, key):
+        """ Have we recently recorded that the item doesn't exist? """
+        fname = os.path.join(self.cachedir, key, "MISSING")
+        try:
+            mtime = os.stat(fname).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime < self.missing_ttl
+
+    def clear_missing(self, key):
+        """ Forget that the item didn't exist. """
+        try:
+            os.unlink(os.path.join(self.cachedir, key, "MISSING"))
+        except OSError:
+            pass
+
+    def _touch(self, fptr, fname):
+        """ Mark the file as recently used, if it hasn't been lately. """
+        try:
+            if time.time() - os.fstat(fptr.fileno()).st_mtime > \
+                    self.touch_after:
+                os.utime(fname, None)
+        except OSError:
+            pass
+
     def get_filename(self, key):
         """ return the full path to the on-disk file """
+        fname = os.path.join(self.cachedir, key, "DATA")
         try:
-            fptr = open(os.path.join(self.cachedir, key, "DATA"), "r")
+            fptr = open(fname, "r")
         except IOError:
+            CacheStats.record("file", key, "misses")
             return False, False
+        self._touch(fptr, fname)
         fptr.close()
-        return os.path.join(self.cachedir, key, "DATA"), True
+        CacheStats.record("file", key, "hits")
+        return fname, True
 
     def get(self, key):
         """ fetch item. """
+        if self.local:
+            (data, found) = self.local.get(key)
+            if found:
+                return data, True
+        fname = os.path.join(self.cachedir, key, "DATA")
         try:
-            fptr = open(os.path.join(self.cachedir, key, "DATA"), "r")
+            fptr = open(fname, "r")
         except IOError:
+            CacheStats.record("file", key, "misses")
             return False, False
         try:
+            self._touch(fptr, fname)
             data = fptr.read()
             fptr.close()
             if len(data) == 0:
@@ -178,143 +665,719 @@ class FileCache(object):
         except IOError as err:
             # it's possible that something went wrong
             L.error("file Cache ERROR. (key=%s, exception=%s)" % (key, err))
+            CacheStats.record("file", key, "errors")
             return False, False
+        CacheStats.record("file", key, "hits")
+        if self.local and data is not False:
+            self.local.set(key, data)
         return data, True
 
+    def trim(self, maxbytes=None, maxage=None):
+        """ Remove items not used in the last maxage seconds, then the least
+            recently used until the cache is under maxbytes (the values given
+            to the constructor if not given, 0 for no limit).
+            Returns (items removed, bytes removed, bytes remaining)
+        """
+        if maxbytes is None:
+            maxbytes = self.maxbytes
+        if maxage is None:
+            maxage = self.maxage
+        now = time.time()
+        items = []
+        for dirpath, dirnames, filenames in os.walk(self.cachedir):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # someone else removed it
+                if fname.startswith(".DATA."):
+                    # Left over from an interrupted write
+                    if now - stat.st_mtime > 3600:
+                        self._remove(path)
+                    continue
+                items.append((stat.st_mtime, stat.st_size, path))
+        items.sort()
+        total = sum([item[1] for item in items])
+        removed = 0
+        freed = 0
+        for mtime, size, path in items:
+            if maxage and now - mtime > maxage:
+                pass
+            elif maxbytes and total > maxbytes:
+                pass
+            else:
+                break
+            if self._remove(path):
+                removed += 1
+                freed += size
+                total -= size
+        L.info("File cache trimmed, removed %d items (%d bytes), %d left" % (
+            removed, freed, total))
+        return removed, freed, total
+
+    def _remove(self, path):
+        """ Remove a cache file and any directories left empty. """
+        try:
+            os.unlink(path)
+        except OSError:
+            return False
+        dirpath = os.path.dirname(path)
+        try:
+            while dirpath != self.cachedir and \
+                    dirpath.startswith(self.cachedir):
+                os.rmdir(dirpath)  # fails if not empty
+                dirpath = os.path.dirname(dirpath)
+        except OSError:
+            pass
+        return True
+
 
-# noinspection PyUnusedLocal
-class FakeMCConn(object):
-    """ Dummy memcached connector for when we don't want to use memcached.
+class LocalCache(object):
+    """ A small in-process cache for hot, tiny values, that sits in front of
+        the FileCache and memcache so we don't have to go to disk or the
+        network for them every time.
+
+        Only keys matching one of the namespaces are kept. Each namespace is
+        a least-recently-used cache with its own size limit and time to
+        live (in seconds), since we can't tell other processes when we
+        change something.
+
+        example:
+
+        local = LocalCache({
+            'mimetype': (r"attach/.*/mimetype$", 5000, 3600),
+        })
     """
 
-    def __init__(self, connectstring):
-        L.info("Starting dummy memcached interface.")
+    def __init__(self, namespaces):
+        self.lock = threading.Lock()
+        self.namespaces = []
+        self.items = {}
+        self.limits = {}
+        self.hits = {}
+        self.misses = {}
+        for name, (pattern, size, ttl) in namespaces.items():
+            self.namespaces.append((name, re.compile(pattern)))
+            self.items[name] = OrderedDict()
+            self.limits[name] = (size, ttl)
+            self.hits[name] = 0
+            self.misses[name] = 0
 
-    def set(self, key, value, expiry=None):
-        """Pretend to store item. """
-        return True
+    def namespace(self, key):
+        """ Which namespace the key belongs in, or None if we don't keep it.
+        """
+        for name, pattern in self.namespaces:
+            if pattern.search(key):
+                return name
+        return None
 
     def get(self, key):
-        """Return nothing. """
-        return None
+        """ Fetch item. Returns (value, found) """
+        name = self.namespace(key)
+        if name is None:
+            return None, False
+        with self.lock:
+            items = self.items[name]
+            item = items.pop(key, None)
+            if item is not None and item[0] > time.time():
+                items[key] = item  # move to most recently used end
+                self.hits[name] += 1
+                return item[1], True
+            self.misses[name] += 1
+        return None, False
+
+    def set(self, key, value, expiry=None):
+        """ Store item, for no longer than expiry seconds if given.
+            Returns False if we don't keep this sort of key.
+        """
+        name = self.namespace(key)
+        if name is None:
+            return False
+        (size, ttl) = self.limits[name]
+        if expiry:
+            ttl = min(ttl, expiry)
+        with self.lock:
+            items = self.items[name]
+            items.pop(key, None)
+            items[key] = (time.time() + ttl, value)
+            while len(items) > size:
+                items.popitem(last=False)
+        return True
 
     def delete(self, key):
-        """Do nothing."""
-        return None
+        """ Remove item. """
+        name = self.namespace(key)
+        if name is None:
+            return
+        with self.lock:
+            self.items[name].pop(key, None)
 
+    def clear(self):
+        """ Remove everything. """
+        with self.lock:
+            for items in self.items.values():
+                items.clear()
+
+    def stats(self):
+        """ Return a list of dicts, one per namespace, with
+            name, size, limit, ttl, hits, misses
+        """
+        with self.lock:
+            return [{'name': name,
+                     'size': len(self.items[name]),
+                     'limit': self.limits[name][0],
+                     'ttl': self.limits[name][1],
+                     'hits': self.hits[name],
+                     'misses': self.misses[name]}
+                    for name, _ in self.namespaces]
 
-class MCConn(object):
-    """ Look after a connection to a memcached server.
-        Just a simple wrapper with some logging. """
 
-    def __init__(self, connectstring):
+class CacheBackend(object):
+    """ Where MCPool keeps items. Subclasses store items (already packed
+        into byte strings) under already prefixed (byte string) keys and
+        never raise, a failure just looks like a cache miss.
+    """
 
-        self.conn = memcache.Client([connectstring], debug=0)
-        if not self.conn:
-            L.error("Memcache login failed!")
+    def get(self, key):
+        """ fetch item, or None if not there. """
+        raise NotImplementedError
 
     def set(self, key, value, expiry=None):
-        """ store item. """
-        key = "%s-%s" % (uniqueKey, key)
-        key = key.encode("utf-8")
-        try:
-            if expiry:
-                res = self.conn.set(key, value, expiry)
-            else:
-                res = self.conn.set(key, value)
-            L.info("OaPool:MCConn:set(%s, %s, %s)" % (key, value, expiry))
-        except BaseException as err:
-            # it's possible that something went wrong
-            L.error("Memcache Error. (%s)" % err)
+        """ store item, for no longer than expiry seconds if given. """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ remove item. """
+        raise NotImplementedError
+
+    def add(self, key, value, expiry=None):
+        """ store item only if it isn't there already. Returns True if
+            stored. Backends should do this atomically if they can.
+        """
+        if self.get(key) is not None:
             return False
+        return self.set(key, value, expiry)
+
+    def get_multi(self, keys):
+        """ fetch several items. Returns a dict of the ones found. """
+        return dict([(key, value)
+                     for key, value in [(key, self.get(key)) for key in keys]
+                     if value is not None])
 
+    def set_multi(self, mapping, expiry=None):
+        """ store several items. Returns True if they were all stored. """
+        res = True
+        for key, value in mapping.iteritems():
+            if not self.set(key, value, expiry):
+                res = False
         return res
 
+    def delete_multi(self, keys):
+        """ remove several items. """
+        for key in keys:
+            self.delete(key)
+        return True
+
+    def is_alive(self):
+        """ Whether the backend is working. """
+        return True
+
+    def status(self):
+        """ Return a dict describing the state of the backend. """
+        return {'address': self.__class__.__name__,
+                'alive': True,
+                'failures': 0}
+
+
+class MemoryCache(CacheBackend):
+    """ Keep cache items in this process, for when there's no memcached.
+        Least recently used items are thrown out to keep the total size
+        under maxbytes. Items arrive packed into byte strings, so callers get
+        their own copy just as they would from memcached.
+
+        Other processes on the server have their own, and can't tell this
+        one when something changes, so nothing is kept for longer than
+        maxttl seconds.
+    """
+
+    def __init__(self, maxbytes, maxttl):
+
+        self.maxbytes = maxbytes
+        self.maxttl = maxttl
+        self.maxitem = min(maxbytes / 4, 1024 * 1024)
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.bytes = 0
+        L.info("Starting in-process cache (%d bytes)." % maxbytes)
+
+    def _pop(self, key):
+        """ Remove item, returning it. Call with the lock held. """
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.bytes -= len(item[1])
+        return item
+
     def get(self, key):
-        """ fetch item."""
-        key = "%s-%s" % (uniqueKey, key)
-        key = key.encode("utf-8")
-        try:
-            res = self.conn.get(key)
+        """ fetch item, or None if not there. """
+        with self.lock:
+            item = self._pop(key)
+            if item is None or item[0] <= time.time():
+                return None
+            self.items[key] = item  # move to most recently used end
+            self.bytes += len(item[1])
+        return item[1]
 
-        except BaseException as err:
-            # it's possible that something went wrong
-            L.error("Memcache Error. (%s)" % err)
+    def set(self, key, value, expiry=None):
+        """ store item, for no longer than expiry seconds if given. """
+        return self._store(key, value, expiry, replace=True)
+
+    def add(self, key, value, expiry=None):
+        """ store item only if it isn't there already. """
+        return self._store(key, value, expiry, replace=False)
+
+    def _store(self, key, value, expiry, replace):
+        """ store item, unless replace is False and it's already there. """
+        data = value
+        if len(data) > self.maxitem:
+            if replace:
+                self.delete(key)
             return False
+        ttl = self.maxttl
+        if expiry:
+            ttl = min(ttl, expiry)
+        now = time.time()
+        with self.lock:
+            item = self._pop(key)
+            if not replace and item is not None and item[0] > now:
+                self.items[key] = item
+                self.bytes += len(item[1])
+                return False
+            self.items[key] = (now + ttl, data)
+            self.bytes += len(data)
+            while self.bytes > self.maxbytes:
+                (_, (_, old)) = self.items.popitem(last=False)
+                self.bytes -= len(old)
+        return True
+
+    def delete(self, key):
+        """ remove item. """
+        with self.lock:
+            self._pop(key)
+        return True
+
+    def status(self):
+        """ Return a dict describing the state of the cache. """
+        with self.lock:
+            return {'address': "in process",
+                    'alive': True,
+                    'failures': 0,
+                    'items': len(self.items),
+                    'bytes': self.bytes}
+
+
+def _ring_hash(key):
+    """ Position of the key on the hash ring. """
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """ Consistent hashing of keys onto a set of servers. Every process given
+        the same server list puts a key on the same server, and adding or
+        removing a server only moves the keys that were near it on the ring,
+        not nearly all of them as "hash modulo number of servers" would.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        """ Each node gets replicas points on the ring, to spread keys evenly.
+        """
+        self.nodes = sorted(nodes)
+        ring = []
+        for node in self.nodes:
+            for num in range(replicas):
+                ring.append((_ring_hash("%s-%d" % (node, num)), node))
+        ring.sort()
+        self.points = [point for point, _ in ring]
+        self.ring = [node for _, node in ring]
+
+    def get_node(self, key):
+        """ The node the key belongs on. """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        if not self.nodes:
+            return None
+        idx = bisect.bisect(self.points, _ring_hash(key))
+        if idx == len(self.points):
+            idx = 0
+        return self.ring[idx]
+
+
+class MCConn(CacheBackend):
+    """ Look after connections to one memcached server.
+        Each thread gets its own client, since python-memcached's aren't safe
+        to share. If the server stops responding it's marked dead for
+        dead_retry seconds, during which calls act as if the cache were
+        empty, rather than each waiting on it and logging an error.
+    """
+
+    def __init__(self, address, dead_retry=30):
+
+        self.address = address
+        self.dead_retry = dead_retry
+        self.dead_until = 0
+        self.dead = False
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _client(self):
+        """ This thread's client for the server. """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # We do our own dead server handling, shared between threads.
+            conn = memcache.Client([self.address], debug=0, dead_retry=0)
+            self.local.conn = conn
+        return conn
 
+    def _failed(self, reason):
+        """ Mark the server as dead for a while. Only logged once. """
+        with self.lock:
+            self.failures += 1
+            if not self.dead:
+                L.error("Memcache server %s failed, not using it for %ss. (%s)" %
+                        (self.address, self.dead_retry, reason))
+            self.dead = True
+            self.dead_until = time.time() + self.dead_retry
+
+    def _call(self, default, method, *args):
+        """ Run the client method, returning default if the server is, or
+            turns out to be, dead.
+        """
+        if self.dead and self.dead_until > time.time():
+            return default
+        conn = self._client()
+        try:
+            res = getattr(conn, method)(*args)
+        except memcache.Client.MemcachedKeyError as err:
+            # a problem with this key, not with the server
+            L.error("Memcache refused key for %s on %s. (%s)" %
+                    (method, self.address, err))
+            return default
+        except (socket.error, IOError) as err:
+            self._failed(err)
+            return default
+        # python-memcached doesn't raise errors, it marks the server dead
+        # and carries on.
+        for host in getattr(conn, "servers", []):
+            if host.deaduntil:
+                host.deaduntil = 0
+                self._failed("connection failed")
+                return default
+        if self.dead:
+            with self.lock:
+                if self.dead:
+                    L.warn("Memcache server %s is back." % self.address)
+                    self.dead = False
         return res
 
+    def is_alive(self):
+        """ Whether we're currently using the server. """
+        return not (self.dead and self.dead_until > time.time())
+
+    def status(self):
+        """ Return a dict describing the state of the server. """
+        return {'address': self.address,
+                'alive': self.is_alive(),
+                'failures': self.failures,
+                'dead_until': self.dead_until}
+
+    def set(self, key, value, expiry=None):
+        """ store item. """
+        return bool(self._call(False, "set", key, value, expiry or 0))
+
+    def get(self, key):
+        """ fetch item."""
+        return self._call(None, "get", key)
+
     def delete(self, key):
         """ remove item."""
-        key = "%s-%s" % (uniqueKey, key)
-        key = key.encode("utf-8")
-        try:
-            res = self.conn.delete(key)
+        return self._call(False, "delete", key)
 
-        except IOError as err:
-            # it's possible that something went wrong
-            L.error("Memcache Error. (%s)" % err)
-            return False
+    def add(self, key, value, expiry=None):
+        """ store item only if it isn't there already. """
+        return bool(self._call(False, "add", key, value, expiry or 0))
 
-        return res
+    def get_multi(self, keys):
+        """ fetch several items in one round trip.
+            Returns a dict of the ones found.
+        """
+        return self._call({}, "get_multi", keys)
+
+    def set_multi(self, mapping, expiry=None):
+        """ store several items in one round trip.
+            Returns True if they were all stored.
+        """
+        failed = self._call(mapping.keys(), "set_multi", mapping, expiry or 0)
+        return not failed
+
+    def delete_multi(self, keys):
+        """ remove several items in one round trip."""
+        return self._call(False, "delete_multi", keys)
 
 
-# nowadays memcache-client comes with its own pool, but this works and I haven't
-# had time to evaluate the memcache one.
 class MCPool(object):
-    """ Look after a pool of connections to the memcached. As well as reducing
-        total number of connections used, libmemcache also doesn't appear to be
-        threadsafe, so this gives us some protection.
+    """ Spread cache items over one or more memcached servers, so several
+        web servers can share one cache. Keys are placed on the servers by
+        consistent hashing.
+        Values are packed into byte strings by CachePack. Hits, misses, etc.
+        are counted in CacheStats (items found in the LocalCache aren't, it
+        has its own counts).
     """
 
-    def __init__(self, connectstring, size):
-        """Call with the connection string and a number of
-           connections to put in the pool.
+    def __init__(self, servers, local=None, dead_retry=30, backend=None):
+        """Call with a list of "host:port" memcached servers. If given a
+           LocalCache, items it's interested in are kept in memory too.
+           If given a CacheBackend, it's used instead of memcached.
         """
 
-        self.connqueue = Queue.Queue(size)
-        self.size = size
-        for _ in range(0, size):
-            try:
-                if not OaConfig.memcache_enable:
-                    mc = FakeMCConn
-                else:
-                    mc = MCConn
-            except AttributeError:
-                mc = MCConn
-            self.connqueue.put(mc(connectstring))
+        if isinstance(servers, basestring):
+            servers = servers.replace(",", " ").split()
+        self.local = local
+        if backend is not None:
+            self.conns = {"backend": backend}
+        else:
+            self.conns = dict([(server, MCConn(server, dead_retry))
+                               for server in servers])
+        self.ring = HashRing(self.conns.keys())
+
+    @staticmethod
+    def _key(key):
+        """ The key as stored in memcached. Keys memcached won't take, too
+            long or with spaces or control characters in them (eg. from a
+            username someone typed), are replaced by a hash of them.
+        """
+        key = "%s-%s" % (uniqueKey, key)
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        if len(key) > MC_MAX_KEY_LENGTH or _RX_MC_BAD_KEY.search(key):
+            key = "%s-md5-%s" % (uniqueKey, hashlib.md5(key).hexdigest())
+        return key
+
+    def _conn(self, mckey):
+        """ The connection for the server the key lives on. """
+        return self.conns[self.ring.get_node(mckey)]
+
+    def _by_server(self, keys):
+        """ Split the keys up by the server they live on.
+            Returns {conn: {mckey: key}}
+        """
+        groups = {}
+        for key in keys:
+            mckey = self._key(key)
+            groups.setdefault(self._conn(mckey), {})[mckey] = key
+        return groups
 
     def get(self, key):
         """Get an item from the cache. """
-        if self.connqueue.qsize() < 3:
-            L.warn("Memcache Pool getting low! %d" % self.connqueue.qsize())
-        dbc = self.connqueue.get(True)
-        res = dbc.get(key)
-        self.connqueue.put(dbc)
+        if self.local:
+            (res, found) = self.local.get(key)
+            if found:
+                return res
+        mckey = self._key(key)
+        conn = self._conn(mckey)
+        res = conn.get(mckey)
+        if res is not None:
+            res = unpack(res)
+        if res is not None:
+            CacheStats.record("memcache", key, "hits")
+            if self.local:
+                self.local.set(key, res)
+        elif conn.is_alive():
+            CacheStats.record("memcache", key, "misses")
+        else:
+            CacheStats.record("memcache", key, "errors")
         return res
 
     def set(self, key, value, expiry=None):
         """Put an item into the cache. """
-        dbc = self.connqueue.get(True)
-        res = dbc.set(key, value, expiry)
-        self.connqueue.put(dbc)
+        if self.local:
+            self.local.set(key, value, expiry)
+        mckey = self._key(key)
+        data = pack(value)
+        res = self._conn(mckey).set(mckey, data, expiry)
+        if res:
+            CacheStats.record_set("memcache", key, data)
+        else:
+            CacheStats.record("memcache", key, "errors")
         return res
 
     def delete(self, key):
         """Remove an item from the cache. """
-        dbc = self.connqueue.get(True)
-        res = dbc.delete(key)
-        self.connqueue.put(dbc)
+        if self.local:
+            self.local.delete(key)
+        mckey = self._key(key)
+        return self._conn(mckey).delete(mckey)
+
+    def get_multi(self, keys):
+        """Get several items from the cache at once. Returns a dict of
+           the ones found.
+        """
+        res = {}
+        if self.local:
+            for key in keys:
+                (value, found) = self.local.get(key)
+                if found:
+                    res[key] = value
+            keys = [key for key in keys if key not in res]
+        for conn, mckeys in self._by_server(keys).iteritems():
+            found = conn.get_multi(mckeys.keys())
+            for mckey, value in found.items():
+                value = unpack(value)
+                if value is None:
+                    del found[mckey]
+                    continue
+                key = mckeys[mckey]
+                if self.local:
+                    self.local.set(key, value)
+                CacheStats.record("memcache", key, "hits")
+                res[key] = value
+            if conn.is_alive():
+                event = "misses"
+            else:
+                event = "errors"
+            for mckey, key in mckeys.iteritems():
+                if mckey not in found:
+                    CacheStats.record("memcache", key, event)
         return res
 
-    def __len__(self):
+    def set_multi(self, mapping, expiry=None):
+        """Put several items into the cache at once. """
+        if self.local:
+            for key, value in mapping.iteritems():
+                self.local.set(key, value, expiry)
+        res = True
+        for conn, mckeys in self._by_server(mapping.keys()).iteritems():
+            data = dict([(mckey, pack(mapping[key]))
+                         for mckey, key in mckeys.iteritems()])
+            stored = conn.set_multi(data, expiry)
+            for mckey, key in mckeys.iteritems():
+                if stored:
+                    CacheStats.record_set("memcache", key, data[mckey])
+                else:
+                    CacheStats.record("memcache", key, "errors")
+            if not stored:
+                res = False
+        return res
+
+    def delete_multi(self, keys):
+        """Remove several items from the cache at once. """
+        if self.local:
+            for key in keys:
+                self.local.delete(key)
+        res = True
+        for conn, mckeys in self._by_server(keys).iteritems():
+            if not conn.delete_multi(mckeys.keys()):
+                res = False
+        return res
+
+    def add(self, key, value, expiry=None):
+        """Put an item into the cache only if it isn't there already.
+           Returns True if it was stored. Not kept in the local tier.
         """
-        :return: integer : the number of free entries in the pool.
+        mckey = self._key(key)
+        data = pack(value)
+        res = self._conn(mckey).add(mckey, data, expiry)
+        if res:
+            CacheStats.record_set("memcache", key, data)
+        return res
+
+    def get_or_compute(self, key, compute, expiry, stale=None, lock_time=10,
+                       beta=1.0):
+        """ Return the cached value for key, or call compute() to make it
+            and cache it for expiry seconds. Guards against stampedes, where
+            a popular item expires and every request recomputes it at once:
+
+            - Only the request holding a lock key recomputes an item.
+              Meanwhile others carry on using the old value, for up to
+              stale seconds (default expiry) after it expired. If there's
+              no old value they wait up to lock_time seconds for the new one.
+            - Items are refreshed a little early, at random, more likely the
+              closer they are to expiring and the longer they took to
+              compute ("probabilistic early expiration", scaled by beta).
+
+            Items are stored as (value, expires, compute time), read them
+            only through here, get_computed_multi or set_computed_multi.
         """
-        return self.connqueue.qsize()
+        if stale is None:
+            stale = expiry
+        item = self.get(key)
+        now = time.time()
+        if item is not None:
+            (value, expires, delta) = item
+            # log() of (0, 1] is <= 0, so this is now plus a random bit
+            if now - delta * beta * math.log(1.0 - random.random()) < expires:
+                return value
+            locked = self._lock(key, lock_time)
+            if not locked and now < expires + stale:
+                # someone else is refreshing it
+                return value
+        else:
+            locked = self._lock(key, lock_time)
+            if not locked:
+                # someone else is computing it, wait for them.
+                waited = 0.0
+                while waited < lock_time:
+                    time.sleep(0.05)
+                    waited += 0.05
+                    item = self.get(key)
+                    if item is not None:
+                        return item[0]
+                    locked = self._lock(key, lock_time)
+                    if locked:
+                        # they gave up
+                        break
+        try:
+            started = time.time()
+            value = compute()
+            delta = time.time() - started
+            self.set(key, (value, time.time() + expiry, delta),
+                     int(expiry + stale))
+        finally:
+            if locked:
+                self.delete("%s-lock" % key)
+        return value
 
-    def total(self):
+    def _lock(self, key, lock_time):
+        """ Try to get the lock for recomputing the item. Returns True if we
+            have it, or if the cache isn't working so there's no point
+            waiting for anyone else.
         """
-        :return: integer : the number of db connections.
+        lockkey = "%s-lock" % key
+        if self.add(lockkey, 1, lock_time):
+            return True
+        return self.get(lockkey) is None
+
+    def get_computed_multi(self, keys):
+        """ Get several items stored by get_or_compute at once. Returns a
+            dict of the values that haven't expired.
         """
-        return self.size
+        now = time.time()
+        return dict([(key, item[0])
+                     for key, item in self.get_multi(keys).iteritems()
+                     if item[1] > now])
+
+    def set_computed_multi(self, mapping, expiry, stale=None):
+        """ Store several items for get_or_compute at once. """
+        if stale is None:
+            stale = expiry
+        expires = time.time() + expiry
+        return self.set_multi(dict([(key, (value, expires, 0.0))
+                                    for key, value in mapping.iteritems()]),
+                              int(expiry + stale))
+
+    def servers(self):
+        """
+        :return: list of dicts : the state of each server (or backend).
+        """
+        return [self.conns[server].status()
+                for server in sorted(self.conns)]
@@ -11,7 +11,7 @@ from oasis.lib import General
 
 from oasis.lib.Permissions import check_perm
 from oasis.lib.OaExceptions import OaMarkerError
-from . import OaConfig, DB, Pool, Topics
+from . import OaConfig, DB, Pool, Topics, QPool
 from logging import getLogger
 
 L = getLogger("oasisqe")
@@ -30,7 +30,9 @@ def get_practice_q(qt_id, user_id):
     qid = DB.get_q_by_qt_student(qt_id, user_id)
     if qid is not False:
         return int(qid)
-    qid = General.gen_q(qt_id, user_id)
+    qid = QPool.claim(qt_id, user_id)
+    if not qid:
+        qid = General.gen_q(qt_id, user_id)
     try:
         qid = int(qid)
     except (ValueError, TypeError):
@@ -195,18 +197,19 @@ def get_next_prev(qt_id, topic_id):
 def mark_q(user_id, topic_id, q_id, request):
     """Mark the question and return the results"""
     answers = {}
-    for i in request.form.keys():
-        part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
-        if part:
-            newqid = int(part.groups()[0])
-            part = int(part.groups()[1])
-            if newqid == q_id:
-                value = request.form[i]
-                answers["G%d" % part] = value
-                DB.save_guess(newqid, part, value)
-            else:
-                L.warn("received guess for wrong question? (%d,%d,%d,%s)" %
-                    (user_id, topic_id, q_id, request.form))
+    with DB.transaction():  # save all the guesses together
+        for i in request.form.keys():
+            part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
+            if part:
+                newqid = int(part.groups()[0])
+                part = int(part.groups()[1])
+                if newqid == q_id:
+                    value = request.form[i]
+                    answers["G%d" % part] = value
+                    DB.save_guess(newqid, part, value)
+                else:
+                    L.warn("received guess for wrong question? (%d,%d,%d,%s)" %
+                        (user_id, topic_id, q_id, request.form))
     try:
         marks = General.mark_q(q_id, answers)
         DB.set_q_status(q_id, 3)    # 3 = marked
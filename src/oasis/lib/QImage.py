@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" QImage.py
+    Draw the values of a question variation onto the question template's
+    image.gif. The datfile gives, for each value n, its position Xn, Yn and
+    the text to draw, Zn.
+
+    The font and the decoded template images are kept in memory, so drawing
+    a variation is just copying the image, drawing the text and encoding it.
+    Images can be encoded as GIF (as always) or PNG, set with q_image_format.
+    PNG keeps the template's palette if it has one, and is much smaller and
+    quicker to encode than GIF.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from StringIO import StringIO
+from logging import getLogger
+
+from PIL import Image, ImageDraw, ImageFont
+
+from oasis.lib import OaConfig
+
+L = getLogger("oasisqe")
+
+FONT = "Courier_New.ttf"
+FONT_SIZE = 14
+
+MIMETYPES = {"GIF": "image/gif", "PNG": "image/png"}
+
+# zlib level for PNGs. Higher levels take a few times as long for images
+# only a little smaller.
+PNG_COMPRESS_LEVEL = 1
+
+# How many decoded template images to keep in memory
+TEMPLATE_CACHE_SIZE = 50
+
+_fonts = {}
+_templates = OrderedDict()
+_lock = threading.Lock()
+
+
+def image_format():
+    """ The format to save question images in, "GIF" or "PNG". """
+    fmt = OaConfig.q_image_format.upper()
+    if fmt not in MIMETYPES:
+        L.warn("Unknown q_image_format %s, using GIF" % fmt)
+        return "GIF"
+    return fmt
+
+
+def mimetype(fmt=None):
+    """ The mime type of question images in the format. """
+    return MIMETYPES[fmt or image_format()]
+
+
+def get_font(name=FONT, size=FONT_SIZE):
+    """ Return the font, loading it the first time. """
+    key = (name, size)
+    font = _fonts.get(key)
+    if font is None:
+        font = ImageFont.truetype("%s/fonts/%s" % (OaConfig.homedir, name),
+                                  size)
+        _fonts[key] = font
+    return font
+
+
+def coords(qvars):
+    """ The values to draw for the variation, as a list of
+        (x, y, unicode text), in order.
+    """
+    nums = sorted([int(name[1:]) for name in qvars.keys()
+                   if name[:1] == "X" and name[1:].isdigit()])
+    out = []
+    for num in nums:
+        (xcoord, ycoord, value) = (qvars["X%d" % num],
+                                   qvars["Y%d" % num],
+                                   qvars["Z%d" % num])
+        (xcoord, ycoord) = (int(xcoord), int(ycoord))
+        if xcoord < 0 or ycoord < 0:
+            continue
+        if isinstance(value, str):
+            value = unicode(value, "utf-8")
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        out.append((xcoord, ycoord, value))
+    return out
+
+
+def get_template(image):
+    """ Return (the template image decoded as RGBA, its palette image or
+        None). They're shared, so don't change them.
+    """
+    key = hashlib.md5(image).digest()
+    with _lock:
+        if key in _templates:
+            template = _templates.pop(key)
+            _templates[key] = template
+            return template
+    img = Image.open(StringIO(image))
+    img.load()
+    palette = None
+    if img.mode == "P" and _has_black(img):
+        palette = img
+    template = (img.convert("RGBA"), palette)
+    with _lock:
+        _templates[key] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
+
+
+def _has_black(img):
+    """ Does the palette image have black in it, to draw the text with? """
+    pal = img.getpalette() or []
+    return any(pal[pos:pos + 3] == [0, 0, 0]
+               for pos in range(0, len(pal) - 2, 3))
+
+
+def render(image, points, fmt=None):
+    """ Draw the points (from coords()) onto the template image, returns
+        the encoded image.
+    """
+    fmt = fmt or image_format()
+    (base, palette) = get_template(image)
+    img = base.copy()
+    imgdraw = ImageDraw.Draw(img)
+    font = get_font()
+    for xcoord, ycoord, value in points:
+        try:
+            imgdraw.text((xcoord, ycoord), value, font=font, fill="black")
+        except UnicodeEncodeError as err:
+            L.warn(u"Unicode error generating image: %s [%s]." % (err, value))
+    data = StringIO()
+    if fmt == "PNG":
+        if palette:
+            img = img.convert("RGB").quantize(palette=palette, dither=0)
+        img.save(data, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        img.save(data, "GIF")
+    return data.getvalue()
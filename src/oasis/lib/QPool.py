@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" QPool.py
+    Practice question instances generated ahead of time.
+
+    Generating a question instance takes a handful of queries, and may draw
+    an image, all while the student waits for the page. Instead we keep a
+    few instances of each question template that's being practised already
+    generated (with their attachments) but not given to anyone: status 0,
+    no student. Giving one to a student is then a single UPDATE, and when a
+    pool gets down to OaConfig.qpool_low a background thread tops it up to
+    OaConfig.qpool_size.
+
+    Only the current version of a question template is pooled, instances of
+    older versions are removed when the pool is next topped up.
+"""
+
+import Queue
+import random
+import threading
+from logging import getLogger
+
+from oasis.lib import OaConfig, DB, General
+
+L = getLogger("oasisqe")
+
+POOLED = 0  # question status while it's waiting in the pool
+
+# Seconds one server may spend topping up a pool before another can try.
+FILL_LOCK_TIME = 120
+
+_queue = Queue.Queue()
+_pending = set()
+_lock = threading.Lock()
+_worker = None
+
+
+def claim(qt_id, student):
+    """ Give the student a pre-generated practice instance of the question
+        template. Returns its id, or False if there aren't any (or pools are
+        turned off), in which case the caller should generate one.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(student, int)
+    if OaConfig.qpool_size <= 0:
+        return False
+    version = DB.get_qt_version(qt_id)
+    q_id = DB.claim_pooled_q(qt_id, version, student)
+    request_fill(qt_id)
+    return q_id
+
+
+def request_fill(qt_id):
+    """ Have the background thread top up the pool of the question template,
+        if it's low. Returns straight away.
+    """
+    global _worker
+    with _lock:
+        if qt_id in _pending:
+            return
+        _pending.add(qt_id)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="qpool")
+            _worker.daemon = True
+            _worker.start()
+    _queue.put(qt_id)
+
+
+def _run():
+    """ The background thread, topping up pools as they're requested. """
+    while True:
+        qt_id = _queue.get()
+        with _lock:
+            _pending.discard(qt_id)
+        try:
+            fill(qt_id)
+        except Exception as err:
+            L.error("Unable to fill question pool of qtemplate %s: %s" %
+                    (qt_id, err))
+
+
+def fill(qt_id, low=None, size=None):
+    """ If the question template has low or fewer pooled instances, generate
+        more until there are size. Returns how many were generated.
+        Only one server at a time does this for a question template.
+    """
+    assert isinstance(qt_id, int)
+    if low is None:
+        low = OaConfig.qpool_low
+    if size is None:
+        size = OaConfig.qpool_size
+    version = DB.get_qt_version(qt_id)
+    have = DB.count_pooled_qs(qt_id, version)
+    if have > low or have >= size:
+        return 0
+    lock = "qpool-%d-fill" % qt_id
+    if not DB.MC.add(lock, 1, FILL_LOCK_TIME):
+        return 0
+    try:
+        DB.delete_stale_pooled_qs(qt_id, version)
+        numvars = DB.get_qt_num_variations(qt_id, version)
+        if numvars <= 0:
+            L.warn("No question variations (qtid=%d)" % qt_id)
+            return 0
+        made = 0
+        for _ in range(size - have):
+            variation = random.randint(1, numvars)
+            q_id = General.gen_q_from_var(qt_id, None, 0, 0, version,
+                                          variation, status=POOLED)
+            if not q_id:
+                L.warn("Failed to generate pooled instance of %s" % qt_id)
+                break
+            made += 1
+        return made
+    finally:
+        DB.MC.delete(lock)
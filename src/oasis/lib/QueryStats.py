@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" QueryStats.py
+    Keep track of how long our SQL statements take and how many each page
+    runs, so we can find the slow ones and the pages doing too many.
+    Statistics are per process, since startup.
+"""
+
+import re
+import threading
+from collections import deque
+from logging import getLogger
+
+import OaConfig
+
+L = getLogger("oasisqe.slowquery")
+
+# Keep this many recent timings of each statement, for the percentiles.
+SAMPLES = 200
+
+# Stop tracking new statements after this many, in case something is
+# building SQL with values in it.
+MAX_STATEMENTS = 1000
+
+_lock = threading.Lock()
+_statements = {}
+_requests = {}
+
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_RE_SPACE = re.compile(r"\s+")
+
+
+def normalize(sql):
+    """ Reduce the SQL to a form that's the same for every run of the
+        statement: literal values replaced with ?, whitespace squashed.
+    """
+    sql = _RE_STRING.sub("?", sql)
+    sql = _RE_NUMBER.sub("?", sql)
+    sql = _RE_LIST.sub("(...)", sql)
+    return _RE_SPACE.sub(" ", sql).strip()
+
+
+def _percentile(ordered, pct):
+    """ The pct percentile of an already sorted list. """
+    if not ordered:
+        return 0.0
+    idx = int(round((len(ordered) - 1) * pct / 100.0))
+    return ordered[idx]
+
+
+def record(sql, seconds, params=None):
+    """ Note that the statement took the given number of seconds to run,
+        and log it if it was slow.
+    """
+    key = statement = normalize(sql)
+    with _lock:
+        stat = _statements.get(key)
+        if stat is None:
+            if len(_statements) >= MAX_STATEMENTS:
+                key = "(other)"
+                stat = _statements.get(key)
+            if stat is None:
+                stat = {'count': 0,
+                        'total': 0.0,
+                        'max': 0.0,
+                        'samples': deque(maxlen=SAMPLES)}
+                _statements[key] = stat
+        stat['count'] += 1
+        stat['total'] += seconds
+        if seconds > stat['max']:
+            stat['max'] = seconds
+        stat['samples'].append(seconds)
+
+    if 0 < OaConfig.db_slow_query <= seconds:
+        # Only say how many parameters there were, they may be passwords,
+        # confirmation codes or students' answers.
+        L.warn("Slow query (%.3fs): %s ;(%s)" % (seconds, statement,
+                                                 _describe_params(params)))
+
+
+def _describe_params(params):
+    """ How many parameters the statement was given, for the log. """
+    if params is None:
+        return "no params"
+    if isinstance(params, basestring):
+        # eg. "200 rows" from a bulk statement, not a parameter
+        return params
+    try:
+        return "%d params" % len(params)
+    except TypeError:
+        return "1 param"
+
+
+def record_request(endpoint, queries, seconds):
+    """ Note that a web request to the endpoint ran the given number of
+        queries, taking seconds in total.
+    """
+    with _lock:
+        stat = _requests.get(endpoint)
+        if stat is None:
+            if len(_requests) >= MAX_STATEMENTS:
+                return
+            stat = {'count': 0, 'queries': 0, 'max': 0, 'time': 0.0}
+            _requests[endpoint] = stat
+        stat['count'] += 1
+        stat['queries'] += queries
+        stat['time'] += seconds
+        if queries > stat['max']:
+            stat['max'] = queries
+
+
+def top_statements(num=20):
+    """ Return statistics for the num statements that have used the most
+        time in total, as a list of dicts:
+            sql, count, total, mean, p50, p95, max
+        times are in seconds.
+    """
+    with _lock:
+        stats = [(key, stat['count'], stat['total'], stat['max'],
+                  sorted(stat['samples']))
+                 for key, stat in _statements.items()]
+    stats.sort(key=lambda s: s[2], reverse=True)
+    return [{'sql': key,
+             'count': count,
+             'total': total,
+             'mean': total / count,
+             'p50': _percentile(samples, 50),
+             'p95': _percentile(samples, 95),
+             'max': maxtime}
+            for key, count, total, maxtime, samples in stats[:num]]
+
+
+def top_requests(num=20):
+    """ Return the num endpoints that average the most queries per request,
+        as a list of dicts:  endpoint, count, mean, max, time
+    """
+    with _lock:
+        stats = [(endpoint, stat['count'], stat['queries'], stat['max'],
+                  stat['time'])
+                 for endpoint, stat in _requests.items()]
+    stats = [{'endpoint': endpoint,
+              'count': count,
+              'mean': float(queries) / count,
+              'max': maxq,
+              'time': qtime / count}
+             for endpoint, count, queries, maxq, qtime in stats]
+    stats.sort(key=lambda s: s['mean'], reverse=True)
+    return stats[:num]
+
+
+def reset():
+    """ Throw away the statistics collected so far. """
+    with _lock:
+        _statements.clear()
+        _requests.clear()
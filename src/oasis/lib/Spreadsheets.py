@@ -31,9 +31,7 @@ def exam_results_as_spreadsheet(course_id, group, exam_id):
             totals[user_id] += val['score']
 
     questions = Exams.get_qts_list(exam_id)
-    users = {}
-    for uid in uids:
-        users[uid] = Users2.get_user(uid)
+    users = Users2.get_users(uids)
 
     wb = Workbook()
 
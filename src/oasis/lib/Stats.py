@@ -44,6 +44,22 @@ def add_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
     DB.run_sql(sql, params)
 
 
+def add_prac_q_counts(counts):
+    """ Insert many practice counts. counts is a list of dicts with
+        year, month, day, hour, qtemplate, count, avgscore
+    """
+    sql = """INSERT INTO stats_prac_q_course ("qtemplate", "hour", "day",
+                                              "month", "year", "number",
+                                              "when", "avgscore")
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);"""
+    DB.run_many(sql, [(c['qtemplate'], c['hour'], c['day'],
+                       c['month'], c['year'], c['count'],
+                       datetime(year=c['year'], hour=c['hour'],
+                                day=c['day'], month=c['month']),
+                       c['avgscore'])
+                      for c in counts])
+
+
 def update_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
     """ Insert a practice count for the given time/qtemplate """
     sql = """UPDATE stats_prac_q_course SET "number"=%s, "avgscore"=%s
@@ -56,6 +72,21 @@ def update_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
     DB.run_sql(sql, params)
 
 
+def update_prac_q_counts(counts):
+    """ Update many practice counts. counts is a list of dicts with
+        year, month, day, hour, qtemplate, count, avgscore
+    """
+    sql = """UPDATE stats_prac_q_course SET "number"=%s, "avgscore"=%s
+                 WHERE hour=%s
+                 AND month=%s
+                 AND day=%s
+                 AND year=%s
+                 AND qtemplate=%s;"""
+    DB.run_many(sql, [(c['count'], c['avgscore'], c['hour'], c['month'],
+                       c['day'], c['year'], c['qtemplate'])
+                      for c in counts])
+
+
 def populate_prac_q_count(start=None, end=None):
     """  Go through the questions from start to end date and count the number of
          questions practiced. Store the results in stats_prac_q_course
@@ -83,14 +114,13 @@ def populate_prac_q_count(start=None, end=None):
                      EXTRACT (MONTH FROM marktime),
                      EXTRACT (DAY FROM marktime),
                      EXTRACT (HOUR FROM marktime),
-                     qtemplate;
+                     qtemplate
+              ORDER BY year, month, day, hour;
                      """
     params = (start, end)
-    res = DB.run_sql(sql, params)
-    if not res:
-        return False
-    for row in res:
-        data = {
+    batch = []
+    for row in DB.iter_sql(sql, params):
+        batch.append({
             'count': int(row[0]),
             'year': int(row[1]),
             'month': int(row[2]),
@@ -98,28 +128,43 @@ def populate_prac_q_count(start=None, end=None):
             'hour': int(row[4]),
             'qtemplate': int(row[5]),
             'avgscore': float(row[6])
-        }
-        exist_count = prac_q_count(data['year'],
-                                   data['month'],
-                                   data['day'],
-                                   data['hour'],
-                                   data['qtemplate'])
-        if exist_count is False:  # could be 0
-            add_prac_q_count(data['year'],
-                             data['month'],
-                             data['day'],
-                             data['hour'],
-                             data['qtemplate'],
-                             data['count'],
-                             data['avgscore'])
+        })
+        if len(batch) >= 1000:
+            _save_prac_q_counts(batch)
+            batch = []
+    if batch:
+        _save_prac_q_counts(batch)
+
+
+def _save_prac_q_counts(counts):
+    """ Store a batch of practice counts, in time order, updating any hours
+        that are already there and inserting the rest.
+    """
+    first = counts[0]
+    last = counts[-1]
+    # Which hours already have an entry, so we know to UPDATE rather
+    # than INSERT. Fetch them all at once rather than asking for each.
+    sql = """SELECT "qtemplate", "hour", "day", "month", "year"
+             FROM stats_prac_q_course
+             WHERE "when" >= %s
+               AND "when" <= %s;"""
+    params = (datetime(year=first['year'], month=first['month'],
+                       day=first['day'], hour=first['hour']),
+              datetime(year=last['year'], month=last['month'],
+                       day=last['day'], hour=last['hour']))
+    existing = set([tuple(int(col) for col in row)
+                    for row in DB.run_sql(sql, params) or []])
+    inserts = []
+    updates = []
+    for data in counts:
+        if (data['qtemplate'], data['hour'], data['day'],
+                data['month'], data['year']) in existing:
+            updates.append(data)
         else:
-            update_prac_q_count(data['year'],
-                                data['month'],
-                                data['day'],
-                                data['hour'],
-                                data['qtemplate'],
-                                data['count'],
-                                data['avgscore'])
+            inserts.append(data)
+    with DB.transaction():
+        add_prac_q_counts(inserts)
+        update_prac_q_counts(updates)
 
 
 def daily_prac_q_count(start_time, end_time, qt_id):
@@ -134,7 +179,7 @@ def daily_prac_q_count(start_time, end_time, qt_id):
              GROUP BY "year","month","day"
              ORDER BY "year","month","day" ASC;"""
     params = (qt_id, start_time, end_time)
-    res = DB.run_sql(sql, params)
+    res = DB.run_sql(sql, params, readonly=True)
     if not res:
         res = []
     data = []
@@ -200,7 +245,7 @@ def daily_prac_load(start_time, end_time):
              GROUP BY "year","month","day"
              ORDER BY "year","month","day" ASC;"""
     params = (start_time, end_time)
-    res = DB.run_sql(sql, params)
+    res = DB.run_sql(sql, params, readonly=True)
     if not res:
         res = []
     data = []
@@ -6,20 +6,18 @@
 """ db/Topics.py
     Handle topic related operations.
 """
-import json
 from logging import getLogger
-from .DB import run_sql, MC
+from .DB import run_sql, MC, gen_key, get_generations, bump_generation
 
 L = getLogger("oasisqe")
 
 
 def create(course_id, name, vis, pos=1):
     """Add a topic to the database."""
-    key = "course-%s-topics" % course_id
-    MC.delete(key)
     L.info("db/Topics/create(%s, %s, %s, %s)" % (course_id, name, vis, pos))
     res = run_sql("""INSERT INTO topics (course, title, visibility, position)
         VALUES (%s, %s, %s, %s) RETURNING topic;""", (course_id, name, vis, pos))
+    bump_generation("course", course_id)
     if res:
         return res[0][0]
     L.error("Topic create error (%s, %s, %s, %s)" % (course_id, name, vis, pos))
@@ -28,30 +26,30 @@ def create(course_id, name, vis, pos=1):
 
 def get_topic(topic_id):
     """ Fetch a dictionary of topic values"""
-    key = "topic-%s-record" % topic_id
-    obj = MC.get(key)
-    if obj:
-        return json.loads(obj)
-    sql = """SELECT topic, course, title, visibility, position, archived
-             FROM topics
-             WHERE topic=%s;"""
-    params = (topic_id,)
-    ret = run_sql(sql, params)
-    if not ret:
-        raise KeyError("Unable to find topic %s" % topic_id)
-    row = ret[0]
-    topic = {
-        'id': row[0],
-        'course': row[1],
-        'title': row[2],
-        'visibility': row[3],
-        'position': row[4],
-        'archived': row[5]
-    }
-    if topic['position'] is None or topic['position'] is "None":
-        topic['position'] = 0
-    MC.set(key, json.dumps(topic))
-    return topic
+    key = gen_key("topic", topic_id, "record")
+
+    def load():
+        """ Fetch the topic from the database """
+        sql = """SELECT topic, course, title, visibility, position, archived
+                 FROM topics
+                 WHERE topic=%s;"""
+        params = (topic_id,)
+        ret = run_sql(sql, params)
+        if not ret:
+            raise KeyError("Unable to find topic %s" % topic_id)
+        row = ret[0]
+        topic = {
+            'id': row[0],
+            'course': row[1],
+            'title': row[2],
+            'visibility': row[3],
+            'position': row[4],
+            'archived': row[5]
+        }
+        if topic['position'] is None or topic['position'] is "None":
+            topic['position'] = 0
+        return topic
+    return MC.get_or_compute(key, load, 600)
 
 
 def get_name(topic_id):
@@ -64,8 +62,16 @@ def set_name(topic_id, name):
     assert isinstance(topic_id, int)
     assert isinstance(name, str) or isinstance(name, unicode)
     run_sql("UPDATE topics SET title=%s WHERE topic=%s;", (name, topic_id))
-    key = "topic-%s-record" % topic_id
-    MC.delete(key)
+    _changed(topic_id)
+
+
+def _changed(topic_id):
+    """ Throw away what's cached about the topic, and about its course,
+        which includes a summary of its topics.
+    """
+    course_id = get_course_id(topic_id)
+    bump_generation("topic", topic_id)
+    bump_generation("course", course_id)
 
 
 def get_pos(topic_id):
@@ -86,11 +92,7 @@ def set_pos(topic_id, pos):
     run_sql("""UPDATE topics
                SET position=%s
                WHERE topic=%s;""", (pos, topic_id))
-    key = "topic-%s-record" % topic_id
-    MC.delete(key)
-    course = get_course_id(topic_id)
-    key = "course-%s-topics" % course
-    MC.delete(key)
+    _changed(topic_id)
 
 
 def get_course_id(topic_id):
@@ -107,32 +109,32 @@ def set_vis(topic_id, vis):
     """Update the visibility of a topic."""
     run_sql("""UPDATE topics SET visibility=%s WHERE topic=%s;""",
             (vis, topic_id))
-    key = "topic-%s-record" % topic_id
-    MC.delete(key)
+    _changed(topic_id)
 
 
 def flush_num_qs(topic_id):
     """The number of questions in a topic may have changed so flush the cache.
     """
-    key = "topic-%s-numquestions" % topic_id
-    MC.delete(key)
+    _changed(topic_id)
 
 
 def get_num_qs(topic_id):
     """Tell us how many questions are in the given topic."""
-    key = "topic-%s-numquestions" % topic_id
-    obj = MC.get(key)
-    if obj:
-        return int(obj)
-    sql = """SELECT position
-            FROM questiontopics
-            WHERE topic=%s
-             AND position > 0
-            ORDER BY position;
-            """
-    params = (topic_id,)
-    try:
-        res = run_sql(sql, params)
+    key = gen_key("topic", topic_id, "numquestions")
+
+    def load():
+        """ Count them in the database """
+        sql = """SELECT position
+                FROM questiontopics
+                WHERE topic=%s
+                 AND position > 0
+                ORDER BY position;
+                """
+        params = (topic_id,)
+        try:
+            res = run_sql(sql, params)
+        except LookupError:
+            raise IOError("Database connection failed")
         num = 0
         if res:
             prev = -1
@@ -140,10 +142,40 @@ def get_num_qs(topic_id):
                 if int(row[0]) != prev:
                     num += 1
                     prev = int(row[0])
-        MC.set(key, num, 180)  # 3 minute cache
         return num
-    except LookupError:
-        raise IOError("Database connection failed")
+    return int(MC.get_or_compute(key, load, 180))  # 3 minute cache
+
+
+def get_num_qs_many(topic_ids):
+    """ Like get_num_qs, but for a list of topics at once.
+        Returns a dict of {topic_id: number of questions}
+    """
+    gens = get_generations("topic", topic_ids)
+    keys = dict([(gen_key("topic", topic_id, "numquestions", gens[topic_id]),
+                  topic_id)
+                 for topic_id in topic_ids])
+    nums = {}
+    for key, obj in MC.get_computed_multi(keys.keys()).iteritems():
+        nums[keys[key]] = int(obj)
+    missing = [topic_id for topic_id in topic_ids if topic_id not in nums]
+    if not missing:
+        return nums
+    sql = """SELECT topic, COUNT(DISTINCT position)
+            FROM questiontopics
+            WHERE topic IN %s
+             AND position > 0
+            GROUP BY topic;
+            """
+    params = (tuple(missing),)
+    found = dict([(topic_id, 0) for topic_id in missing])
+    for row in run_sql(sql, params) or []:
+        found[int(row[0])] = int(row[1])
+    MC.set_computed_multi(dict([(gen_key("topic", topic_id, "numquestions",
+                                         gens[topic_id]), num)
+                                for topic_id, num in found.iteritems()]),
+                          180)  # 3 minute cache
+    nums.update(found)
+    return nums
 
 
 def get_qts(topic_id):
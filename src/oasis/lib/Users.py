@@ -8,12 +8,12 @@
 """
 
 import hashlib
-import json
 import random
 from logging import getLogger
 import bcrypt
 
-from oasis.lib.DB import run_sql, MC
+from oasis.lib.DB import run_sql, MC, gen_key, get_generations, \
+    bump_generation
 
 
 L = getLogger("oasisqe")
@@ -21,9 +21,8 @@ L = getLogger("oasisqe")
 
 def get_version():
     """ Fetch the current version of the user table.
-        This will be incremented when anything in the users table is changed.
-        The idea is that while the version hasn't changed, user information
-        can be cached in memory.
+        This will be incremented when users are added. Changes to a user
+        bump their generation instead (see DB.bump_generation)
     """
     key = "userstable-version"
     obj = MC.get(key)
@@ -51,59 +50,90 @@ def incr_version():
     return -1
 
 
+_USER_COLUMNS = """id, uname, givenname, familyname, student_id,
+                    acctstatus, email, expiry, source, confirmed"""
+
+
+def _user_from_row(row):
+    """ Build a user record from a database row of _USER_COLUMNS """
+    if row[1]:
+        uname = unicode(row[1], 'utf-8')
+    else:
+        uname = u""
+    if row[2]:
+        givenname = unicode(row[2], 'utf-8')
+    else:
+        givenname = u""
+    if row[3]:
+        familyname = unicode(row[3], 'utf-8')
+    else:
+        familyname = u""
+    user_rec = {'id': int(row[0]),
+                'uname': uname,
+                'givenname': givenname,
+                'familyname': familyname,
+                'fullname': u"%s %s" % (givenname, familyname),
+                'student_id': row[4],
+                'acctstatus': row[5],
+                'email': row[6],
+                'expiry': row[7],
+                'source': row[8],
+                'confirmed': row[9]}
+    if row[9] is True \
+            or row[9] == "true" \
+            or row[9] == "TRUE" \
+            or row[9] == "" \
+            or row[9] is None:
+
+        user_rec['confirmed'] = True
+    else:
+        user_rec['confirmed'] = False
+    return user_rec
+
+
 def get_user_record(user_id):
     """ Fetch info about the user
         returns  {'id', 'uname', 'givenname', 'lastname', 'fullname'}
     """
-    # TODO: clear the cache entry when we change any of these values
-    key = "user-%s-record" % (user_id,)
+    key = gen_key("user", user_id, "record")
     obj = MC.get(key)
     if obj:
-        return json.loads(obj)
-    sql = """SELECT id, uname, givenname, familyname, student_id,
-                    acctstatus, email, expiry, source, confirmed
-                    FROM users
-                    WHERE id=%s"""
+        return obj
+    sql = """SELECT %s FROM users WHERE id=%%s""" % _USER_COLUMNS
     params = (user_id,)
     ret = run_sql(sql, params)
     if ret:
-        row = ret[0]
-        if row[1]:
-            uname = unicode(row[1], 'utf-8')
-        else:
-            uname = u""
-        if row[2]:
-            givenname = unicode(row[2], 'utf-8')
-        else:
-            givenname = u""
-        if row[3]:
-            familyname = unicode(row[3], 'utf-8')
-        else:
-            familyname = u""
-        user_rec = {'id': user_id,
-                    'uname': uname,
-                    'givenname': givenname,
-                    'familyname': familyname,
-                    'fullname': u"%s %s" % (givenname, familyname),
-                    'student_id': ret[0][4],
-                    'acctstatus': ret[0][5],
-                    'email': ret[0][6],
-                    'expiry': ret[0][7],
-                    'source': ret[0][8],
-                    'confirmed': ret[0][9]}
-        if ret[0][9] is True \
-                or ret[0][9] == "true" \
-                or ret[0][9] == "TRUE" \
-                or ret[0][9] == "" \
-                or ret[0][9] is None:
-
-            user_rec['confirmed'] = True
-        else:
-            user_rec['confirmed'] = False
-        MC.set(key, json.dumps(user_rec))
+        user_rec = _user_from_row(ret[0])
+        MC.set(key, user_rec)
         return user_rec
 
 
+def get_user_records(user_ids):
+    """ Fetch info about many users at once.
+        returns  {user_id: {'id', 'uname', 'givenname', 'lastname', ...}}
+        Users that can't be found are left out.
+    """
+    gens = get_generations("user", user_ids)
+    keys = dict([(gen_key("user", user_id, "record", gens[user_id]), user_id)
+                 for user_id in user_ids])
+    users = {}
+    for key, obj in MC.get_multi(keys.keys()).iteritems():
+        if obj:
+            users[keys[key]] = obj
+    missing = [user_id for user_id in keys.values() if user_id not in users]
+    if missing:
+        sql = """SELECT %s FROM users WHERE id IN %%s""" % _USER_COLUMNS
+        params = (tuple(missing),)
+        found = {}
+        for row in run_sql(sql, params) or []:
+            user_rec = _user_from_row(row)
+            users[user_rec['id']] = user_rec
+            found[gen_key("user", user_rec['id'], "record",
+                          gens[user_rec['id']])] = user_rec
+        MC.set_multi(found)
+    return users
+
+
 def set_password(user_id, clearpass):
     """ Updates a users password. """
     hashed = bcrypt.hashpw(clearpass, bcrypt.gensalt(log_rounds=10))
@@ -265,14 +295,14 @@ def verify_confirm_code(code):
 def set_confirm(uid):
     """ The user has confirmed, mark their record."""
     run_sql("""UPDATE "users" SET confirmed='TRUE' WHERE id=%s;""", (uid,))
-    incr_version()
+    bump_generation("user", uid)
 
 
 def set_confirm_code(uid, code):
     """ Set a new code, possibly for password reset confirmation."""
     run_sql("""UPDATE "users" SET confirmation_code=%s WHERE id=%s;""",
             (code, uid))
-    incr_version()
+    bump_generation("user", uid)
 
 
 def gen_confirm_code():
@@ -285,25 +315,25 @@ def gen_confirm_code():
 def set_studentid(uid, stid):
     """ Update student ID."""
     run_sql("""UPDATE "users" SET student_id=%s WHERE id=%s;""", (stid, uid,))
-    incr_version()
+    bump_generation("user", uid)
 
 
 def set_givenname(uid, name):
     """ Update Given Name."""
     run_sql("""UPDATE "users" SET givenname=%s WHERE id=%s;""", (name, uid,))
-    incr_version()
+    bump_generation("user", uid)
 
 
 def set_familyname(uid, name):
     """ Update Family Name."""
     run_sql("""UPDATE "users" SET familyname=%s WHERE id=%s;""", (name, uid,))
-    incr_version()
+    bump_generation("user", uid)
 
 
 def set_email(uid, email):
     """ Update Email."""
     run_sql("""UPDATE "users" SET email=%s WHERE id=%s;""", (email, uid,))
-    incr_version()
+    bump_generation("user", uid)
 
 
 # Human readable symbols
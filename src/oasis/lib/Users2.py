@@ -11,18 +11,15 @@
     as it's used.
 """
 
-# Get the latest version of the user info
-# We can cache information until this changes,
-# then we
-# need to flush and reread it from the Db layer
-# Something more fine-grained would be better longer term,
-# but this will do nicely for now.
-# We bump the version if any of  user    uname, firstname, lastname change
-from . import Users
+# The user table version is bumped when users are added, then we
+# flush everything and reread it from the Db layer as needed.
+# Each user's generation is bumped when their details change, then we
+# reread just that user.
+from . import Users, DB
 
 USERS_VERSION = -1
 
-# We store user  [id] = { id, uname, givenname, familyname}
+# We store user  [id] = (generation, { id, uname, givenname, familyname})
 USERS = {}
 
 
@@ -45,10 +42,29 @@ def get_user(user_id):
     """
 
     reload_users()
-    if user_id not in USERS:
-        USERS[user_id] = Users.get_user_record(user_id)
+    gen = DB.get_generation("user", user_id)
+    if user_id not in USERS or USERS[user_id][0] != gen:
+        USERS[user_id] = (gen, Users.get_user_record(user_id))
 
-    return USERS[user_id]
+    return USERS[user_id][1]
+
+
+def get_users(user_ids):
+    """ Return a dict of user fields for each of the users,
+        { user_id: {'id', 'uname', 'givenname', 'familyname', 'fullname'} }
+        Faster than calling get_user for each of them.
+    """
+
+    reload_users()
+    gens = DB.get_generations("user", user_ids)
+    missing = [user_id for user_id in user_ids
+               if user_id not in USERS or USERS[user_id][0] != gens[user_id]]
+    if missing:
+        found = Users.get_user_records(missing)
+        for user_id in missing:
+            USERS[user_id] = (gens[user_id], found.get(user_id))
+
+    return dict([(user_id, USERS[user_id][1]) for user_id in user_ids])
 
 
 uid_by_uname = Users.uid_by_uname
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+""" Test the caches in Pool.py and the packing of cached values.
+    None of these need memcached or the database.
+"""
+
+import datetime
+import os
+import time
+
+from oasis.lib import Pool, CachePack, OaConfig
+
+
+class Clock(object):
+    """ Stands in for time.time() so we can make things expire. """
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def test_cachepack_roundtrip(monkeypatch):
+    """ Values come back out as they went in, compressed or not. """
+    monkeypatch.setattr(OaConfig, "cache_compress_threshold", 100)
+    for value in ["", "bytes\x00\xff", u"unicode é", 0, False,
+                  [1, 2.5, None], {'when': datetime.datetime(2014, 3, 4, 5, 6)},
+                  "x" * 5000, {'big': range(1000)}]:
+        data = CachePack.pack(value)
+        assert isinstance(data, str)
+        assert CachePack.unpack(data) == value
+        assert type(CachePack.unpack(data)) == type(value)
+
+    assert CachePack.pack("x" * 5000)[0] == CachePack.COMPRESSED
+    assert CachePack.pack("x" * 50)[0] == CachePack.RAW
+
+    monkeypatch.setattr(OaConfig, "cache_compress_threshold", 0)
+    assert CachePack.pack("x" * 5000)[0] == CachePack.RAW
+
+
+def test_cachepack_foreign():
+    """ Things we didn't pack, like values left in memcache by an older
+        version, are treated as missing.
+    """
+    assert CachePack.unpack(None) is None
+    assert CachePack.unpack("") is None
+    assert CachePack.unpack(12) is None
+    assert CachePack.unpack(u"sunicode") is None
+    assert CachePack.unpack("(dp0\nS'old'\np1\nI1\ns.") is None
+    assert CachePack.unpack(CachePack.PICKLED + "not a pickle") is None
+    assert CachePack.unpack(CachePack.COMPRESSED + "not zlib") is None
+
+
+def test_hashring():
+    """ Keys are spread over the nodes the same way whatever order they're
+        given in, and removing a node only moves its own keys.
+    """
+    nodes = ["mc1:11211", "mc2:11211", "mc3:11211"]
+    ring = Pool.HashRing(nodes)
+    keys = ["key-%d" % num for num in range(3000)]
+    placed = dict([(key, ring.get_node(key)) for key in keys])
+
+    reordered = Pool.HashRing(reversed(nodes))
+    assert placed == dict([(key, reordered.get_node(key)) for key in keys])
+    for node in nodes:
+        assert 700 < placed.values().count(node) < 1300
+
+    smaller = Pool.HashRing(nodes[:2])
+    for key in keys:
+        if placed[key] != nodes[2]:
+            assert smaller.get_node(key) == placed[key]
+
+    assert Pool.HashRing(["only:11211"]).get_node("x") == "only:11211"
+    assert Pool.HashRing([]).get_node("x") is None
+
+
+def test_memorycache_eviction():
+    """ The least recently used items go when it's full. """
+    cache = Pool.MemoryCache(400, 60)
+    for num in range(4):
+        assert cache.set("k%d" % num, "x" * 100)
+    assert cache.get("k0") == "x" * 100   # now the most recently used
+    assert cache.set("k4", "x" * 100)
+    assert cache.get("k1") is None
+    assert cache.get("k0") == "x" * 100
+    assert cache.get("k4") == "x" * 100
+    assert cache.bytes <= 400
+
+    # too big to keep at all
+    assert not cache.set("k0", "x" * 101)
+    assert cache.get("k0") is None
+
+    assert not cache.add("k4", "y")
+    assert cache.add("k5", "y")
+    assert cache.delete("k5")
+    assert cache.get("k5") is None
+
+
+def test_memorycache_ttl(monkeypatch):
+    """ Items expire after their expiry, and never last longer than maxttl.
+    """
+    clock = Clock()
+    monkeypatch.setattr(Pool.time, "time", clock)
+    cache = Pool.MemoryCache(10000, 60)
+    cache.set("short", "a", 5)
+    cache.set("long", "b", 600)
+    cache.set("default", "c")
+    clock.now += 6
+    assert cache.get("short") is None
+    assert cache.add("short", "d")
+    assert cache.get("long") == "b"
+    clock.now += 60
+    assert cache.get("long") is None
+    assert cache.get("default") is None
+
+
+def test_localcache(monkeypatch):
+    """ Only keys in a namespace are kept, each namespace with its own size
+        and time to live.
+    """
+    clock = Clock()
+    monkeypatch.setattr(Pool.time, "time", clock)
+    local = Pool.LocalCache({
+        'small': (r"^small-", 2, 100),
+        'brief': (r"^brief-", 100, 5),
+    })
+    assert not local.set("other-1", "x")
+    assert local.get("other-1") == (None, False)
+
+    local.set("small-1", "a")
+    local.set("small-2", "b")
+    assert local.get("small-1") == ("a", True)
+    local.set("small-3", "c")
+    assert local.get("small-2") == (None, False)
+    assert local.get("small-1") == ("a", True)
+
+    local.set("brief-1", False)
+    local.set("small-4", "d", expiry=2)
+    assert local.get("brief-1") == (False, True)
+    clock.now += 3
+    assert local.get("small-4") == (None, False)
+    assert local.get("brief-1") == (False, True)
+    clock.now += 3
+    assert local.get("brief-1") == (None, False)
+    assert local.get("small-1") == ("a", True)
+
+    local.delete("small-1")
+    assert local.get("small-1") == (None, False)
+    stats = dict([(ns['name'], ns) for ns in local.stats()])
+    assert stats['small']['size'] == 0
+    assert stats['brief']['hits'] == 2
+
+
+def test_filecache_trim(tmpdir):
+    """ Trimming removes the least recently used items until it's under the
+        size, and anything older than the age limit.
+    """
+    cachedir = str(tmpdir)
+    cache = Pool.FileCache(cachedir)
+    now = time.time()
+    for num in range(5):
+        cache.set("item/%d" % num, "x" * 1000)
+        os.utime(os.path.join(cachedir, "item/%d" % num, "DATA"),
+                 (now - 1000 + num * 100, now - 1000 + num * 100))
+
+    assert cache.trim(maxbytes=3000, maxage=0) == (2, 2000, 3000)
+    assert cache.get("item/0") == (False, False)
+    assert cache.get("item/1") == (False, False)
+    assert not os.path.exists(os.path.join(cachedir, "item/0"))
+    assert cache.get("item/2") == ("x" * 1000, True)
+
+    # item/2 was just read, but reading only marks it used now and then
+    assert cache.trim(maxbytes=0, maxage=650) == (2, 2000, 1000)
+    assert cache.get("item/4") == ("x" * 1000, True)
+
+
+def test_mcpool_get_or_compute():
+    """ Computed once then cached, and values are stored packed. """
+    backend = Pool.MemoryCache(100000, 60)
+    pool = Pool.MCPool("", backend=backend)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'answer': 42}
+
+    assert pool.get_or_compute("test-item", compute, 30) == {'answer': 42}
+    assert pool.get_or_compute("test-item", compute, 30) == {'answer': 42}
+    assert len(calls) == 1
+    assert pool.get("test-item-lock") is None
+
+    raw = backend.get(Pool.MCPool._key("test-item"))
+    assert CachePack.unpack(raw)[0] == {'answer': 42}
+
+    # someone else is refreshing an expired item, so use the old value
+    expires = time.time() - 1
+    pool.set("test-item", ({'answer': 41}, expires, 0.0), 60)
+    pool.add("test-item-lock", 1, 10)
+    assert pool.get_or_compute("test-item", compute, 30) == {'answer': 41}
+    assert len(calls) == 1
+    pool.delete("test-item-lock")
+    assert pool.get_or_compute("test-item", compute, 30) == {'answer': 42}
+    assert len(calls) == 2
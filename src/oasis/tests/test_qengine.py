@@ -8,6 +8,7 @@
 # code from all over the place :)
 
 import datetime
+import random
 
 from oasis.lib import General
 
@@ -160,6 +161,71 @@ def test_instance_generate_variable():
     assert res == html
 
 
+def test_instance_generate_compiled():
+    """ Check the compiled HTML gives the same instance as doing it the long
+        way, including shuffled options and odd templates that it hands
+        over to the long way.
+
+        No side effects.
+    """
+
+    qvars = {"a": 1, "b": "two", "c": "3.5", "d": "<VAL a>", "Oasis_qid": 5}
+    tmpls = [
+        "<IMG SRC>Q<VAL a> <ANSWER1> <ANSWER2 5> <ANSWER3 TEXT>",
+        "<ANSWER1 MULTI a,b,c><ANSWER2 SELECT c,b,a><ANSWER3 MULTIF a,zz>",
+        "<ANSWER1 MULTIV a,b>x<ANSWER1 MULTIV a,b>y",
+        "<IMG SRC a> <ATT SRC b> <VAL zz> <VAL Oasis_qid>",
+        "<VAL d> <ANSWER1 MULTI a,d>",
+        "<<VAL b>> <ANSWER60 MULTI a,b> <ANSWER4 MULTI a,",
+        "<ANSWER1 MULTIV a,b>x<ANSWER1 MULTIV b>",
+    ]
+    for tmpl in tmpls:
+        random.seed(tmpl)
+        html = General._gen_q_html_passes(qvars, tmpl)
+        random.seed(tmpl)
+        assert General.gen_q_html(qvars, tmpl) == html
+
+    # the ordinary ones shouldn't need the long way
+    for tmpl in tmpls[:4]:
+        assert General.compile_q_html(tmpl).parts is not None
+
+
+def test_q_display_compiled():
+    """ Check the compiled question display gives the same HTML as doing it
+        the long way, for various guesses, including odd questions and
+        guesses that it hands over to the long way.
+
+        No side effects.
+    """
+
+    texts = [
+        u"<INPUT NAME=ANS_1 VALUE='VAL_1'> <IMG SRC='$IMAGES$x.png'>",
+        u"<SELECT NAME=ANS_2><OPTION Oa_SEL_2_1>a<OPTION Oa_SEL_2_2>b"
+        u"</SELECT><INPUT Oa_CHK_3_1> <INPUT Oa_CHK_3_12> $STATIC$ $APPLET$",
+        u"VAL_1 VAL_10 VAL_25 Oa_SEL_1_50 Oa_CHK_25_1 \xe9",
+        u"xVAL_1 VAL_1x VAL_26 Oa_SEL_1_51 Oa_CHK_1_",
+        u"VAL_\x01 ANS_ANS_1",
+    ]
+    guesses = [
+        {},
+        {"G1": "2", "G2": "2.0", "G3": "12"},
+        {"G1": None, "G2": "None", "G25": "1"},
+        {"G1": "<b>&", "G10": 0, "G3": "1.5"},
+        {"G1": "VAL_2", "G2": "1"},
+    ]
+    for text in texts:
+        for readonly in (False, True):
+            compiled = General.CompiledQDisplay(text, 4, 2, 7, readonly)
+            for guess in guesses:
+                html = General._q_display_passes(text, 123, 4, 2, 7, readonly,
+                                                 dict(guess))
+                assert compiled.render(123, dict(guess)) == html
+
+    # the ordinary ones shouldn't need the long way
+    for text in texts[:3]:
+        assert General.CompiledQDisplay(text, 4, 2, 7, False).parts is not None
+
+
 def test_html_esc():
     """ Check that our HTML escaping works ok. ( & -> &amp;  etc)
     """
@@ -12,13 +12,13 @@ import os
 from datetime import datetime
 
 from flask import render_template, \
-    request, redirect, abort, url_for, flash
+    request, redirect, abort, url_for, flash, jsonify
 
 from logging import getLogger
-from oasis.lib import Courses, Courses2, Setup, Periods, Feeds, External, UFeeds, OaConfig
+from oasis.lib import Courses, Courses2, Setup, Periods, Feeds, External, UFeeds
 
 MYPATH = os.path.dirname(__file__)
-from .lib import DB, Groups
+from .lib import DB, Groups, QueryStats, CacheStats
 from oasis import app, require_perm
 
 L = getLogger("oasisqe")
@@ -56,12 +56,17 @@ def admin_sysstats():
     db_sizes = DB.get_db_size()
     db_queue_size = DB.dbpool.total()
     db_queue_free = len(DB.dbpool)
-    if OaConfig.memcache_enable:
-        mc_queue_size = DB.MC.total()
-        mc_queue_free = len(DB.MC)
+    db_queue_max = DB.dbpool.maxsize
+    db_waits = DB.dbpool.wait_stats()
+    if DB.localCache:
+        local_cache = DB.localCache.stats()
     else:
-        mc_queue_free = 0
-        mc_queue_size = 0
+        local_cache = []
+    try:
+        top = int(request.args.get("top", 20))
+    except ValueError:
+        top = 20
+    mc_servers = DB.MC.servers()
     return render_template(
         "admin_sysstats.html",
         courses=Setup.get_sorted_courselist(),
@@ -69,12 +74,33 @@ def admin_sysstats():
         db_sizes=db_sizes,
         db_queue_size=db_queue_size,
         db_queue_free=db_queue_free,
-        mc_enable=OaConfig.memcache_enable,
-        mc_queue_size=mc_queue_size,
-        mc_queue_free=mc_queue_free
+        db_queue_max=db_queue_max,
+        db_waits=db_waits,
+        top=top,
+        top_statements=QueryStats.top_statements(top),
+        top_requests=QueryStats.top_requests(top),
+        mc_servers=mc_servers,
+        local_cache=local_cache,
+        cache_families=CacheStats.families()
     )
 
 
+@app.route("/admin/sysstats/cache")
+@require_perm('sysadmin')
+def admin_sysstats_cache():
+    """ Return the cache statistics of this process as JSON, for monitoring.
+    """
+    if DB.localCache:
+        local_cache = DB.localCache.stats()
+    else:
+        local_cache = []
+    return jsonify(result={
+        'families': CacheStats.families(),
+        'servers': DB.MC.servers(),
+        'local': local_cache
+    })
+
+
 @app.route("/admin/userfeeds")
 @require_perm('sysadmin')
 def admin_userfeeds():
@@ -142,23 +142,24 @@ def assess_assessmentpage(course_id, exam_id, page):
         Exams.touchuserexam(exam_id, user_id)
 
     form = request.form
-    for field in form.keys():
-        qinfo = re.search(r"^Q_(\d+)_ANS_(\d+)$", field)
-        if qinfo:
-            q_id = int(qinfo.groups()[0])
-            part = int(qinfo.groups()[1])
-            value = form[field]
-            timeremain = Exams.get_end_time(exam_id, user_id) - time.time()
-            if timeremain < -30:
-                flash("Time Exceeded, automatically submitting...")
-                return redirect(url_for("assess_submit",
-                                        course_id=course_id,
-                                        exam_id=exam_id))
-
-            if status < 6:
-                DB.save_guess(q_id, part, value)
-        else:
-            pass
+    with DB.transaction():  # save all the guesses together
+        for field in form.keys():
+            qinfo = re.search(r"^Q_(\d+)_ANS_(\d+)$", field)
+            if qinfo:
+                q_id = int(qinfo.groups()[0])
+                part = int(qinfo.groups()[1])
+                value = form[field]
+                timeremain = Exams.get_end_time(exam_id, user_id) - time.time()
+                if timeremain < -30:
+                    flash("Time Exceeded, automatically submitting...")
+                    return redirect(url_for("assess_submit",
+                                            course_id=course_id,
+                                            exam_id=exam_id))
+
+                if status < 6:
+                    DB.save_guess(q_id, part, value)
+            else:
+                pass
 
     Exams.touchuserexam(exam_id, user_id)
 
@@ -319,9 +319,7 @@ def cadmin_exam_results(course_id, exam_id):
                 totals[user_id] += val['score']
 
     questions = Exams.get_qts_list(exam_id)
-    users = {}
-    for uid in uids:
-        users[uid] = Users2.get_user(uid)
+    users = Users2.get_users(uids)
     return render_template(
         "cadmin_examresults.html",
         course=course,
@@ -512,7 +510,8 @@ def cadmin_editgroup(course_id, group_id):
     if not course:
         abort(404)
     ulist = group.members()
-    members = [Users2.get_user(uid) for uid in ulist]
+    users = Users2.get_users(ulist)
+    members = [users[uid] for uid in ulist]
     return render_template("courseadmin_editgroup.html",
                            course=course,
                            group=group,
@@ -9,15 +9,14 @@
 
 import os
 import StringIO
-import datetime
 
 from flask import render_template, session, \
     request, redirect, abort, url_for, flash, \
-    send_file, Response
+    send_file, Response, jsonify
 from logging import getLogger
 
 from .lib import Users2, DB, Topics, \
-    Courses2, Attach, QEditor
+    Courses2, Attach, QEditor, Materialize
 
 MYPATH = os.path.dirname(__file__)
 
@@ -34,40 +33,60 @@ L = getLogger("oasisqe")
 @app.route("/att/qatt/<int:qt_id>/<int:version>/<int:variation>/<fname>")
 def attachment_question(qt_id, version, variation, fname):
     """ Serve the given question attachment """
-    qtemplate = DB.get_qtemplate(qt_id)
-    if len(qtemplate['embed_id']) < 1:  # if it's not embedded, check auth
-        if 'user_id' not in session:
-            session['redirect'] = request.path
-            return redirect(url_for('index'))
-    if Attach.is_restricted(fname):
-        abort(403)
-    (mtype, fname) = Attach.q_att_details(qt_id, version, variation, fname)
-    if not mtype:
-        abort(404)
-
-    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
-    response = send_file(fname, mtype)
-    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    return response
+    return _send_attachment("qatt", qt_id, version, variation, fname)
 
 
 @app.route("/att/qtatt/<int:qt_id>/<int:version>/<int:variation>/<fname>")
 # Does its own auth because it may be used in embedded questions
 def attachment_qtemplate(qt_id, version, variation, fname):
     """ Serve the given question attachment """
-    qtemplate = DB.get_qtemplate(qt_id)
-    if len(qtemplate['embed_id']) < 1:  # if it's not embedded, check auth
-        if 'user_id' not in session:
-            session['redirect'] = request.path
-            return redirect(url_for('index'))
-    (mtype, filename) = Attach.q_att_details(qt_id, version, variation, fname)
+    return _send_attachment("qtatt", qt_id, version, variation, fname)
+
+
+def _send_attachment(kind, qt_id, version, variation, fname):
+    """ Send a question attachment. The URL includes the version and
+        variation so the content never changes: let browsers keep it
+        forever, and if they ask whether it's changed tell them no
+        without looking anything up. The exception is when the variation's
+        image.gif or qtemplate.html hasn't been generated yet and we send
+        the question template's instead.
+    """
     if Attach.is_restricted(fname):
         abort(403)
+    etag = Attach.etag(kind, qt_id, version, variation, fname)
+    if request.if_none_match.contains(etag):
+        # They already have it, so nothing to protect.
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "max-age=31536000, immutable"
+        return response
+
+    public = False
+    if 'user_id' not in session:
+        qtemplate = DB.get_qtemplate(qt_id)
+        if len(qtemplate['embed_id']) < 1:  # if it's not embedded, need auth
+            session['redirect'] = request.path
+            return redirect(url_for('index'))
+        public = True
+
+    (mtype, filename, final) = Attach.q_att_details(qt_id, version,
+                                                    variation, fname)
     if not mtype:
         abort(404)
-    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
-    response = send_file(filename, mtype)
-    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    # The file is in our file cache, so with x_sendfile on the web server
+    # sends it directly.
+    response = send_file(filename, mtype, add_etags=False)
+    # Embedded questions may be shown to anyone, so shared caches can keep
+    # them too.
+    scope = "public" if public else "private"
+    if not final:
+        # The template's, until the variation's has been generated. Don't
+        # let them keep it.
+        response.headers["Cache-Control"] = "%s, max-age=60" % scope
+        return response
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "%s, max-age=31536000, immutable" % \
+        scope
     return response
 
 
@@ -208,10 +227,29 @@ def qedit_raw_edit(topic_id, qt_id):
         topic=topic,
         html=html,
         attachments=attachments,
-        qtemplate=qtemplate
+        qtemplate=qtemplate,
+        materialize=Materialize.progress(qt_id)
     )
 
 
+@app.route("/qedit_raw/materialize/<int:topic_id>/<int:qt_id>")
+@authenticated
+def qedit_raw_materialize(topic_id, qt_id):
+    """ Return (JSON) how far generating the variations of the question
+        template has got.
+    """
+    user_id = session['user_id']
+    course_id = Topics.get_course_id(topic_id)
+    if not (check_perm(user_id, course_id, "courseadmin")
+            or check_perm(user_id, course_id, "questionedit")
+            or check_perm(user_id, course_id, "questionsource")):
+        abort(401)
+    if DB.get_qtemplate_topic_pos(qt_id, topic_id) is False:
+        # They may be trying to bypass the permission check
+        abort(401)
+    return jsonify(result=Materialize.progress(qt_id) or {})
+
+
 @app.route("/qedit_raw/save/<int:topic_id>/<int:qt_id>", methods=['POST', ])
 @authenticated
 def qedit_raw_save(topic_id, qt_id):
@@ -236,106 +274,107 @@ def qedit_raw_save(topic_id, qt_id):
                                 course_id=course_id,
                                 topic_id=topic_id))
 
-    version = DB.incr_qt_version(qt_id)
-    owner = Users2.get_user(user_id)
-    DB.update_qt_owner(qt_id, user_id)
-    audit(3, user_id, qt_id, "qeditor",
-          "version=%s,message=%s" %
-          (version, "Edited: ownership set to %s" % owner['uname']))
-
-    if 'qtitle' in form:
-        qtitle = form['qtitle']
-        qtitle = qtitle.replace("'", "&#039;")
-        title = qtitle.replace("%", "&#037;")
-        DB.update_qt_title(qt_id, title)
-
-    if 'embed_id' in form:
-        embed_id = form['embed_id']
-        embed_id = ''.join([ch for ch in embed_id
-                            if ch in valid])
-        if not DB.update_qt_embedid(qt_id, embed_id):
-            flash("Error updating EmbedID, "
-                  "possibly the value is already used elsewhere.")
-
-    # They entered something into the html field and didn't upload a
-    # qtemplate.html
-    if not ('newattachmentname' in form
-            and form['newattachmentname'] == "qtemplate.html"):
-        if 'newhtml' in form:
-            html = form['newhtml'].encode("utf8")
-            DB.create_qt_att(qt_id,
-                             "qtemplate.html",
-                             "text/plain",
-                             html,
-                             version)
-
-    # They uploaded a new qtemplate.html
-    if 'newindex' in request.files:
-        data = request.files['newindex'].read()
-        if len(data) > 1:
-            html = data
-            DB.create_qt_att(qt_id,
-                             "qtemplate.html",
-                             "text/plain",
-                             html,
-                             version)
-
-    # They uploaded a new datfile
-    if 'newdatfile' in request.files:
-        data = request.files['newdatfile'].read()
-        if len(data) > 1:
-            DB.create_qt_att(qt_id,
-                             "datfile.txt",
-                             "text/plain",
-                             data,
-                             version)
-            qvars = QEditor.parse_datfile(data)
-            for row in range(0, len(qvars)):
-                DB.add_qt_variation(qt_id, row + 1, qvars[row], version)
-
-                # They uploaded a new image file
-    if 'newimgfile' in request.files:
-        data = request.files['newimgfile'].read()
-        if len(data) > 1:
-            df = data
-            DB.create_qt_att(qt_id, "image.gif", "image/gif", df, version)
-
-    if 'newmodule' in form:
-        try:
-            newmodule = int(form['newmodule'])
-        except (ValueError, TypeError):
-            flash(form['newmodule'])
-        else:
-            DB.update_qt_marker(qt_id, newmodule)
-
-    if 'newmaxscore' in form:
-        try:
-            newmaxscore = float(form['newmaxscore'])
-        except (ValueError, TypeError):
-            newmaxscore = None
-        DB.update_qt_maxscore(qt_id, newmaxscore)
-
-    newname = False
-    if 'newattachmentname' in form:
-        if len(form['newattachmentname']) > 1:
-            newname = form['newattachmentname']
-    if 'newattachment' in request.files:
-        fptr = request.files['newattachment']
-        if not newname:
-            # If they haven't supplied a filename we use
-            # the name of the file they uploaded.
-            # TODO: Security check? We don't create disk files with this name
-            newname = fptr.filename
-        if len(newname) < 1:
-            L.info("File with no name uploaded by %s" % (session['username']))
-            newname = 'NONAME'
-        data = fptr.read()
-        mtype = fptr.content_type
-
-        if len(data) >= 1 and newname == 'NONAME':
-            DB.create_qt_att(qt_id, newname, mtype, data, version)
-            L.info("File '%s' uploaded by %s" % (newname, session['username']))
-
+    with DB.transaction():
+        version = DB.incr_qt_version(qt_id)
+        owner = Users2.get_user(user_id)
+        DB.update_qt_owner(qt_id, user_id)
+        audit(3, user_id, qt_id, "qeditor",
+              "version=%s,message=%s" %
+              (version, "Edited: ownership set to %s" % owner['uname']))
+
+        if 'qtitle' in form:
+            qtitle = form['qtitle']
+            qtitle = qtitle.replace("'", "&#039;")
+            title = qtitle.replace("%", "&#037;")
+            DB.update_qt_title(qt_id, title)
+
+        if 'embed_id' in form:
+            embed_id = form['embed_id']
+            embed_id = ''.join([ch for ch in embed_id
+                                if ch in valid])
+            if not DB.update_qt_embedid(qt_id, embed_id):
+                flash("Error updating EmbedID, "
+                      "possibly the value is already used elsewhere.")
+
+        # They entered something into the html field and didn't upload a
+        # qtemplate.html
+        if not ('newattachmentname' in form
+                and form['newattachmentname'] == "qtemplate.html"):
+            if 'newhtml' in form:
+                html = form['newhtml'].encode("utf8")
+                DB.create_qt_att(qt_id,
+                                 "qtemplate.html",
+                                 "text/plain",
+                                 html,
+                                 version)
+
+        # They uploaded a new qtemplate.html
+        if 'newindex' in request.files:
+            data = request.files['newindex'].read()
+            if len(data) > 1:
+                html = data
+                DB.create_qt_att(qt_id,
+                                 "qtemplate.html",
+                                 "text/plain",
+                                 html,
+                                 version)
+
+        # They uploaded a new datfile
+        if 'newdatfile' in request.files:
+            data = request.files['newdatfile'].read()
+            if len(data) > 1:
+                DB.create_qt_att(qt_id,
+                                 "datfile.txt",
+                                 "text/plain",
+                                 data,
+                                 version)
+                qvars = QEditor.parse_datfile(data)
+                DB.add_qt_variations(qt_id, dict(enumerate(qvars, 1)), version)
+
+                    # They uploaded a new image file
+        if 'newimgfile' in request.files:
+            data = request.files['newimgfile'].read()
+            if len(data) > 1:
+                df = data
+                DB.create_qt_att(qt_id, "image.gif", "image/gif", df, version)
+
+        if 'newmodule' in form:
+            try:
+                newmodule = int(form['newmodule'])
+            except (ValueError, TypeError):
+                flash(form['newmodule'])
+            else:
+                DB.update_qt_marker(qt_id, newmodule)
+
+        if 'newmaxscore' in form:
+            try:
+                newmaxscore = float(form['newmaxscore'])
+            except (ValueError, TypeError):
+                newmaxscore = None
+            DB.update_qt_maxscore(qt_id, newmaxscore)
+
+        newname = False
+        if 'newattachmentname' in form:
+            if len(form['newattachmentname']) > 1:
+                newname = form['newattachmentname']
+        if 'newattachment' in request.files:
+            fptr = request.files['newattachment']
+            if not newname:
+                # If they haven't supplied a filename we use
+                # the name of the file they uploaded.
+                # TODO: Security check? We don't create disk files with this name
+                newname = fptr.filename
+            if len(newname) < 1:
+                L.info("File with no name uploaded by %s" % (session['username']))
+                newname = 'NONAME'
+            data = fptr.read()
+            mtype = fptr.content_type
+
+            if len(data) >= 1 and newname == 'NONAME':
+                DB.create_qt_att(qt_id, newname, mtype, data, version)
+                L.info("File '%s' uploaded by %s" % (newname, session['username']))
+
+    Materialize.start(qt_id, version)
     flash("Question changes saved")
     return redirect(url_for("qedit_raw_edit", topic_id=topic_id, qt_id=qt_id))
 
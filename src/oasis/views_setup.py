@@ -138,7 +138,7 @@ def setup_usersearch():
                 flash("Search term too short, please try something longer")
             else:
                 uids = Users2.find(needle)
-                users = [Users2.get_user(uid) for uid in uids]
+                users = Users2.get_users(uids).values()
                 if len(users) == 0:
                     nonefound = True
                 else: